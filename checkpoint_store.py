@@ -0,0 +1,123 @@
+"""
+Append-only checkpoint store of the enrichment stages. Instead of rewriting a whole dataframe after each batch, which
+costs a quadratic disk I/O over a run, each batch appends only its newly resolved rows to a log file, as a pickled
+frame of {key: value} records (e.g. {album_id: track_ids}). On restart the state is rebuilt by replaying the frames,
+the latest value of a key winning, and the log is periodically compacted into a single frame.
+"""
+import os
+import pickle
+
+
+class CheckpointStore:
+    """
+    Class storing the resolved rows of a stage in an append-only log
+
+    e.g. store = CheckpointStore('dataset/checkpoints/album_tracks.log')
+         to_fetch = [album_id for album_id in album_ids if album_id not in store]
+         store.append({album_id: track_ids})
+         track_ids = store.state[album_id]
+    """
+
+    def __init__(self, path: str, compact_every: int = 100, read_only: bool = False):
+        """
+        Parameters
+        ----------
+        path: The log file, created on the first append
+        compact_every: The number of frames appended after which the log is compacted
+        read_only: Whether to only read the log, e.g. to plan a run, a truncated frame is then skipped without
+        truncating the log, and the store cannot be written
+        """
+        self.path = path
+        self._compact_every = compact_every
+        self._read_only = read_only
+        self._nb_frames = 0
+        self.state = {}
+        self._replay()
+
+    def _replay(self):
+        """Rebuild the state from the frames of the log. A frame truncated by an interruption during its write is
+        dropped, along with the end of the file"""
+        if not os.path.isfile(self.path):
+            return
+
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    records = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                    print(f'Truncated frame dropped from {self.path}')
+                    break
+                self.state.update(records)
+                self._nb_frames += 1
+                valid_size = f.tell()
+
+        if valid_size < os.path.getsize(self.path) and not self._read_only:
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_size)
+
+        print(f'{len(self.state)} rows restored from {self.path}')
+
+    def _check_writable(self):
+        """Raise an error if the store was opened read-only"""
+        if self._read_only:
+            raise ValueError(f'The checkpoint store {self.path} is read-only')
+
+    def __contains__(self, key) -> bool:
+        return key in self.state
+
+    def __len__(self) -> int:
+        return len(self.state)
+
+    def append(self, records: dict):
+        """Append the newly resolved rows to the log
+
+        Parameters
+        ----------
+        records: The value of each key resolved since the previous append
+        """
+        if not records:
+            return
+        self._check_writable()
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'ab') as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.state.update(records)
+        self._nb_frames += 1
+        if self._nb_frames >= self._compact_every:
+            self.compact()
+
+    def seed(self, records: dict, source: str):
+        """Fill a store that has no log yet, e.g. with the rows of a checkpoint written in an older format. A store with
+        a log is left untouched, its rows being more recent than the ones of the source
+
+        Parameters
+        ----------
+        records: The value of each key already resolved
+        source: The origin of the records, reported in the log of the run
+        """
+        if os.path.isfile(self.path) or not records:
+            return
+
+        self.append(records)
+        self.compact()
+        print(f'{len(records)} rows seeded from {source}')
+
+    def compact(self):
+        """Rewrite the log as a single frame holding the current state. The new log is written aside and then renamed,
+        so that an interruption during the compaction does not lose the previous log"""
+        if not self.state:
+            return
+        self._check_writable()
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        compacted_path = self.path + '.compact'
+        with open(compacted_path, 'wb') as f:
+            pickle.dump(self.state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(compacted_path, self.path)
+
+        self._nb_frames = 1
@@ -0,0 +1,172 @@
+"""
+Entity resolution between the TMDB composers and the Spotify artists. A few artists are searched on Spotify for each
+composer, then the candidates are joined to the composers on blocking keys of their normalized names (first and last
+word), so that only the pairs sharing a key are scored, with a rapidfuzz similarity computed in parallel. The best
+candidate above the threshold is kept, the most popular artist winning a tie.
+
+The result is stored in dataset/composer_spotify_mapping.csv as an explicit tmdb_person_id -> spotify_artist_id table,
+the composers without a match included with an empty spotify_artist_id. A composer of the table is never searched nor
+matched again by the next runs.
+"""
+import os
+
+import pandas as pd
+from rapidfuzz import fuzz, process
+
+from helpers import normalize_words
+from spotify.SpotifyDataLoader import SpotifyDataLoader
+
+COMPOSER_MAPPING_PATH = 'dataset/composer_spotify_mapping.csv'
+
+MAPPING_COLUMNS = ['tmdb_person_id', 'tmdb_name', 'spotify_artist_id', 'spotify_name', 'score']
+
+# Number of Spotify artists searched for each composer
+NB_CANDIDATES = 5
+
+# Minimum similarity (0-100) between the names of a composer and of an artist to match them
+MATCH_THRESHOLD = 85
+
+
+def normalize_person_name(name: str) -> str:
+    """Normalize the name of a person: remove accents, case and punctuation, e.g. 'Jean-Michel Jarre' and
+    'Jean Michel Jarre' are both 'jean michel jarre'
+
+    Parameters
+    ----------
+    name: The name to normalize
+
+    Returns
+    -------
+    The normalized name
+    """
+    return normalize_words(name)
+
+
+def blocking_keys(name: str) -> list[str]:
+    """The blocking keys of a name, its first and last normalized words. A composer and an artist are only compared if
+    they share a key, which keeps the matches with a missing middle name or initial
+
+    Parameters
+    ----------
+    name: The name of a composer or an artist
+
+    Returns
+    -------
+    The distinct keys, empty for a name without any word
+    """
+    words = normalize_person_name(name).split()
+    return list(dict.fromkeys(words[:1] + words[-1:]))
+
+
+def match_composers(composers: pd.DataFrame, candidates: pd.DataFrame, threshold: float = MATCH_THRESHOLD) \
+        -> pd.DataFrame:
+    """Match each composer to the most similar candidate artist sharing one of its blocking keys
+
+    Parameters
+    ----------
+    composers: The composers, with the columns 'tmdb_person_id' and 'tmdb_name'
+    candidates: The Spotify artists found, with the columns 'spotify_artist_id', 'spotify_name' and 'popularity'
+    threshold: The minimum similarity (0-100) of a match
+
+    Returns
+    -------
+    The mapping, one row per composer with the columns of MAPPING_COLUMNS, the spotify columns are missing for the
+    composers without a match
+    """
+    composers = composers.drop_duplicates(subset='tmdb_person_id')
+    left = composers.assign(key=composers.tmdb_name.map(blocking_keys)).explode('key').dropna(subset=['key'])
+    right = candidates.drop_duplicates(subset='spotify_artist_id')
+    right = right.assign(key=right.spotify_name.map(blocking_keys)).explode('key').dropna(subset=['key'])
+
+    pairs = left.merge(right, on='key').drop_duplicates(subset=['tmdb_person_id', 'spotify_artist_id'])
+    if pairs.empty:
+        best = pairs.assign(score=pd.Series(dtype='float64'))
+    else:
+        # Scores all the pairs at once, on every core, instead of one extractOne per composer
+        scores = process.cpdist(pairs.tmdb_name.map(normalize_person_name).tolist(),
+                                pairs.spotify_name.map(normalize_person_name).tolist(),
+                                scorer=fuzz.token_sort_ratio, workers=-1)
+        best = pairs.assign(score=scores)
+        best = best[best.score >= threshold].sort_values(['score', 'popularity'], ascending=False, kind='stable')
+
+    best = best.drop_duplicates(subset='tmdb_person_id')[['tmdb_person_id', 'spotify_artist_id', 'spotify_name',
+                                                          'score']]
+    return composers[['tmdb_person_id', 'tmdb_name']].merge(best, on='tmdb_person_id', how='left')[MAPPING_COLUMNS]
+
+
+def load_mapping(mapping_path: str = COMPOSER_MAPPING_PATH) -> pd.DataFrame:
+    """Load the composers already resolved
+
+    Parameters
+    ----------
+    mapping_path: The csv file written by resolve_composers
+
+    Returns
+    -------
+    The mapping, with the columns of MAPPING_COLUMNS, empty if the file does not exist
+    """
+    if not os.path.isfile(mapping_path):
+        return pd.DataFrame(columns=MAPPING_COLUMNS)
+
+    return pd.read_csv(mapping_path, dtype={'tmdb_name': str, 'spotify_artist_id': str, 'spotify_name': str})
+
+
+def link_legacy_composers(spotify_composers: pd.DataFrame, composers: pd.DataFrame) -> pd.DataFrame:
+    """Link the artists of a Spotify composers dataset created before the explicit mapping, which only has their
+    Spotify 'name', to the TMDB composers of the same normalized name
+
+    Parameters
+    ----------
+    spotify_composers: The Spotify composers dataset (spotify_composers_dataset)
+    composers: The TMDB composers, with the column 'tmdb_name' and optionally 'tmdb_person_id'
+
+    Returns
+    -------
+    The dataset unchanged if it already has the 'tmdb_name' column, otherwise its artists matching a composer, with the
+    columns of the composer added
+    """
+    if 'tmdb_name' in spotify_composers.columns:
+        return spotify_composers
+
+    composers = composers.drop_duplicates().assign(key=composers.tmdb_name.map(normalize_person_name))
+    return spotify_composers.assign(key=spotify_composers.name.map(normalize_person_name)) \
+        .merge(composers, on='key').drop(columns='key')
+
+
+async def resolve_composers(composers: pd.DataFrame, spotify: SpotifyDataLoader,
+                            mapping_path: str = COMPOSER_MAPPING_PATH, nb_candidates: int = NB_CANDIDATES,
+                            threshold: float = MATCH_THRESHOLD) -> pd.DataFrame:
+    """Map the composers to their Spotify artist. Only the composers missing from the mapping file are searched, and
+    their result is appended to it
+
+    Parameters
+    ----------
+    composers: The composers, with the columns 'tmdb_person_id' and 'tmdb_name'
+    spotify: The Spotify loader used to search the artists
+    mapping_path: The csv file storing the mapping
+    nb_candidates: The number of artists searched for each composer
+    threshold: The minimum similarity (0-100) of a match
+
+    Returns
+    -------
+    The mapping of the given composers, with the columns of MAPPING_COLUMNS
+    """
+    mapping = load_mapping(mapping_path)
+    new_composers = composers[~composers.tmdb_person_id.isin(mapping.tmdb_person_id)]
+    new_composers = new_composers.drop_duplicates(subset='tmdb_person_id')
+    print(f'{len(new_composers)} composers to resolve, {len(mapping)} already in {mapping_path}')
+
+    if not new_composers.empty:
+        results = await spotify.search_artist_candidates(new_composers.tmdb_name.tolist(), nb_candidates)
+        candidates = pd.DataFrame([(artist.id, artist.name, artist.popularity)
+                                   for artists in results for artist in artists],
+                                  columns=['spotify_artist_id', 'spotify_name', 'popularity'])
+
+        new_mapping = match_composers(new_composers, candidates, threshold)
+        print(f'{new_mapping.spotify_artist_id.notna().sum()} of them matched a Spotify artist')
+
+        os.makedirs(os.path.dirname(mapping_path) or '.', exist_ok=True)
+        new_mapping.to_csv(mapping_path, mode='a', header=not os.path.isfile(mapping_path), index=False)
+        mapping = pd.concat([mapping, new_mapping], ignore_index=True) if len(mapping) else new_mapping
+
+    return mapping[mapping.tmdb_person_id.isin(composers.tmdb_person_id)].reset_index(drop=True)
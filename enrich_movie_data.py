@@ -3,62 +3,185 @@ This script has been used to create our personal, specific and enrich dataframe
 the CMU dataset. Our analysis performed in the JupyterNotebook is using this processed
 data.
 """
+import argparse
 import asyncio
+import os
 import time
 
 import pandas
 
 from helpers import load_movies, clean_movies, clean_movies_revenue
-from tmdb.tmdbDataLoader import TMDBDataLoader
+from incremental import (compute_row_hashes, hashes_from_snapshot, load_processed_hashes, merge_into_snapshot,
+                         save_processed_hashes, select_delta)
+from network.session_pool import SessionPool
+from profiling import enable_profiling, profile_stage
+from tmdb.tmdbDataLoader import TMDB_BASE_URL, TMDBDataLoader
 
+ENRICHED_MOVIES_PATH = 'dataset/clean_enrich_movies.pickle'
 
-async def enhanced_with_composer(movies: pandas.DataFrame):
-    """Enhanced the dataset with the composers, and directly save it as a pickle
+# Hashes of the cleaned CMU movies already sent to TMDB, used by the incremental mode
+PROCESSED_HASHES_PATH = 'dataset/clean_enrich_movies_hashes.pickle'
+
+# A movie is identified by its name and release year, the other columns are compared to detect a change
+IDENTITY_COLUMNS = ['name', 'release_date']
+CONTENT_COLUMNS = ['box_office_revenue', 'countries', 'genres']
+
+# Records of the movies already streamed through the composers requests, used by the streaming mode
+COMPOSERS_STREAM_PATH = 'dataset/checkpoints/clean_enrich_movies_composers.jsonl'
+
+
+@profile_stage('composers')
+async def enhanced_with_composer(movies: pandas.DataFrame, stream_path: str = None, session=None) \
+        -> pandas.DataFrame:
+    """Enhanced the dataset with the composers
 
     Parameters
     ----------
     movies: the dataframe to enhance with the composers
+    stream_path: if given, stream each movie through the credits and person requests, and write its composers to
+    this JSON lines file as soon as they are retrieved, instead of waiting for each step to finish for all the movies
+    session: the shared TMDB session of a SessionPool, a new session is created if None
 
+    Returns
+    -------
+    The enhanced dataset
     """
-    async with TMDBDataLoader() as tmdb:
+    async with TMDBDataLoader(session=session) as tmdb:
         start_time = time.time()
 
-        result = await tmdb.append_movie_composers(movies)
+        if stream_path:
+            result = await tmdb.stream_movie_composers(movies, stream_path)
+        else:
+            result = await tmdb.append_movie_composers(movies)
 
         end_time = time.time()
 
         print(f'Elapsed time: {end_time - start_time}')
 
-        # Finally create a pickle file of this new enrich dataframe
-        # pickle, as it takes less space on disk, and allows to directly
-        # parse the composer column as a list of Composer without having to cast anything
-        result.to_csv('dataset/clean_enrich_movies.csv')
-        result.to_pickle('dataset/clean_enrich_movies.pickle')
+        return result
+
 
+def save_enhanced_movies(movies: pandas.DataFrame):
+    """Save the enriched dataset
 
-async def enhanced_with_revenue(movies: pandas.DataFrame, chunk_size=15000) -> pandas.DataFrame:
+    Parameters
+    ----------
+    movies: the enriched dataframe
+    """
+    # Create a pickle file of this new enrich dataframe
+    # pickle, as it takes less space on disk, and allows to directly
+    # parse the composer column as a list of Composer without having to cast anything
+    movies.to_csv('dataset/clean_enrich_movies.csv')
+    movies.to_pickle(ENRICHED_MOVIES_PATH)
+
+
+@profile_stage('revenue')
+async def enhanced_with_revenue(movies: pandas.DataFrame, chunk_size=15000, session=None, time_budget: float = None,
+                                fallback_threshold: float = None) -> pandas.DataFrame:
     """Enhanced the dataset with the revenue
 
     Parameters
     ----------
     movies: The dataset of the movie to enhanced
     chunk_size: The size of the chunk to split the requests to periodically save the work in case of an error
+    session: The shared TMDB session of a SessionPool, a new session is created if None
+    time_budget: If given, the movies are fetched by decreasing known box office revenue, and no new movie is fetched
+    after this number of seconds. The movies not fetched have a nan tmdb_id
+    fallback_threshold: If given, the movies not found or matched below this title similarity (0-100) are searched
+    again without the year, with the year +/- 1 and on the second page, within a budget of 10% extra searches
 
     Returns
     -------
     The enhanced dataset
     """
-    async with TMDBDataLoader() as tmdb:
+    async with TMDBDataLoader(session=session, fallback_threshold=fallback_threshold) as tmdb:
+        if time_budget is not None:
+            return await tmdb.append_movie_revenue(movies, priority=movies.box_office_revenue,
+                                                   time_budget=time_budget)
+
         result = await tmdb.append_movie_revenue(movies, chunk_size)
         return result
 
 
-def create_enhanced_movie_dataset():
+def enrich_movies(movies: pandas.DataFrame, streaming: bool = False, time_budget: float = None,
+                  fallback_threshold: float = None) -> tuple[pandas.DataFrame, pandas.Index]:
+    """Enrich cleaned CMU movies with their revenue and composers from TMDB
+
+    Parameters
+    ----------
+    movies: The cleaned movies, without the revenue cleaned
+    streaming: Whether to stream the movies through the composers requests, see enhanced_with_composer
+    time_budget: The number of seconds after which no new movie is searched, the movies with the highest known box
+    office revenue being searched first, no limit if None
+    fallback_threshold: The title similarity (0-100) under which a movie is searched again with relaxed queries, no
+    fallback search if None
+
+    Returns
+    -------
+    The movies with a revenue, along with their composers, and the index of the movies not searched
+    """
+    return asyncio.run(_enrich_movies(movies, streaming, time_budget, fallback_threshold))
+
+
+async def _enrich_movies(movies: pandas.DataFrame, streaming: bool, time_budget: float, fallback_threshold: float) \
+        -> tuple[pandas.DataFrame, pandas.Index]:
+    """Enrich the movies in a single event loop, the revenue and composers requests sharing the same warmed TMDB
+    connections
+
+    Parameters
+    ----------
+    movies: The cleaned movies, without the revenue cleaned
+    streaming: Whether to stream the movies through the composers requests
+    time_budget: The number of seconds after which no new movie is searched, no limit if None
+    fallback_threshold: The title similarity under which a movie is searched again, no fallback search if None
+
+    Returns
+    -------
+    The movies with a revenue, along with their composers, and the index of the movies not searched
+    """
+    async with SessionPool() as session_pool:
+        await session_pool.warm_up([TMDB_BASE_URL])
+
+        # Merge revenue from cmu and tmdb and drop nan
+        res = await enhanced_with_revenue(movies, 15000, session_pool.session(TMDB_BASE_URL), time_budget,
+                                         fallback_threshold)
+
+        # The movies not searched before the end of the time budget are left for the next run
+        not_searched = res.index[res.tmdb_id.isna()] if time_budget is not None else movies.index[:0]
+        if len(not_searched) > 0:
+            print(f'{len(not_searched)} movies not searched before the end of the time budget, run again with '
+                  f'--incremental to search them')
+        res = res.drop(index=not_searched)
+
+        cleaned_movies = clean_movies_revenue(res)
+
+        # Retrieve composers of all movies
+        result = await enhanced_with_composer(cleaned_movies, COMPOSERS_STREAM_PATH if streaming else None,
+                                              session_pool.session(TMDB_BASE_URL))
+
+        print(session_pool.report())
+        return result, not_searched
+
+
+def create_enhanced_movie_dataset(incremental: bool = False, streaming: bool = False, time_budget: float = None,
+                                  fallback_threshold: float = None):
     """
     This function enhance the movie dataset. It does:
     - Loads a movie dataset
     - enhances it with revenue information
     - enriches it with composer details for each movie.
+
+    Parameters
+    ----------
+    incremental: Whether to only enrich the movies added or changed since the previous run, and merge them into the
+    existing clean_enrich_movies.pickle. A full enrichment is performed if there is no previous run
+    streaming: Whether to stream the movies through the composers requests, and write their composers as soon as
+    they are retrieved
+    time_budget: The number of seconds after which no new movie is searched, the movies with the highest known box
+    office revenue being searched first. The movies not searched are not recorded as processed, so that a later
+    incremental run searches them
+    fallback_threshold: The title similarity (0-100) under which a movie is searched again with relaxed queries, no
+    fallback search if None
     """
     # Load movies data set
     raw_movies = load_movies('dataset/MovieSummaries/movie.metadata.tsv')
@@ -66,14 +189,57 @@ def create_enhanced_movie_dataset():
     # Clean data to filter only observation with all needed features (without looking at box office revenue)
     cleaned_movies_without_revenue_cleaned = clean_movies(raw_movies)
 
-    # Merge revenue from cmu and tmdb and drop nan
-    res = asyncio.run(enhanced_with_revenue(cleaned_movies_without_revenue_cleaned, 15000))
+    hashes = compute_row_hashes(cleaned_movies_without_revenue_cleaned, IDENTITY_COLUMNS, CONTENT_COLUMNS)
+
+    if not incremental or not os.path.isfile(ENRICHED_MOVIES_PATH):
+        result, not_searched = enrich_movies(cleaned_movies_without_revenue_cleaned, streaming, time_budget,
+                                             fallback_threshold)
+        save_enhanced_movies(result)
+        save_processed_hashes(hashes.drop(index=not_searched), PROCESSED_HASHES_PATH)
+        return
+
+    snapshot = pandas.read_pickle(ENRICHED_MOVIES_PATH)
+    if os.path.isfile(PROCESSED_HASHES_PATH):
+        processed = load_processed_hashes(PROCESSED_HASHES_PATH)
+    else:
+        processed = hashes_from_snapshot(snapshot, IDENTITY_COLUMNS)
+
+    to_enrich = select_delta(hashes, processed)
+    delta = cleaned_movies_without_revenue_cleaned[to_enrich.to_numpy()]
+    print(f'{len(delta)} movies added or changed since the previous run, out of {len(hashes)}')
+
+    delta_result, not_searched = enrich_movies(delta, streaming, time_budget, fallback_threshold) if len(delta) > 0 \
+        else (snapshot.iloc[:0], delta.index)
 
-    cleaned_movies = clean_movies_revenue(res)
+    # The movies not searched before the end of the time budget keep their previous enrichment, if they had one
+    keep_previous = ~to_enrich | hashes.index.isin(not_searched)
+    result = merge_into_snapshot(snapshot, delta_result, IDENTITY_COLUMNS, hashes.identity_hash[keep_previous])
+    # A tmdb id should be unique across the whole dataset, keep the movie already enriched
+    result = result[result.tmdb_id.isna() | ~result.tmdb_id.duplicated(keep='first')]
+    result = result.sort_values(by='box_office_revenue', axis='rows', ascending=False, ignore_index=True)
 
-    # Retrieve composers of all movies
-    asyncio.run(enhanced_with_composer(cleaned_movies))
+    save_enhanced_movies(result)
+    # The hashes of the previous run are kept for the movies not searched, so that they are searched by the next run
+    save_processed_hashes(pandas.concat([processed, hashes.drop(index=not_searched)]), PROCESSED_HASHES_PATH)
 
 
 if __name__ == '__main__':
-    create_enhanced_movie_dataset()
+    parser = argparse.ArgumentParser(description='Enrich the CMU movies with TMDB data')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only enrich the movies added or changed since the previous run')
+    parser.add_argument('--streaming', action='store_true',
+                        help='stream each movie through the composers requests and write them incrementally')
+    parser.add_argument('--time-budget', type=float,
+                        help='number of seconds after which no new movie is searched, the movies with the highest '
+                             'known box office revenue being searched first')
+    parser.add_argument('--fallback-threshold', type=float,
+                        help='title similarity (0-100) under which a movie is searched again without the year, with '
+                             'the year +/- 1 and on the second page, within a budget of 10%% extra searches')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the CPU and memory of each stage, the reports are written to dataset/profiles')
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling()
+
+    create_enhanced_movie_dataset(args.incremental, args.streaming, args.time_budget, args.fallback_threshold)
@@ -1,46 +1,132 @@
+import argparse
 import asyncio
+import os
 import time
+from dataclasses import fields
 
 import pandas as pd
 
+from composer_matching import COMPOSER_MAPPING_PATH, resolve_composers
+from incremental import compute_row_hashes, load_processed_hashes, save_processed_hashes, select_delta
+from profiling import enable_profiling, profile_stage
+from spotify.Composer_Spotify import ComposerSpotify
 from spotify.SpotifyDataLoader import SpotifyDataLoader
 
+COMPOSERS_DATASET_PATH = 'dataset/spotify_composers_dataset.pickle'
 
-async def get_music_dataset(composers_names: list) -> None:
+# Hashes of the composers already searched on Spotify, used by the incremental mode
+PROCESSED_HASHES_PATH = 'dataset/spotify_composers_dataset_hashes.pickle'
+
+
+@profile_stage('spotify_composers')
+async def get_music_dataset(composers: pd.DataFrame, session=None,
+                            mapping_path: str = COMPOSER_MAPPING_PATH) -> pd.DataFrame:
     """
-    This function is used to create the spotify_dataset.pickle file
+    This function is used to retrieve the data of the spotify_dataset.pickle file
 
     Parameters
     ----------
-    composers_names: list ist of composers names
+    composers: The TMDB composers, with the columns 'tmdb_person_id' and 'tmdb_name'
+    session: the shared Spotify session of a SessionPool, a new session is created if None
+    mapping_path: The csv file of the composers already matched to a Spotify artist, only the other ones are searched
+
+    Returns
+    -------
+    The dataframe of the composers found on Spotify, with the id and name of the matching TMDB composer
     """
-    async with SpotifyDataLoader() as spotify:
+    async with SpotifyDataLoader(session=session) as spotify:
         start_time = time.time()
 
-        result = await spotify.create_composers_table(composers_names)
+        mapping = (await resolve_composers(composers, spotify, mapping_path)).dropna(subset=['spotify_artist_id'])
+        artists = await spotify.get_composers_by_id(mapping.spotify_artist_id.unique().tolist())
+        artists = pd.DataFrame(artists, columns=[f.name for f in fields(ComposerSpotify)])
+
+        # A Spotify artist may match several TMDB composers, e.g. a composer credited under two TMDB ids
+        result = mapping[['tmdb_person_id', 'tmdb_name', 'spotify_artist_id']].merge(
+            artists, left_on='spotify_artist_id', right_on='id').drop(columns='spotify_artist_id')
 
         end_time = time.time()
 
         print(f'Elapsed time: {end_time - start_time}')
 
-        # Finally create a pickle file of this new dataframe, as it takes less space on disk
-        result.to_pickle('dataset/spotify_composers_dataset.pickle')
-        result.to_csv('dataset/spotify_composers_dataset.csv')
+        return result
+
+
+def get_composers(movies: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the distinct composers of the movies
+
+    Parameters
+    ----------
+    movies: The enriched movies dataframe, with a 'composers' column
+
+    Returns
+    -------
+    The dataframe of the composers, with the columns 'tmdb_person_id' and 'tmdb_name'
+    """
+    list_composers = movies['composers'].dropna().tolist()
+    # Flatten the list
+    list_composers = [item for sublist in list_composers for item in sublist]
+    composers = pd.DataFrame([(c.id, c.name) for c in list_composers], columns=['tmdb_person_id', 'tmdb_name'])
+    return composers.drop_duplicates(subset='tmdb_person_id').reset_index(drop=True)
 
 
-def create_music_composers_dataset():
+def create_music_composers_dataset(incremental: bool = False):
     """
     Create the composer dataset
+
+    Parameters
+    ----------
+    incremental: Whether to only search the composers that were not searched by the previous run, and append them to
+    the existing spotify_composers_dataset.pickle
     """
 
     m = pd.read_pickle('dataset/clean_enrich_movies.pickle')
-    list_composers = m['composers'].dropna().tolist()
-    # Flatten the list
-    list_composers = [item for sublist in list_composers for item in sublist]
-    composers_names = [c.name for c in list_composers]
-    composers_names = list(set(composers_names))
-    asyncio.run(get_music_dataset(composers_names))
+    composers = get_composers(m)
+
+    hashes = compute_row_hashes(composers, ['tmdb_person_id', 'tmdb_name'])
+
+    previous = pd.read_pickle(COMPOSERS_DATASET_PATH) if incremental and os.path.isfile(COMPOSERS_DATASET_PATH) \
+        else None
+    if previous is not None and 'tmdb_person_id' not in previous.columns:
+        # Dataset created before the composers were matched by TMDB id, the mapping file avoids searching them again
+        print('The previous dataset has no TMDB id, all the composers are resolved again')
+        previous = None
+
+    if previous is not None:
+        processed = load_processed_hashes(PROCESSED_HASHES_PATH)
+        if processed.empty:
+            # No hashes stored by the previous run, consider the composers found on Spotify as searched
+            processed = compute_row_hashes(previous, ['tmdb_person_id', 'tmdb_name'])
+
+        to_search = select_delta(hashes, processed).to_numpy()
+        print(f'{to_search.sum()} composers added since the previous run, out of {len(composers)}')
+
+        new_composers = asyncio.run(get_music_dataset(composers[to_search])) if to_search.any() \
+            else previous.iloc[:0]
+        # The composers are kept even if they no longer appear in the movies, as their Spotify data did not change
+        result = pd.concat([previous, new_composers], ignore_index=True).drop_duplicates(subset='tmdb_person_id',
+                                                                                         keep='last')
+    else:
+        result = asyncio.run(get_music_dataset(composers))
+
+    # Finally create a pickle file of this new dataframe, as it takes less space on disk
+    result.to_pickle(COMPOSERS_DATASET_PATH)
+    result.to_csv('dataset/spotify_composers_dataset.csv')
+
+    # Searched composers are recorded, even the ones not found, so that they are not searched again
+    save_processed_hashes(pd.concat([load_processed_hashes(PROCESSED_HASHES_PATH), hashes]), PROCESSED_HASHES_PATH)
 
 
 if __name__ == '__main__':
-    create_music_composers_dataset()
+    parser = argparse.ArgumentParser(description='Create the dataset of the composers found on Spotify')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only search the composers added since the previous run')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the CPU and memory of each stage, the reports are written to dataset/profiles')
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling()
+
+    create_music_composers_dataset(args.incremental)
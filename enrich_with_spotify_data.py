@@ -1,14 +1,22 @@
+import argparse
 import asyncio
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 from rapidfuzz import fuzz
 
-# from question_script.question1 import create_db_to_link_composers_to_movies
+from checkpoint_store import CheckpointStore
+from composer_matching import link_legacy_composers
+from incremental import compute_row_hashes, merge_into_snapshot, select_delta
+from network.priority import priority_order
+from network.session_pool import SessionPool
+from profiling import enable_profiling, profile_stage
+from question_script.composer_graph import ComposerMovieGraph
 from spotify import get_bearer_token
-from spotify.SpotifyDataLoader import SpotifyDataLoader
+from spotify.SpotifyDataLoader import SPOTIFY_BASE_URL, SpotifyDataLoader
 
 # Define keywords to search for soundtrack of movies
 POSITIVE_KEYWORD = ["original", "motion", "picture", "soundtrack", "music", "band", "score", "theme", "ost", "ost.",
@@ -24,6 +32,24 @@ NEGATIVE_INFLUENCE = 0.9
 
 BATCH_SIZE = 100
 
+# Table of the audio features of the soundtrack tracks, keyed by track_id
+AUDIO_FEATURES_PATH = 'dataset/track_audio_features.parquet'
+
+# Compact types of the audio features table, the integer features are nullable for the tracks without features
+AUDIO_FEATURES_DTYPES = {'track_id': 'string', 'danceability': 'float32', 'energy': 'float32', 'key': 'Int8',
+                         'loudness': 'float32', 'mode': 'Int8', 'speechiness': 'float32', 'acousticness': 'float32',
+                         'instrumentalness': 'float32', 'liveness': 'float32', 'valence': 'float32',
+                         'tempo': 'float32', 'duration_ms': 'Int32', 'time_signature': 'Int8'}
+
+# Columns identifying a movie searched on Spotify, a row is searched again in incremental mode if one of them changes
+ALBUM_IDENTITY_COLUMNS = ["movie_name", "release_date", "movie_revenue", "composer_name"]
+
+# Checkpoints of the previous versions of the stages, the whole dataframe rewritten during the run, used to seed the
+# checkpoint logs that do not exist yet
+LEGACY_ALBUM_CHECKPOINT_PATH = 'dataset/checkpoints/movie_album_and_revenue.pickle'
+LEGACY_TRACK_CHECKPOINT_PATH = 'dataset/checkpoints/movie_album_and_revenue_with_track_ids.pickle'
+LEGACY_MUSIC_CHECKPOINT_PATH = 'dataset/checkpoints/album_id_and_musics.pickle'
+
 
 def _regenerate_token_if_needed(timer, spotify):
     """
@@ -129,8 +155,72 @@ def score_best_matching_albums(albums_df: pd.DataFrame, date: int, name: str, co
     return score
 
 
+def best_matching_album_ids(results: list[list], dates: list, names: list[str], composers: list[str]) -> list:
+    """
+    Find the best matching album of each movie of a batch, run in an executor to overlap with the next search
+
+    Parameters
+    ----------
+    results: list[list]
+        the albums found for each movie
+    dates: list
+        the date of each movie
+    names: list[str]
+        the name of each movie
+    composers: list[str]
+        the name of the composer of each movie
+
+    Returns
+    -------
+    album_ids: list
+        the id of the best matching album of each movie, None if no album matches
+    """
+    album_ids = []
+    for j, albums in enumerate(results):
+        albums_df = pd.DataFrame(albums)
+        scores = score_best_matching_albums(albums_df, dates[j], names[j], composers[j])
+        if len(scores) > 0:
+            best_score = max(scores, key=lambda x: x[1])
+            album_ids.append(albums_df.loc[best_score[0]]["id"])
+        else:
+            album_ids.append(None)
+    return album_ids
+
+
+def _seed_from_legacy_checkpoint(store: CheckpointStore, legacy_path: str, key_columns: list[str],
+                                 value_column: str):
+    """
+    Seed a checkpoint store without log with the rows resolved in a legacy checkpoint, so that they are not requested
+    again. A missing value is not seeded, as the legacy checkpoints did not tell an unmatched row from a row not
+    searched yet
+
+    Parameters
+    ----------
+    store: CheckpointStore
+        the store to seed
+
+    legacy_path: str
+        the pickle of the legacy checkpoint, nothing is seeded if it does not exist
+
+    key_columns: list[str]
+        the columns of the key of the store, a single column is used as is and several ones as a tuple
+
+    value_column: str
+        the column of the value of the store
+    """
+    if os.path.isfile(store.path) or not os.path.isfile(legacy_path):
+        return
+
+    legacy = pd.read_pickle(legacy_path).dropna(subset=[value_column])
+    keys = legacy[key_columns[0]] if len(key_columns) == 1 else \
+        legacy[key_columns].itertuples(index=False, name=None)
+    store.seed(dict(zip(keys, legacy[value_column])), legacy_path)
+
+
+@profile_stage('albums')
 async def get_album_ids_into_df(movie_names_and_date: pd.DataFrame, checkpoint: bool = False,
-                                save_interval: int = 5) -> pd.DataFrame:
+                                save_interval: int = 5, save: bool = True, session=None, priority: pd.Series = None,
+                                time_budget: float = None) -> pd.DataFrame:
     """
     This function is used to create the movie_album_and_revenue.pickle file
 
@@ -140,67 +230,114 @@ async def get_album_ids_into_df(movie_names_and_date: pd.DataFrame, checkpoint:
         the dataframe of movies
 
     checkpoint: bool
-        if True, load the checkpoint and save the dataframe every save_interval
+        if True, skip the movies already searched by a previous run, and append the album ids found to the checkpoint
+        log every save_interval batches
 
     save_interval: int
-        the interval to save the dataframe
+        the number of batches between two appends to the checkpoint log
+
+    save: bool
+        if True, save the result as movie_album_and_revenue.pickle
+
+    session: aiohttp.ClientSession
+        the shared Spotify session of a SessionPool, a new session is created if None
+
+    priority: pd.Series
+        the priority of each movie, aligned with movie_names_and_date (e.g. the movie revenue), the movies with the
+        highest priority are searched first. The movies keep their order if None
+
+    time_budget: float
+        the number of seconds after which no new batch is searched, the album_id of the movies not searched stays
+        None. No limit if None
 
     Returns
     -------
     movie_albums_df: pd.DataFrame
     """
-    checkpoint_path = 'dataset/checkpoints/movie_album_and_revenue.pickle'
+    checkpoint_path = 'dataset/checkpoints/movie_album_ids.log'
 
     movie_albums_df = movie_names_and_date
     movie_albums_df['album_id'] = None
 
-    if checkpoint:
-        # Load the checkpoint if it exists
-        if os.path.isfile(checkpoint_path):
-            movie_albums_df = pd.read_pickle(checkpoint_path)
+    # The album id of each movie searched, None if no album matches, so that it is not searched again
+    store = CheckpointStore(checkpoint_path) if checkpoint else None
+    if store is not None:
+        _seed_from_legacy_checkpoint(store, LEGACY_ALBUM_CHECKPOINT_PATH, ALBUM_IDENTITY_COLUMNS, 'album_id')
+    keys = pd.Series(list(movie_albums_df[ALBUM_IDENTITY_COLUMNS].itertuples(index=False, name=None)),
+                     index=movie_albums_df.index)
+    mask = pd.Series(True, index=movie_albums_df.index)
+    if store is not None:
+        mask = ~keys.map(lambda key: key in store).astype(bool)
+        movie_albums_df.loc[~mask, 'album_id'] = keys[~mask].map(lambda key: store.state[key]).to_numpy()
 
-    mask = movie_albums_df["album_id"].isna()
     working_index = movie_albums_df[mask].index
+    if priority is not None:
+        # Search the most valuable movies first, so that a run cut short covers them
+        working_index = priority_order(priority.reindex(working_index))
 
     start_time = time.time()
     timer = start_time
 
-    # Get the album ids for each movie
-    async with SpotifyDataLoader() as spotify:
-        for i in range(0, len(working_index), BATCH_SIZE):
-            # Get all the albums for the movies in the batch
-            batch = movie_albums_df.loc[working_index[i:i + BATCH_SIZE]]
-            date = list(batch.release_date)
-            names = list(batch.movie_name)
-            composer = list(batch.composer_name)
+    loop = asyncio.get_running_loop()
 
-            # if timer more than 1 hour, regenerate token
-            timer = _regenerate_token_if_needed(timer, spotify)
-
-            results = await spotify.search_albums_by_name(names)
-            for j, albums in enumerate(results):
-                albums_df = pd.DataFrame(albums)
-                scores = score_best_matching_albums(albums_df, date[j], names[j], composer[j])
-                if len(scores) > 0:
-                    best_score = max(scores, key=lambda x: x[1])
-                    movie_albums_df.loc[working_index[i + j], "album_id"] = albums_df.loc[best_score[0]]["id"]
+    # Get the album ids for each movie
+    pending = {}
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        async with SpotifyDataLoader(session=session) as spotify:
+            batches = [movie_albums_df.loc[working_index[i:i + BATCH_SIZE]] for i in range(0, len(working_index),
+                                                                                           BATCH_SIZE)]
+            # Search the albums of the next batch while the albums of the current batch are scored in the executor
+            next_search = asyncio.ensure_future(spotify.search_albums_by_name(list(batches[0].movie_name))) \
+                if batches else None
+
+            for batch_nb, batch in enumerate(batches):
+                i = batch_nb * BATCH_SIZE
+                results = await next_search
+
+                # if timer more than 1 hour, regenerate token
+                timer = _regenerate_token_if_needed(timer, spotify)
+
+                out_of_time = time_budget is not None and time.time() - start_time > time_budget
+                if out_of_time:
+                    print(f'Time budget spent, {len(working_index) - i - len(batch)} movies not searched')
+                elif batch_nb + 1 < len(batches):
+                    next_search = asyncio.ensure_future(
+                        spotify.search_albums_by_name(list(batches[batch_nb + 1].movie_name)))
+
+                album_ids = await loop.run_in_executor(executor, best_matching_album_ids, results,
+                                                       list(batch.release_date), list(batch.movie_name),
+                                                       list(batch.composer_name))
+                for j, album_id in enumerate(album_ids):
+                    if album_id is not None:
+                        movie_albums_df.loc[working_index[i + j], "album_id"] = album_id
+                    pending[keys[working_index[i + j]]] = album_id
+
+                if store is not None and (batch_nb + 1) % save_interval == 0:
+                    store.append(pending)
+                    pending = {}
+
+                if out_of_time:
+                    break
 
-                    if checkpoint and j % save_interval == 0:
-                        movie_albums_df.to_pickle(checkpoint_path)
+    if store is not None:
+        store.append(pending)
+        store.compact()
 
     end_time = time.time()
 
     print(f'Elapsed time for mapping album ids to film: {end_time - start_time}')
 
     # Save the dataframe
-    movie_albums_df.to_pickle('dataset/movie_album_and_revenue.pickle')
-    movie_albums_df.to_csv('dataset/movie_album_and_revenue.csv')
+    if save:
+        movie_albums_df.to_pickle('dataset/movie_album_and_revenue.pickle')
+        movie_albums_df.to_csv('dataset/movie_album_and_revenue.csv')
 
     return movie_albums_df
 
 
+@profile_stage('tracks')
 async def get_track_ids_into_df(movie_albums_df: pd.DataFrame, checkpoint: bool = False,
-                                save_interval: int = 5) -> pd.DataFrame:
+                                save_interval: int = 5, save: bool = True, session=None) -> pd.DataFrame:
     """
     This function is used to create the movie_album_and_revenue_with_track_ids.pickle file
 
@@ -210,23 +347,31 @@ async def get_track_ids_into_df(movie_albums_df: pd.DataFrame, checkpoint: bool
         the dataframe of movies
 
     checkpoint: bool
-        if True, load the checkpoint and save the dataframe every save_interval
+        if True, skip the albums already retrieved by a previous run, and append the track ids retrieved to the
+        checkpoint log every save_interval batches
 
     save_interval: int
-        the interval to save the dataframe
+        the number of batches between two appends to the checkpoint log
+
+    save: bool
+        if True, save the result as movie_album_and_revenue_with_track_ids.pickle
+
+    session: aiohttp.ClientSession
+        the shared Spotify session of a SessionPool, a new session is created if None
 
     Returns
     -------
     movie_albums_df: pd.DataFrame
     """
 
-    checkpoint_path = 'dataset/checkpoints/movie_album_and_revenue_with_track_ids.pickle'
+    checkpoint_path = 'dataset/checkpoints/album_track_ids.log'
     movie_albums_df['track_ids'] = None
 
-    if checkpoint:
-        # Load the checkpoint if it exists
-        if os.path.isfile(checkpoint_path):
-            movie_albums_df = pd.read_pickle(checkpoint_path)
+    # The track ids of each album retrieved
+    store = CheckpointStore(checkpoint_path) if checkpoint else None
+    if store is not None:
+        _seed_from_legacy_checkpoint(store, LEGACY_TRACK_CHECKPOINT_PATH, ['album_id'], 'track_ids')
+        movie_albums_df['track_ids'] = movie_albums_df['album_id'].map(store.state).astype(object)
 
     mask = movie_albums_df["track_ids"].isna()
     working_index = movie_albums_df[mask].index
@@ -234,29 +379,40 @@ async def get_track_ids_into_df(movie_albums_df: pd.DataFrame, checkpoint: bool
     start_time = time.time()
     timer = start_time
 
-    async with SpotifyDataLoader() as spotify:
+    pending = {}
+    async with SpotifyDataLoader(session=session) as spotify:
         for i in range(0, len(working_index), BATCH_SIZE):
             # Get all the tracks ids of the albums in the batch
             batch = list(movie_albums_df.loc[working_index[i:i + BATCH_SIZE]]["album_id"])
             results = await spotify.get_albums_tracks_async(batch)
-            movie_albums_df.loc[working_index[i:i + BATCH_SIZE], "track_ids"] = np.array(results, dtype=object)
+            # A series, so that lists of the same length are not turned into a 2d array
+            movie_albums_df.loc[working_index[i:i + BATCH_SIZE], "track_ids"] = pd.Series(
+                results, index=working_index[i:i + BATCH_SIZE], dtype=object)
             timer = _regenerate_token_if_needed(timer, spotify)
-            if checkpoint and i % save_interval == 0:
-                movie_albums_df.to_pickle(checkpoint_path)
+            pending.update(zip(batch, results))
+            if store is not None and (i // BATCH_SIZE + 1) % save_interval == 0:
+                store.append(pending)
+                pending = {}
+
+    if store is not None:
+        store.append(pending)
+        store.compact()
 
     end_time = time.time()
 
     print(f'Elapsed time for retrieving all track_ids from album_ids: {end_time - start_time}')
 
     # Save the dataframe
-    movie_albums_df.to_pickle('dataset/movie_album_and_revenue_with_track_ids.pickle')
-    movie_albums_df.to_csv('dataset/movie_album_and_revenue_with_track_ids.csv')
+    if save:
+        movie_albums_df.to_pickle('dataset/movie_album_and_revenue_with_track_ids.pickle')
+        movie_albums_df.to_csv('dataset/movie_album_and_revenue_with_track_ids.csv')
 
     return movie_albums_df
 
 
+@profile_stage('musics')
 async def get_music_from_track_ids(albums_with_track_ids: pd.DataFrame, checkpoint: bool = False,
-                                   save_interval: int = 10) -> pd.DataFrame:
+                                   save_interval: int = 10, save: bool = True, session=None) -> pd.DataFrame:
     """
     This function is used to create the movie_album_and_revenue_with_track_ids.pickle file
 
@@ -266,10 +422,17 @@ async def get_music_from_track_ids(albums_with_track_ids: pd.DataFrame, checkpoi
         the dataframe of albums
 
     checkpoint: bool
-        if True, load the checkpoint and save the dataframe every save_interval
+        if True, skip the tracks already retrieved by a previous run, and append the musics retrieved to the
+        checkpoint log every save_interval batches
 
     save_interval: int
-        the interval to save the dataframe
+        the number of batches between two appends to the checkpoint log
+
+    save: bool
+        if True, save the result as album_id_and_musics.pickle
+
+    session: aiohttp.ClientSession
+        the shared Spotify session of a SessionPool, a new session is created if None
 
     Returns
     -------
@@ -277,23 +440,23 @@ async def get_music_from_track_ids(albums_with_track_ids: pd.DataFrame, checkpoi
     """
     # Create new dataframe with the same columns as movie_names_and_date and an additional column for the album id
     albums_with_track_ids['track'] = albums_with_track_ids.get('track', pd.Series(dtype='object'))
-    checkpoint_path = 'dataset/checkpoints/album_id_and_musics.pickle'
+    checkpoint_path = 'dataset/checkpoints/track_musics.log'
 
-    if checkpoint:
-        # Load the checkpoint if it exists
-        if os.path.isfile(checkpoint_path):
-            albums_with_track_ids = pd.read_pickle(checkpoint_path)
-            mask = albums_with_track_ids["track_ids"].str.len() != 22
-            albums_with_track_ids = albums_with_track_ids[~mask]
+    # The music of each track retrieved
+    store = CheckpointStore(checkpoint_path) if checkpoint else None
+    if store is not None:
+        _seed_from_legacy_checkpoint(store, LEGACY_MUSIC_CHECKPOINT_PATH, ['track_ids'], 'track')
+    musics = dict(store.state) if store is not None else {}
 
-    mask = albums_with_track_ids["track"].isna()
+    mask = albums_with_track_ids["track"].isna() & ~albums_with_track_ids["track_ids"].isin(musics.keys())
     working_index = albums_with_track_ids[mask].index
 
     start_time = time.time()
     timer = start_time
 
     start_time = time.time()
-    async with SpotifyDataLoader() as spotify:
+    pending = {}
+    async with SpotifyDataLoader(session=session) as spotify:
         # Define the batch size
         batch_size = 250  # You can change this value as needed
 
@@ -316,109 +479,290 @@ async def get_music_from_track_ids(albums_with_track_ids: pd.DataFrame, checkpoi
                 for track in batch["tracks"]:
                     genre = []
                     music = spotify.get_music_from_track(track, genre)
-                    # Use .loc for setting the value
-                    albums_with_track_ids.loc[albums_with_track_ids["track_ids"] == music.id, "track"] = music
+                    pending[music.id] = music
+
+            musics.update(pending)
+            if store is not None and (batch_num + 1) % save_interval == 0:
+                store.append(pending)
+                pending = {}
 
-            if checkpoint:
-                albums_with_track_ids.to_pickle(checkpoint_path)
+    if store is not None:
+        store.append(pending)
+        store.compact()
+
+    # Set the music of each track at once, instead of searching its rows after each track
+    missing = albums_with_track_ids["track"].isna()
+    albums_with_track_ids.loc[missing, "track"] = albums_with_track_ids.loc[missing, "track_ids"].map(musics).to_numpy()
 
     end_time = time.time()
 
     print(f'Elapsed time for retrieving all music objects from track_ids: {end_time - start_time}')
 
-    albums_with_track_ids.to_pickle('dataset/album_id_and_musics.pickle')
-    albums_with_track_ids.to_csv('dataset/album_id_and_musics.csv')
+    if save:
+        albums_with_track_ids.to_pickle('dataset/album_id_and_musics.pickle')
+        albums_with_track_ids.to_csv('dataset/album_id_and_musics.csv')
 
     return albums_with_track_ids
 
 
-def create_musics_dataset():
-    # Load the data
-    spotify_composers_dataset = pd.read_pickle('dataset/spotify_composers_dataset.pickle')
-    clean_enrich_movies = pd.read_pickle('dataset/clean_enrich_movies.pickle')
+@profile_stage('audio_features')
+async def get_audio_features_of_tracks(track_ids: pd.Series, output_path: str = AUDIO_FEATURES_PATH,
+                                       save: bool = True, session=None) -> pd.DataFrame:
+    """
+    This function is used to create the track_audio_features.parquet file, with the audio features of the tracks
 
-    composers_to_movies = create_db_to_link_composers_to_movies(clean_enrich_movies)
+    Parameters
+    ----------
+    track_ids: pd.Series
+        the ids of the tracks, possibly duplicated
 
-    box_office_and_composer_popularity = pd.merge(left=spotify_composers_dataset,
-                                                  right=composers_to_movies,
-                                                  left_on='name',
-                                                  right_on='composer_name',
-                                                  how='inner')[
-        ['movie_name', 'movie_revenue', 'composer_name', 'release_date', 'popularity']]
+    output_path: str
+        the table of the audio features already retrieved, only the tracks missing from it are requested
 
-    movie_names_and_date = box_office_and_composer_popularity[
-        ["movie_name", "release_date", "movie_revenue", "composer_name"]]
+    save: bool
+        if True, save the result to output_path
 
-    if os.path.isfile("dataset/movie_album_and_revenue.pickle"):
-        movie_albums_df = pd.read_pickle("dataset/movie_album_and_revenue.pickle")
-    else:
-        get_bearer_token.replace_token("")
-        movie_albums_df = asyncio.run(get_album_ids_into_df(movie_names_and_date, checkpoint=True, save_interval=1))
+    session: aiohttp.ClientSession
+        the shared Spotify session of a SessionPool, a new session is created if None
 
-    # clean the dataframe
-    movie_albums_df = movie_albums_df.dropna(subset=['album_id'])
-    movie_albums_df = movie_albums_df.drop_duplicates(subset=['movie_name'])
+    Returns
+    -------
+    audio_features: pd.DataFrame
+        the audio features of all the tracks stored, one row per track_id. The tracks without audio features on
+        Spotify have missing features, so that they are not requested again
+    """
+    stored = pd.read_parquet(output_path) if os.path.isfile(output_path) \
+        else pd.DataFrame(columns=list(AUDIO_FEATURES_DTYPES)).astype(AUDIO_FEATURES_DTYPES)
 
-    if os.path.isfile("dataset/movie_album_and_revenue_with_track_ids.pickle"):
-        movie_albums_df = pd.read_pickle("dataset/movie_album_and_revenue_with_track_ids.pickle")
-    else:
-        get_bearer_token.replace_token("")
-        asyncio.run(get_track_ids_into_df(movie_albums_df, checkpoint=True, save_interval=1))
+    unique_ids = pd.Series(track_ids.dropna().unique())
+    to_fetch = unique_ids[~unique_ids.isin(stored.track_id)].tolist()
+    print(f'{len(to_fetch)} tracks to request, out of {len(unique_ids)}, {len(stored)} already stored')
+
+    start_time = time.time()
+
+    async with SpotifyDataLoader(session=session) as spotify:
+        audio_features = await spotify.get_audio_features(to_fetch)
+
+    print(f'Elapsed time for retrieving the audio features: {time.time() - start_time}')
+
+    fetched = pd.DataFrame(audio_features, columns=list(AUDIO_FEATURES_DTYPES))
+    # The tracks requested without audio features are kept as missing features
+    fetched = fetched.set_index('track_id').reindex(pd.Index(to_fetch, name='track_id')).reset_index()
+
+    result = pd.concat([stored, fetched.astype(AUDIO_FEATURES_DTYPES)], ignore_index=True)
+
+    if save:
+        result.to_parquet(output_path, index=False)
+
+    return result
+
+
+def explode_album_tracks(movie_albums_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Create a dataframe only containing the album id and the track ids, one row per track
+
+    Parameters
+    ----------
+    movie_albums_df: pd.DataFrame
+        the dataframe of movies with their album id and track ids
 
+    Returns
+    -------
+    albums_with_tracks: pd.DataFrame
+    """
     # clean the dataframe
     movie_albums_df = movie_albums_df.dropna(subset=['track_ids'])
     movie_albums_df = movie_albums_df.drop_duplicates(subset=['movie_name'])
 
-    # Create a dataframe only containing the album id and the track ids
     albums_with_tracks = movie_albums_df.explode('track_ids')
     albums_with_tracks = albums_with_tracks[["album_id", "track_ids"]]
     mask = albums_with_tracks["track_ids"].str.len() != 22
-    albums_with_tracks = albums_with_tracks[~mask]
+    return albums_with_tracks[~mask]
 
-    if os.path.isfile("dataset/album_id_and_musics.pickle"):
-        print("Enrichment already done!!")
-    else:
-        # Get the music object from track ids
+
+async def _enrich_delta(stage, df: pd.DataFrame, output_path: str, identity_columns: list[str],
+                        session=None, **stage_kwargs) -> pd.DataFrame:
+    """Run an enrichment stage only on the rows added or changed since its previous output, and merge the result into
+    that output
+
+    Parameters
+    ----------
+    stage: The async function of the stage, e.g. get_album_ids_into_df
+    df: The input dataframe of the stage
+    output_path: The pickle file of the previous output of the stage, updated with the merged result
+    identity_columns: The input columns identifying a row, kept in the output of the stage
+    session: The shared Spotify session of a SessionPool
+    stage_kwargs: Other arguments of the stage, e.g. the priority of the rows
+
+    Returns
+    -------
+    The merged output of the stage
+    """
+    snapshot = pd.read_pickle(output_path)
+
+    hashes = compute_row_hashes(df, identity_columns)
+    to_enrich = select_delta(hashes, compute_row_hashes(snapshot, identity_columns)).to_numpy()
+    print(f'{to_enrich.sum()} rows added or changed since the previous run of {stage.__name__}, out of {len(df)}')
+
+    if to_enrich.any():
         get_bearer_token.replace_token("")
-        asyncio.run(get_music_from_track_ids(albums_with_tracks, checkpoint=True, save_interval=1))
+        delta_result = await stage(df[to_enrich].copy(), checkpoint=False, save=False, session=session,
+                                   **stage_kwargs)
+    else:
+        delta_result = snapshot.iloc[:0]
+
+    result = merge_into_snapshot(snapshot, delta_result, identity_columns, hashes.identity_hash[~to_enrich])
+
+    result.to_pickle(output_path)
+    result.to_csv(output_path.replace('.pickle', '.csv'))
+
+    return result
+
+
+def movies_to_search(clean_enrich_movies: pd.DataFrame, spotify_composers_dataset: pd.DataFrame) -> pd.DataFrame:
+    """
+    Create the (movie, composer) pairs whose soundtrack album is searched, the ones whose composer is on Spotify
+
+    Parameters
+    ----------
+    clean_enrich_movies: pd.DataFrame
+        the movies with their composers
+
+    spotify_composers_dataset: pd.DataFrame
+        the Spotify artists of the composers
+
+    Returns
+    -------
+    movie_names_and_date: pd.DataFrame
+    """
+    composers_to_movies = create_db_to_link_composers_to_movies(clean_enrich_movies)
+    spotify_composers_dataset = link_legacy_composers(
+        spotify_composers_dataset, composers_to_movies.reset_index()[['comp_id', 'composer_name']].rename(
+            columns={'comp_id': 'tmdb_person_id', 'composer_name': 'tmdb_name'}))
+
+    # The Spotify artists are linked to the movies through the TMDB id of their composer (see composer_matching)
+    box_office_and_composer_popularity = pd.merge(left=spotify_composers_dataset,
+                                                  right=composers_to_movies.reset_index(),
+                                                  left_on='tmdb_person_id',
+                                                  right_on='comp_id',
+                                                  how='inner')[
+        ['movie_name', 'movie_revenue', 'composer_name', 'release_date', 'popularity']]
+
+    return box_office_and_composer_popularity[ALBUM_IDENTITY_COLUMNS]
+
+
+def create_musics_dataset(incremental: bool = False):
+    """
+    Create the datasets of the albums and musics of the movies, and the audio features of their tracks
+
+    Parameters
+    ----------
+    incremental: Whether to only send to Spotify the rows added or changed since the previous run of each stage, and
+    merge them into its existing output. Otherwise, a stage is skipped if its output exists
+    """
+    asyncio.run(_create_musics_dataset(incremental))
+
+
+async def _create_musics_dataset(incremental: bool):
+    """
+    Run all the stages of create_musics_dataset in a single event loop, sharing the same warmed Spotify connections
+
+    Parameters
+    ----------
+    incremental: Whether to only send to Spotify the rows added or changed since the previous run of each stage
+    """
+    # Load the data
+    spotify_composers_dataset = pd.read_pickle('dataset/spotify_composers_dataset.pickle')
+    clean_enrich_movies = pd.read_pickle('dataset/clean_enrich_movies.pickle')
+
+    movie_names_and_date = movies_to_search(clean_enrich_movies, spotify_composers_dataset)
+
+    async with SessionPool() as session_pool:
+        await session_pool.warm_up([SPOTIFY_BASE_URL])
+
+        if os.path.isfile("dataset/movie_album_and_revenue.pickle"):
+            if incremental:
+                movie_albums_df = await _enrich_delta(get_album_ids_into_df, movie_names_and_date,
+                                                      "dataset/movie_album_and_revenue.pickle", ALBUM_IDENTITY_COLUMNS,
+                                                      session_pool.session(SPOTIFY_BASE_URL),
+                                                      priority=movie_names_and_date.movie_revenue)
+            else:
+                movie_albums_df = pd.read_pickle("dataset/movie_album_and_revenue.pickle")
+        else:
+            get_bearer_token.replace_token("")
+            # The movies with the highest revenue are searched first, so that the checkpoint of an interrupted run
+            # covers them
+            movie_albums_df = await get_album_ids_into_df(movie_names_and_date, checkpoint=True, save_interval=1,
+                                                          session=session_pool.session(SPOTIFY_BASE_URL),
+                                                          priority=movie_names_and_date.movie_revenue)
+
+        # clean the dataframe
+        movie_albums_df = movie_albums_df.dropna(subset=['album_id'])
+        movie_albums_df = movie_albums_df.drop_duplicates(subset=['movie_name'])
+
+        if os.path.isfile("dataset/movie_album_and_revenue_with_track_ids.pickle"):
+            if incremental:
+                movie_albums_df = await _enrich_delta(get_track_ids_into_df, movie_albums_df,
+                                                      "dataset/movie_album_and_revenue_with_track_ids.pickle",
+                                                      ALBUM_IDENTITY_COLUMNS + ['album_id'],
+                                                      session_pool.session(SPOTIFY_BASE_URL))
+            else:
+                movie_albums_df = pd.read_pickle("dataset/movie_album_and_revenue_with_track_ids.pickle")
+        else:
+            get_bearer_token.replace_token("")
+            movie_albums_df = await get_track_ids_into_df(movie_albums_df, checkpoint=True, save_interval=1,
+                                                          session=session_pool.session(SPOTIFY_BASE_URL))
+
+        albums_with_tracks = explode_album_tracks(movie_albums_df)
+
+        if os.path.isfile("dataset/album_id_and_musics.pickle"):
+            if incremental:
+                await _enrich_delta(get_music_from_track_ids, albums_with_tracks, "dataset/album_id_and_musics.pickle",
+                                    ["album_id", "track_ids"], session_pool.session(SPOTIFY_BASE_URL))
+            else:
+                print("Enrichment already done!!")
+        else:
+            # Get the music object from track ids
+            get_bearer_token.replace_token("")
+            await get_music_from_track_ids(albums_with_tracks, checkpoint=True, save_interval=1,
+                                           session=session_pool.session(SPOTIFY_BASE_URL))
+
+        # Only the tracks missing from the audio features table are requested
+        await get_audio_features_of_tracks(albums_with_tracks["track_ids"],
+                                           session=session_pool.session(SPOTIFY_BASE_URL))
+
+        print(session_pool.report())
 
     print("Enrichment done!!")
 
 
 def create_db_to_link_composers_to_movies(movies: pd.DataFrame) -> pd.DataFrame:
-    """Description if needed"""
-    # Initialize the new database
-    db_to_link_composers_to_movies = pd.DataFrame(
-        columns=['tmdb_id', 'comp_id', 'movie_name', 'movie_revenue', 'composer_name', 'release_date',
-                 'composer_place_of_birth']
-    )
-    # Set the index to be unique (pair of ids)
-    db_to_link_composers_to_movies.set_index(['tmdb_id', 'comp_id'], inplace=True)
-
-    # Description TODO
-    for _, movie in movies.iterrows():
-        movie_id = movie['tmdb_id']
-        movie_name = movie['name']
-        movie_revenue = movie['box_office_revenue']
-        composers = movie['composers']
-        release_date = movie['release_date']
-
-        if type(composers) == list:  # meaning we have information about composers, otherwise float nan returned
-            for composer in composers:
-                comp_id = composer.id
-                comp_name = composer.name
-                comp_place_of_birth = composer.place_of_birth
-                db_to_link_composers_to_movies.loc[(movie_id, comp_id), :] = \
-                    {'movie_name': movie_name,
-                     'movie_revenue': movie_revenue,
-                     'composer_name': comp_name,
-                     'release_date': release_date,
-                     'composer_place_of_birth': comp_place_of_birth}
-        else:
-            pass
+    """Create the table linking each movie to its composers
 
-    return db_to_link_composers_to_movies
+    Parameters
+    ----------
+    movies: The enriched movies dataframe, with a 'composers' column
+
+    Returns
+    -------
+    A dataframe indexed by the pair ('tmdb_id', 'comp_id') with the movie and composer attributes
+    """
+    # Read the pairs from the sparse composer-movie graph instead of filling the table row by row
+    db_to_link_composers_to_movies = ComposerMovieGraph.from_movies(movies).link_table()
+
+    # The pair of ids should be unique, a composer can be credited twice for the same movie
+    return db_to_link_composers_to_movies[~db_to_link_composers_to_movies.index.duplicated(keep='first')]
 
 
 if __name__ == '__main__':
-    create_musics_dataset()
+    parser = argparse.ArgumentParser(description='Enrich the movies with their Spotify albums and musics')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process the rows added or changed since the previous run')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the CPU and memory of each stage, the reports are written to dataset/profiles')
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling()
+
+    create_musics_dataset(args.incremental)
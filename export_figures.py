@@ -0,0 +1,208 @@
+"""
+This script exports all the figures of the research questions used on our website in one command:
+
+    python export_figures.py --output-dir figures [--static png] [--force]
+
+The datasets are loaded and the intermediate dataframes shared by several figures are computed once, then each
+figure is rendered in its own process. A figure is skipped if neither its input nor the code creating it changed
+since the last export.
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from plotly.offline import get_plotlyjs
+
+from question_script import figure_builder, grouped_stats, plotly_graph
+from question_script.figure_builder import write_html
+from question_script.grouped_stats import grouped_statistics
+from profiling import enable_profiling, profile_stage
+from question_script.question_helper import create_popularity_revenue_dataset, create_top_composers_dataset
+
+# Figures to export: name of the exported file -> (function creating the figure, intermediate dataframes it takes as
+# positional arguments)
+FIGURES = {
+    'Q3_number_of_movies_per_year': (plotly_graph.figure_number_of_movies, ('top_composers',)),
+    'Q3_box_office_revenue_per_year': (plotly_graph.figure_box_office_revenue, ('top_composers',)),
+    'Q7_popularity_histogram': (plotly_graph.figure_popularity_histogram, ('popularity',)),
+    'Q7_scatter_popularity_revenue_by_year': (plotly_graph.figure_scatter_popularity_revenue_by_year,
+                                              ('popularity_revenue', 'popularity_revenue_fits_by_date')),
+    'Q7_scatter_popularity_revenue_overall': (plotly_graph.figure_scatter_popularity_revenue_overall,
+                                              ('popularity_revenue', 'popularity_revenue_fit')),
+    'Q7_correlation_heatmap': (plotly_graph.figure_heatmap_correlation, ('correlation_by_year',)),
+}
+
+# File storing the fingerprint of each exported figure, in the output directory
+MANIFEST_NAME = 'figures_manifest.json'
+
+
+@profile_stage('figures_intermediates')
+def create_intermediates(datasets_path: str = 'dataset') -> dict[str, pd.DataFrame]:
+    """Load the enriched datasets and compute the dataframes taken by the figures
+
+    Parameters
+    ----------
+    datasets_path: The directory containing the datasets
+
+    Returns
+    -------
+    The intermediate dataframes, keyed by name. The question 7 ones are missing if the spotify musics dataset has not
+    been created
+    """
+    clean_enrich_movies = pd.read_pickle(os.path.join(datasets_path, 'clean_enrich_movies.pickle'))
+
+    intermediates = {'top_composers': create_top_composers_dataset(clean_enrich_movies)}
+
+    album_id_and_musics_path = os.path.join(datasets_path, 'album_id_and_musics.pickle')
+    if os.path.isfile(album_id_and_musics_path):
+        pop_df, merged_df = create_popularity_revenue_dataset(
+            pd.read_pickle(album_id_and_musics_path),
+            pd.read_pickle(os.path.join(datasets_path, 'movie_album_and_revenue.pickle')))
+
+        intermediates['popularity'] = pop_df
+        intermediates['popularity_revenue'] = merged_df
+        # The trendlines of the scatter figures, fitted once here instead of in each figure process. The fits by date
+        # are keyed on the release_date values the points are colored by
+        intermediates['popularity_revenue_fits_by_date'] = grouped_statistics(
+            merged_df['popularity'], merged_df['movie_revenue'], merged_df['release_date'])
+        intermediates['popularity_revenue_fit'] = grouped_statistics(merged_df['popularity'],
+                                                                     merged_df['movie_revenue'])
+        intermediates['correlation_by_year'] = plotly_graph.compute_correlation_by_year(merged_df)
+    else:
+        print(f'{album_id_and_musics_path} not found, the figures of question 7 are skipped')
+
+    return intermediates
+
+
+def _fingerprint(function, data: list[pd.DataFrame], static_format: str = None) -> str:
+    """Fingerprint of a figure, changes whenever its inputs, the code creating it or its static export changes
+
+    Parameters
+    ----------
+    function: The function creating the figure
+    data: The dataframes given to the function
+    static_format: The format of the static export, None if there is none
+
+    Returns
+    -------
+    The hexadecimal digest of the fingerprint
+    """
+    digest = hashlib.sha256()
+    digest.update(pickle.dumps(data))
+    digest.update(f'static {static_format}'.encode())
+    digest.update(inspect.getsource(inspect.getmodule(function)).encode())
+    digest.update(inspect.getsource(figure_builder).encode())
+    digest.update(inspect.getsource(grouped_stats).encode())
+    return digest.hexdigest()
+
+
+def _render_figure(name: str, function, data: list[pd.DataFrame], output_dir: str, static_format: str = None) -> str:
+    """Create a figure and write it to the output directory, run in a worker process
+
+    Parameters
+    ----------
+    name: The name of the exported files
+    function: The function creating the figure
+    data: The dataframes given to the function
+    output_dir: The directory where to write the figure
+    static_format: The format of the static export (e.g. 'png', 'svg'), no static export if None
+
+    Returns
+    -------
+    The name of the figure
+    """
+    with profile_stage(f'figure_{name}'):
+        fig = function(*data)
+
+        write_html(fig, os.path.join(output_dir, f'{name}.html'))
+        if static_format:
+            # Static exports need the kaleido package
+            fig.write_image(os.path.join(output_dir, f'{name}.{static_format}'))
+
+    return name
+
+
+def export_all_figures(output_dir: str = 'figures', datasets_path: str = 'dataset', static_format: str = None,
+                       force: bool = False, max_workers: int = None):
+    """Export all the figures of the research questions
+
+    Parameters
+    ----------
+    output_dir: The directory where to write the figures, along with the shared plotly.min.js
+    datasets_path: The directory containing the datasets
+    static_format: The format of the optional static export (e.g. 'png', 'svg')
+    force: Whether to export the figures even if they did not change since the last export
+    max_workers: The number of processes, defaults to the number of CPUs
+    """
+    start_time = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Write the shared plotly.js bundle once, so that the workers do not race to copy it
+    plotly_js_path = os.path.join(output_dir, 'plotly.min.js')
+    if not os.path.isfile(plotly_js_path):
+        with open(plotly_js_path, 'w', encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    intermediates = create_intermediates(datasets_path)
+
+    # Only render the figures whose fingerprint changed
+    to_render = {}
+    for name, (function, inputs) in FIGURES.items():
+        if any(intermediate not in intermediates for intermediate in inputs):
+            continue
+        fingerprint = _fingerprint(function, [intermediates[intermediate] for intermediate in inputs], static_format)
+        exported = os.path.isfile(os.path.join(output_dir, f'{name}.html')) and (
+            not static_format or os.path.isfile(os.path.join(output_dir, f'{name}.{static_format}')))
+        if force or not exported or manifest.get(name) != fingerprint:
+            to_render[name] = fingerprint
+        else:
+            print(f'{name} is up to date')
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_render_figure, name, FIGURES[name][0],
+                                   [intermediates[intermediate] for intermediate in FIGURES[name][1]], output_dir,
+                                   static_format)
+                   for name in to_render]
+
+        for future in as_completed(futures):
+            try:
+                name = future.result()
+            except Exception as e:
+                print(f'Error while exporting a figure: {e}')
+                continue
+            manifest[name] = to_render[name]
+            print(f'{name} exported')
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f'Elapsed time: {time.time() - start_time}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export all the figures of the research questions')
+    parser.add_argument('--output-dir', default='figures', help='directory where to write the figures')
+    parser.add_argument('--datasets-path', default='dataset', help='directory containing the datasets')
+    parser.add_argument('--static', default=None, help='format of the static exports, e.g. png (needs kaleido)')
+    parser.add_argument('--force', action='store_true', help='export the figures even if they did not change')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the CPU and memory of each figure, the reports are written to dataset/profiles')
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling()
+
+    export_all_figures(args.output_dir, args.datasets_path, args.static, args.force, args.workers)
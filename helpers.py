@@ -1,5 +1,8 @@
 import json
+import re
+import unicodedata
 
+import numpy as np
 import pandas as pd
 from IPython.core.display_functions import display
 
@@ -79,6 +82,73 @@ def clean_movies_revenue(df: pd.DataFrame) -> pd.DataFrame:
     return result.reset_index(drop=True)
 
 
+def stratified_sample(movies: pd.DataFrame, size: int, seed: int = 0, nb_revenue_buckets: int = 4) -> pd.DataFrame:
+    """Draw a sample of the cleaned movies stratified by decade and box office revenue bucket, so that a small sample
+    keeps the share of old, recent, successful and unknown revenue movies of the whole dataset
+
+    Parameters
+    ----------
+    movies: The cleaned movies, with the 'release_date' year and the 'box_office_revenue'
+    size: The number of movies to draw
+    seed: The seed of the random draw, so that two runs compare the same movies
+    nb_revenue_buckets: The number of quantile buckets of the known revenues, the unknown revenues being another bucket
+
+    Returns
+    -------
+    The sampled movies, in their original order
+    """
+    if size >= len(movies):
+        return movies.copy()
+
+    decade = pd.to_numeric(movies.release_date, errors='coerce') // 10 * 10
+    revenue = movies.box_office_revenue.astype('float64')
+    revenue_bucket = pd.qcut(revenue.rank(method='first'), nb_revenue_buckets, labels=False)
+    strata = pd.DataFrame({'decade': decade.to_numpy(dtype='float64'),
+                           'revenue_bucket': revenue_bucket.to_numpy(dtype='float64')}).fillna(-1)
+    groups = strata.groupby(['decade', 'revenue_bucket']).indices
+
+    # Each stratum gets its share of the sample, the remaining movies go to the largest remainders
+    counts = pd.Series({key: len(positions) for key, positions in groups.items()})
+    quotas = counts * size / len(movies)
+    allocation = np.floor(quotas).astype(int)
+    remainders = (quotas - allocation).sort_values(ascending=False, kind='stable')
+    allocation.loc[remainders.index[:size - allocation.sum()]] += 1
+
+    rng = np.random.default_rng(seed)
+    positions = np.concatenate([rng.choice(groups[key], allocation.loc[key], replace=False) for key in groups])
+    return movies.iloc[np.sort(positions)]
+
+
+def remove_accents(text: str) -> str:
+    """Remove the accents of a text, e.g. 'Zürich' becomes 'Zurich'
+
+    Parameters
+    ----------
+    text: The text whose accents are removed
+
+    Returns
+    -------
+    The text without accents
+    """
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def normalize_words(text: str) -> str:
+    """Normalize a text to compare its words: remove accents, case and punctuation, e.g. 'Jean-Michel Jarre' and
+    'jean michel jarre' are both 'jean michel jarre'
+
+    Parameters
+    ----------
+    text: The text to normalize
+
+    Returns
+    -------
+    The words of the text separated by a single space, empty for a text without any word
+    """
+    return re.sub(r'[\W_]+', ' ', remove_accents(text).casefold()).strip()
+
+
 def insight(x: pd.DataFrame):
     """Display a structured and relevant insight of the current movie dataframe.
 
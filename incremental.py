@@ -0,0 +1,132 @@
+"""
+Helpers for the incremental enrichment of the datasets. Each input row is identified by a hash of its identity
+columns (e.g. the name and release date of a movie), and a second hash of its content tells whether it changed since
+the previous run. Only the added or changed rows are sent to TMDB and Spotify, and their result is merged into the
+previous enriched snapshot, so that adding a few hundred movies costs a few hundred requests instead of a full rerun.
+"""
+import os
+
+import pandas as pd
+
+
+def hash_rows(df: pd.DataFrame, columns: list[str]) -> pd.Series:
+    """Hash the given columns of each row of a dataframe
+
+    Parameters
+    ----------
+    df: The dataframe to hash
+    columns: The columns to include in the hash, lists (e.g. genres) are hashed through their string representation
+
+    Returns
+    -------
+    A series of hexadecimal hashes, aligned with the index of the dataframe
+    """
+    hashes = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+    return hashes.map('{:016x}'.format).astype(object)
+
+
+def compute_row_hashes(df: pd.DataFrame, identity_columns: list[str], content_columns: list[str] = None) \
+        -> pd.DataFrame:
+    """Compute the identity and content hashes of each row of a dataframe
+
+    Parameters
+    ----------
+    df: The input dataframe of an enrichment stage
+    identity_columns: The columns identifying a row, e.g. ['name', 'release_date']
+    content_columns: The other columns whose change requires the row to be enriched again
+
+    Returns
+    -------
+    A dataframe aligned with df, with the columns 'identity_hash' and 'content_hash'
+    """
+    return pd.DataFrame({'identity_hash': hash_rows(df, identity_columns),
+                         'content_hash': hash_rows(df, identity_columns + (content_columns or []))},
+                        index=df.index)
+
+
+def load_processed_hashes(path: str) -> pd.DataFrame:
+    """Load the hashes of the rows processed by the previous run
+
+    Parameters
+    ----------
+    path: The pickle file written by save_processed_hashes
+
+    Returns
+    -------
+    A dataframe with the columns 'identity_hash' and 'content_hash', empty if the file does not exist
+    """
+    if os.path.isfile(path):
+        return pd.read_pickle(path)
+
+    return pd.DataFrame({'identity_hash': pd.Series(dtype=object), 'content_hash': pd.Series(dtype=object)})
+
+
+def save_processed_hashes(hashes: pd.DataFrame, path: str):
+    """Store the hashes of the rows processed by the current run, including the rows dropped during the enrichment
+    (e.g. movies not found on TMDB), so that they are not requested again by the next run
+
+    Parameters
+    ----------
+    hashes: The dataframe returned by compute_row_hashes
+    path: The pickle file to write
+    """
+    hashes.drop_duplicates(subset='identity_hash', keep='last').reset_index(drop=True).to_pickle(path)
+
+
+def hashes_from_snapshot(snapshot: pd.DataFrame, identity_columns: list[str]) -> pd.DataFrame:
+    """Rebuild the processed hashes from an enriched snapshot created before the incremental mode existed. The content
+    of these rows is unknown, so they are considered unchanged
+
+    Parameters
+    ----------
+    snapshot: The enriched dataframe of the previous run
+    identity_columns: The columns identifying a row
+
+    Returns
+    -------
+    A dataframe with the columns 'identity_hash' and 'content_hash', the latter being None
+    """
+    return pd.DataFrame({'identity_hash': hash_rows(snapshot, identity_columns).to_numpy(), 'content_hash': None})
+
+
+def select_delta(hashes: pd.DataFrame, processed: pd.DataFrame) -> pd.Series:
+    """Select the rows that were added or changed since the previous run
+
+    Parameters
+    ----------
+    hashes: The hashes of the current input, returned by compute_row_hashes
+    processed: The hashes of the rows processed by the previous run
+
+    Returns
+    -------
+    A boolean mask aligned with hashes, True for the rows to enrich
+    """
+    previous = processed.drop_duplicates(subset='identity_hash', keep='last').set_index('identity_hash').content_hash
+    previous_content = hashes.identity_hash.map(previous)
+
+    known = hashes.identity_hash.isin(previous.index)
+    # A None content hash comes from hashes_from_snapshot, the row is assumed unchanged
+    changed = known & previous_content.notna() & (previous_content != hashes.content_hash)
+
+    return ~known | changed
+
+
+def merge_into_snapshot(snapshot: pd.DataFrame, delta_result: pd.DataFrame, identity_columns: list[str],
+                        unchanged_hashes) -> pd.DataFrame:
+    """Merge the enrichment of the delta rows into the previous snapshot. The rows of the snapshot that changed, or
+    that are no longer in the input, are replaced or dropped
+
+    Parameters
+    ----------
+    snapshot: The enriched dataframe of the previous run
+    delta_result: The enriched dataframe of the added or changed rows
+    identity_columns: The columns identifying a row, present in both dataframes
+    unchanged_hashes: The identity hashes of the input rows that did not change
+
+    Returns
+    -------
+    The merged dataframe, with a new range index
+    """
+    kept = snapshot[hash_rows(snapshot, identity_columns).isin(set(unchanged_hashes))]
+
+    return pd.concat([kept, delta_result], ignore_index=True)
@@ -0,0 +1,213 @@
+"""
+Offline resolver mapping a place of birth (e.g. "Sheffield, Yorkshire, England, UK") to its country. It replaces
+the GPT request of location_to_country_openai_api.py with a lookup in the gazetteer bundled in dataset/gazetteer.csv,
+which lists country names, aliases, administrative regions and major cities.
+
+The components of a location are matched from right to left, since the country is usually given last, with a fuzzy
+match as fallback. The locations already present in dataset/mapping_locations_to_country.csv keep their mapping.
+"""
+import os
+import re
+
+import pandas as pd
+from rapidfuzz import fuzz, process
+
+from helpers import remove_accents
+
+# Separators between the components of a location, e.g. "Paris, France" or "Glasgow - Scotland"
+_SEPARATORS = re.compile(r'\s*(?:,|，|;|/|\|| - | – )\s*')
+
+# Hint on the current country of a historical place, e.g. "West Germany [now Germany]"
+_NOW_HINT = re.compile(r'[\[(]\s*now\s+(?:in\s+)?([^\])]+)[\])]', re.IGNORECASE)
+
+# Any other note between brackets, e.g. "Königsberg (Kaliningrad)"
+_BRACKETS = re.compile(r'[\[(][^\])]*[\])]')
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a place name to compare it with the gazetteer: remove accents, dots and case
+
+    Parameters
+    ----------
+    name: The name to normalize
+
+    Returns
+    -------
+    The normalized name
+    """
+    return re.sub(r'\s+', ' ', remove_accents(name).replace('.', ' ')).strip().casefold()
+
+
+class LocationResolver:
+    """
+    Class resolving the country of a location offline, with the gazetteer and an in-memory cache
+
+    e.g. resolver = LocationResolver()
+         resolver.resolve('Mito, Ibaraki Prefecture, Japan')
+    """
+
+    def __init__(self, gazetteer_path: str = 'dataset/gazetteer.csv',
+                 known_mapping_path: str = 'dataset/mapping_locations_to_country.csv', fuzzy_threshold: float = 90):
+        """
+        Parameters
+        ----------
+        gazetteer_path: The csv file with the columns 'name', 'country' and 'kind' (country, alias, region, city,
+        code or suffix)
+        known_mapping_path: The csv file with the columns 'location' and 'country' of the locations already mapped,
+        ignored if None or if the file does not exist
+        fuzzy_threshold: The minimum fuzz ratio (0-100) for a component to match a gazetteer name
+        """
+        gazetteer = pd.read_csv(gazetteer_path, keep_default_na=False)
+
+        is_code = gazetteer.kind == 'code'
+        is_suffix = gazetteer.kind == 'suffix'
+        names = gazetteer[~is_code & ~is_suffix]
+
+        # Names are matched without case and accents, codes (e.g. 'CA', 'N.Y.') are case sensitive
+        self._names = dict(zip(names.name.map(normalize_name), names.country))
+        self._codes = dict(zip(gazetteer[is_code].name.str.replace('.', '', regex=False), gazetteer[is_code].country))
+        self._suffixes = dict(zip(gazetteer[is_suffix].name.map(normalize_name), gazetteer[is_suffix].country))
+        self._fuzzy_choices = list(self._names.keys())
+        self._fuzzy_threshold = fuzzy_threshold
+
+        self._cache = {}
+        if known_mapping_path and os.path.isfile(known_mapping_path):
+            known_mapping = pd.read_csv(known_mapping_path).dropna()
+            self._cache.update(zip(known_mapping.location, known_mapping.country))
+
+    def _match_component(self, component: str):
+        """Exact match of a single component of a location
+
+        Parameters
+        ----------
+        component: The component, e.g. "Yorkshire"
+
+        Returns
+        -------
+        The country, None if the component is not found in the gazetteer
+        """
+        code = component.replace('.', '').strip()
+        if code in self._codes:
+            return self._codes[code]
+
+        key = normalize_name(component)
+        if key in self._names:
+            return self._names[key]
+
+        words = re.split(r'[\s-]+', key)
+        if words and words[-1] in self._suffixes:
+            return self._suffixes[words[-1]]
+
+        # Look for a known name inside the component (e.g. "Tokyo Japan"), from right to left, longest first
+        for size in range(len(words) - 1, 0, -1):
+            for start in range(len(words) - size, -1, -1):
+                phrase = ' '.join(words[start:start + size])
+                if phrase in self._names:
+                    return self._names[phrase]
+
+        return None
+
+    def _fuzzy_match_component(self, component: str):
+        """Fuzzy match of a single component of a location, to handle typos and spelling variants
+
+        Parameters
+        ----------
+        component: The component, e.g. "Pensylvania"
+
+        Returns
+        -------
+        The country, None if no gazetteer name is close enough
+        """
+        key = normalize_name(component)
+        # Short names are too ambiguous to be matched approximately
+        if len(key) < 4:
+            return None
+
+        match = process.extractOne(key, self._fuzzy_choices, scorer=fuzz.ratio, score_cutoff=self._fuzzy_threshold)
+        return self._names[match[0]] if match else None
+
+    def _resolve_uncached(self, location: str):
+        """Resolve a location without looking at the cache
+
+        Parameters
+        ----------
+        location: The location to resolve
+
+        Returns
+        -------
+        The country, None if it could not be resolved
+        """
+        hint = _NOW_HINT.search(location)
+        if hint:
+            country = self._resolve_uncached(hint.group(1))
+            if country:
+                return country
+
+        components = [c for c in _SEPARATORS.split(_BRACKETS.sub('', location)) if c.strip()]
+
+        for match in (self._match_component, self._fuzzy_match_component):
+            for component in reversed(components):
+                country = match(component)
+                if country:
+                    return country
+
+        return None
+
+    def resolve(self, location: str):
+        """Resolve the country of a location
+
+        Parameters
+        ----------
+        location: The location, e.g. a Composer.place_of_birth
+
+        Returns
+        -------
+        The country, None if the location is missing or could not be resolved
+        """
+        if not isinstance(location, str) or not location.strip():
+            return None
+
+        if location not in self._cache:
+            self._cache[location] = self._resolve_uncached(location)
+
+        return self._cache[location]
+
+    def resolve_all(self, locations) -> pd.DataFrame:
+        """Resolve the country of several locations
+
+        Parameters
+        ----------
+        locations: The locations to resolve, duplicates are resolved once
+
+        Returns
+        -------
+        A dataframe with the columns 'location' and 'country', in the format of mapping_locations_to_country.csv
+        """
+        locations = pd.unique(pd.Series(list(locations), dtype=object).dropna())
+
+        return pd.DataFrame({'location': locations, 'country': [self.resolve(location) for location in locations]})
+
+
+def create_mapping_locations_to_country(movies_path: str = 'dataset/clean_enrich_movies.pickle',
+                                        mapping_path: str = 'dataset/mapping_locations_to_country.csv'):
+    """Create the mapping between the composers' place of birth and their country, and store it as a csv file
+
+    Parameters
+    ----------
+    movies_path: The enriched movies dataset, with the 'composers' column
+    mapping_path: The csv file to create, its existing entries are kept
+    """
+    movies = pd.read_pickle(movies_path)
+    places_of_birth = [composer.place_of_birth for composers in movies.composers.dropna() for composer in composers]
+
+    mapping = LocationResolver(known_mapping_path=mapping_path).resolve_all(places_of_birth)
+
+    unresolved = mapping.country.isna()
+    if unresolved.any():
+        print(f'{unresolved.sum()} locations could not be resolved: {mapping.location[unresolved].tolist()}')
+
+    mapping.dropna().to_csv(mapping_path, index=False)
+
+
+if __name__ == '__main__':
+    create_mapping_locations_to_country()
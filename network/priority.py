@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+import pandas as pd
+
+
+@dataclass
+class PriorityStats:
+    """
+    Data class that gathers the counters of a PriorityScheduler run
+    """
+    nb_done: int = 0
+    nb_failed: int = 0
+    # Items not started before the end of the time budget
+    nb_remaining: int = 0
+    # Sum of the priorities of the items done, and of all the items, to measure the weighted coverage of a partial run
+    done_priority: float = 0
+    total_priority: float = 0
+
+    @property
+    def coverage(self) -> float:
+        """Share of the total priority covered by the items done"""
+        return self.done_priority / self.total_priority if self.total_priority else 0
+
+
+def priority_order(priorities: pd.Series) -> pd.Index:
+    """Order the index of a series by decreasing priority, the missing priorities last, and the equal priorities in
+    their original order
+
+    Parameters
+    ----------
+    priorities: The priority of each row, e.g. the known box office revenue of each movie
+
+    Returns
+    -------
+    The index of the series, the most valuable rows first
+    """
+    return priorities.sort_values(ascending=False, na_position='last', kind='stable').index
+
+
+class PriorityScheduler:
+    """
+    Class running an async worker on many items, the items with the highest priority first, while keeping
+    max_concurrency items in flight. Once the time budget is spent, no new item is started, so that a run cut short
+    has covered the most valuable items instead of an arbitrary subset
+
+    e.g. scheduler = PriorityScheduler(max_concurrency=50, time_budget=600)
+         results = await scheduler.run(df.index, df.box_office_revenue, fetch_movie)
+         print(scheduler.report())
+    """
+
+    def __init__(self, max_concurrency: int = 50, time_budget: float = None):
+        """
+        Parameters
+        ----------
+        max_concurrency: The number of items in flight
+        time_budget: The number of seconds after which no new item is started, no limit if None
+        """
+        self._max_concurrency = max_concurrency
+        self._time_budget = time_budget
+        self.stats = PriorityStats()
+
+    async def run(self, keys: list[Hashable], priorities: list[float], worker: Callable[[Hashable], Awaitable]) \
+            -> dict[Hashable, Any]:
+        """Run the worker on each key, by decreasing priority
+
+        Parameters
+        ----------
+        keys: The keys of the items, e.g. the index of the rows
+        priorities: The priority of each key, the keys with a missing priority are run last
+        worker: The coroutine function run on each key
+
+        Returns
+        -------
+        The result of each key done, the keys that failed or were not started are missing
+        """
+        self.stats = PriorityStats()
+        # heapq pops the smallest element, the counter keeps the original order of the equal priorities
+        counter = itertools.count()
+        heap = []
+        for key, priority in zip(keys, priorities):
+            missing = priority is None or (isinstance(priority, float) and math.isnan(priority))
+            heap.append((math.inf if missing else -priority, next(counter), key))
+            self.stats.total_priority += 0 if missing else priority
+        heapq.heapify(heap)
+
+        deadline = time.monotonic() + self._time_budget if self._time_budget is not None else math.inf
+        results = {}
+
+        async def consume():
+            while heap and time.monotonic() < deadline:
+                negative_priority, _, key = heapq.heappop(heap)
+                try:
+                    results[key] = await worker(key)
+                except Exception as e:
+                    print(f'Error while processing {key}: {e}')
+                    self.stats.nb_failed += 1
+                    continue
+                self.stats.nb_done += 1
+                self.stats.done_priority += 0 if negative_priority == math.inf else -negative_priority
+
+        await asyncio.gather(*[consume() for _ in range(min(self._max_concurrency, len(heap)))])
+        self.stats.nb_remaining = len(heap)
+
+        return results
+
+    def report(self) -> str:
+        """Summary of the last run
+
+        Returns
+        -------
+        The summary, to be printed
+        """
+        return (f'{self.stats.nb_done} items done, {self.stats.nb_failed} failed, {self.stats.nb_remaining} not '
+                f'started before the end of the time budget, covering {self.stats.coverage:.1%} of the total priority')
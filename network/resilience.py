@@ -0,0 +1,300 @@
+import asyncio
+import re
+import time
+import urllib.parse
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+from aiohttp import ClientResponseError
+
+# Path segments that identify a resource rather than an endpoint: numeric TMDB ids and base62 Spotify ids
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9A-Za-z]{22})$')
+
+
+def endpoint_of(url: str) -> str:
+    """The endpoint of an url, i.e. its host and path with the resource ids replaced, so that e.g. the credits of all
+    the movies share the same latency statistics and circuit breaker
+
+    Parameters
+    ----------
+    url: The url of a request
+
+    Returns
+    -------
+    The endpoint, e.g. 'api.themoviedb.org/3/movie/{id}/credits'
+    """
+    parts = urllib.parse.urlsplit(url)
+    segments = parts.path.split('/')
+    # The first segment is the version of the API
+    path = '/'.join(segments[:2] + ['{id}' if _ID_SEGMENT.match(segment) else segment for segment in segments[2:]])
+    return parts.netloc + path.rstrip('/')
+
+
+@dataclass
+class ResilienceStats:
+    """
+    Data class that gathers the counters of a ResilientRequester
+    """
+    nb_requests: int = 0
+    # Duplicate requests sent because the first one exceeded the observed p95, and how many of them answered first
+    nb_hedged: int = 0
+    nb_hedges_won: int = 0
+    nb_timeouts: int = 0
+    nb_retries: int = 0
+    nb_circuit_opened: int = 0
+    # Time spent by the requests waiting for an open circuit, in seconds
+    circuit_wait_time: float = 0
+
+
+class CircuitBreaker:
+    """
+    Class stopping the requests to an endpoint that keeps failing. After failure_threshold consecutive server errors,
+    the circuit opens and the requests wait for the cooldown, then a single trial request is let through: the circuit
+    closes if it succeeds, and opens again otherwise
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30):
+        """
+        Parameters
+        ----------
+        failure_threshold: The number of consecutive failures opening the circuit
+        cooldown: The number of seconds the circuit stays open
+        """
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._nb_failures = 0
+        self._open_until = 0
+        self._trial = None
+
+    async def wait(self):
+        """Wait until a request can be sent to the endpoint"""
+        while True:
+            remaining = self._open_until - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif self._trial is not None:
+                # A trial request is in flight, wait for its outcome
+                await asyncio.shield(self._trial)
+            else:
+                if self._nb_failures >= self._failure_threshold:
+                    # Half open, this request is the trial
+                    self._trial = asyncio.get_running_loop().create_future()
+                return
+
+    def release(self):
+        """Release the requests waiting for the trial request, e.g. when the trial request is cancelled"""
+        if self._trial is not None:
+            self._trial.set_result(None)
+            self._trial = None
+
+    def record_success(self):
+        """Record a successful request, closing the circuit"""
+        self._nb_failures = 0
+        self.release()
+
+    def record_failure(self) -> bool:
+        """Record a failed request
+
+        Returns
+        -------
+        Whether the failure opened the circuit, False if it was already open
+        """
+        was_open = time.monotonic() < self._open_until
+        self._nb_failures += 1
+        self.release()
+        if self._nb_failures >= self._failure_threshold:
+            self._open_until = time.monotonic() + self._cooldown
+            return not was_open
+
+        return False
+
+
+class ResilientRequester:
+    """
+    Class wrapping the requests of a loader to keep the tail latency under control, with statistics per endpoint:
+    - a timeout derived from the observed latencies, so that a stuck socket does not stall a whole gather
+    - a hedged duplicate request once a request exceeds the observed p95, the first response being kept
+    - a circuit breaker that stops sending requests to an endpoint returning repeated 5xx
+    - a retry of the requests that timed out or failed with a 5xx, instead of restarting a whole batch
+    The requests in flight are limited below the connection limit of the session, so that the time spent waiting for a
+    connection is not counted in the latencies, and the hedges find a free connection
+
+    e.g. requester = ResilientRequester()
+         response = await requester.call(url, lambda: perform_request(url))
+    """
+
+    def __init__(self, max_concurrency: int = 45, min_samples: int = 20, hedge_quantile: float = 0.95,
+                 max_hedge_ratio: float = 0.1, timeout_factor: float = 3, min_timeout: float = 10,
+                 max_timeout: float = 120, max_retries: int = 2, failure_threshold: int = 5, cooldown: float = 30,
+                 window: int = 1000):
+        """
+        Parameters
+        ----------
+        max_concurrency: The number of requests in flight, hedges excluded
+        min_samples: The number of latencies observed on an endpoint before hedging and adapting its timeout
+        hedge_quantile: The quantile of the latencies after which a request is hedged
+        max_hedge_ratio: The maximum share of hedged requests, so that hedging does not overload a slow API
+        timeout_factor: The timeout of an endpoint is this factor times its p99 latency
+        min_timeout: The lower bound of the timeout, in seconds
+        max_timeout: The timeout used until enough latencies are observed, and its upper bound, in seconds
+        max_retries: The number of retries of a request that timed out or failed with a 5xx
+        failure_threshold: The number of consecutive failures opening the circuit of an endpoint
+        cooldown: The number of seconds the circuit of an endpoint stays open
+        window: The number of latest latencies kept per endpoint
+        """
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._min_samples = min_samples
+        self._hedge_quantile = hedge_quantile
+        self._max_hedge_ratio = max_hedge_ratio
+        self._timeout_factor = timeout_factor
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._max_retries = max_retries
+
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._breakers = defaultdict(lambda: CircuitBreaker(failure_threshold, cooldown))
+        self.stats = ResilienceStats()
+
+    def quantile(self, endpoint: str, q: float):
+        """The quantile of the latest latencies of an endpoint
+
+        Parameters
+        ----------
+        endpoint: The endpoint, see endpoint_of
+        q: The quantile, between 0 and 1
+
+        Returns
+        -------
+        The latency in seconds, None if not enough latencies were observed
+        """
+        latencies = self._latencies[endpoint]
+        if len(latencies) < self._min_samples:
+            return None
+
+        return float(np.quantile(latencies, q))
+
+    def timeout(self, endpoint: str) -> float:
+        """The timeout of a request to an endpoint, in seconds"""
+        p99 = self.quantile(endpoint, 0.99)
+        if p99 is None:
+            return self._max_timeout
+
+        return min(max(self._timeout_factor * p99, self._min_timeout), self._max_timeout)
+
+    async def call(self, url: str, perform: Callable[[], Awaitable]) -> Any:
+        """Perform a request with a latency-aware timeout, hedging, retries and circuit breaking
+
+        Parameters
+        ----------
+        url: The url of the request, used to find its endpoint
+        perform: The function creating the coroutine of the request, called once per attempt or hedge
+
+        Returns
+        -------
+        The result of the request
+        """
+        endpoint = endpoint_of(url)
+        breaker = self._breakers[endpoint]
+
+        attempt = 0
+        while True:
+            wait_start = time.monotonic()
+            await breaker.wait()
+            self.stats.circuit_wait_time += time.monotonic() - wait_start
+
+            # The timeout and the latency only cover the request itself, not the wait for a slot
+            async with self._slots:
+                self.stats.nb_requests += 1
+                start = time.monotonic()
+                try:
+                    result = await asyncio.wait_for(self._hedged(endpoint, perform), self.timeout(endpoint))
+                except asyncio.TimeoutError as e:
+                    # A stuck request is retried, but does not tell that the endpoint fails
+                    breaker.release()
+                    self.stats.nb_timeouts += 1
+                    error = e
+                except ClientResponseError as e:
+                    if e.status < 500:
+                        # The endpoint works, the request itself is wrong or rate limited
+                        breaker.record_success()
+                        raise
+                    if breaker.record_failure():
+                        self.stats.nb_circuit_opened += 1
+                        print(f'Circuit of {endpoint} opened after repeated server errors')
+                    error = e
+                except asyncio.CancelledError:
+                    breaker.release()
+                    raise
+                except Exception:
+                    breaker.record_success()
+                    raise
+                else:
+                    breaker.record_success()
+                    self._latencies[endpoint].append(time.monotonic() - start)
+                    return result
+
+            if attempt >= self._max_retries:
+                raise error
+            attempt += 1
+            self.stats.nb_retries += 1
+
+    async def _hedged(self, endpoint: str, perform: Callable[[], Awaitable]) -> Any:
+        """Perform a request, and a duplicate of it once it exceeds the observed quantile of its endpoint
+
+        Parameters
+        ----------
+        endpoint: The endpoint of the request
+        perform: The function creating the coroutine of the request
+
+        Returns
+        -------
+        The result of the first request to succeed
+        """
+        first = asyncio.ensure_future(perform())
+        delay = self.quantile(endpoint, self._hedge_quantile)
+        if delay is None or self.stats.nb_hedged >= self._max_hedge_ratio * self.stats.nb_requests:
+            return await first
+
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+
+            self.stats.nb_hedged += 1
+            hedge = asyncio.ensure_future(perform())
+            tasks.add(hedge)
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.stats.nb_hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def report(self) -> str:
+        """Summary of the counters, with the latency quantiles of each endpoint
+
+        Returns
+        -------
+        The summary, to be printed
+        """
+        lines = [f'{self.stats.nb_requests} requests, {self.stats.nb_hedged} hedged ({self.stats.nb_hedges_won} '
+                 f'answered first), {self.stats.nb_timeouts} timeouts, {self.stats.nb_retries} retries, '
+                 f'{self.stats.nb_circuit_opened} circuits opened ({self.stats.circuit_wait_time:.1f}s waiting)']
+        for endpoint, latencies in sorted(self._latencies.items()):
+            if latencies:
+                p50, p95, p99 = np.quantile(latencies, [0.5, 0.95, 0.99])
+                lines.append(f'  {endpoint}: p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms')
+
+        return '\n'.join(lines)
@@ -0,0 +1,184 @@
+import asyncio
+import time
+import urllib.parse
+from dataclasses import dataclass
+
+import aiohttp
+
+
+@dataclass
+class ConnectionStats:
+    """
+    Data class that gathers the connection statistics of the sessions of a SessionPool
+    """
+    nb_requests: int = 0
+    # Connections opened, each one paying the DNS lookup (unless cached), the TCP and the TLS handshakes
+    nb_new_connections: int = 0
+    # Requests sent on a kept-alive connection, without any handshake
+    nb_reused_connections: int = 0
+    # Total time spent opening the new connections, in seconds
+    setup_time: float = 0
+    nb_dns_cache_hits: int = 0
+    nb_dns_cache_misses: int = 0
+    # Sessions handed to the stages, each stage opened a session of its own before the SessionPool
+    nb_stage_sessions: int = 0
+    # Hosts with a shared session
+    nb_hosts: int = 0
+
+    @property
+    def mean_setup_time(self) -> float:
+        """Mean time to open a connection, in seconds"""
+        return self.setup_time / self.nb_new_connections if self.nb_new_connections else 0
+
+    @property
+    def saved_setup_time(self) -> float:
+        """Estimation of the time saved compared to a session per stage, in seconds. A stage used to open at least one
+        connection in its own session, while the stages after the first one of a host now start on its kept-alive
+        connections, so the estimate is a lower bound"""
+        return max(self.nb_stage_sessions - self.nb_hosts, 0) * self.mean_setup_time
+
+
+class SessionPool:
+    """
+    Class providing a long-lived aiohttp session per host, shared by all the loaders of a run, so that the DNS
+    lookups, TCP and TLS handshakes are paid once instead of once per stage
+
+    The pool should be created inside the event loop of the run, in an 'async with' block that closes all the sessions
+    once the block is exited
+
+    e.g. async with SessionPool() as pool:
+            await pool.warm_up(['https://api.themoviedb.org/3'])
+            async with TMDBDataLoader(session=pool.session('https://api.themoviedb.org/3')) as tmdb:
+                ...
+            print(pool.report())
+    """
+
+    def __init__(self, limit_per_host: int = 50, ttl_dns_cache: int = 3600, keepalive_timeout: float = 60):
+        """
+        Parameters
+        ----------
+        limit_per_host: The maximum number of simultaneous connections to a host
+        ttl_dns_cache: The number of seconds the resolved addresses of a host are cached
+        keepalive_timeout: The number of seconds an idle connection is kept open, it should cover the pauses between
+        the stages of a run (e.g. the matching of a batch)
+        """
+        self._limit_per_host = limit_per_host
+        self._ttl_dns_cache = ttl_dns_cache
+        self._keepalive_timeout = keepalive_timeout
+        self._sessions = {}
+        self.stats = ConnectionStats()
+
+    async def __aenter__(self):
+        """ Method called when entering the 'async with' block
+
+        Returns
+        -------
+        The object itself
+        """
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """
+        Method called when exiting the 'async with' block, to close all the sessions
+        """
+        await self.close()
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        """Create the trace config gathering the connection statistics"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.stats.nb_requests += 1
+
+        async def on_connection_create_start(session, context, params):
+            context.connection_start = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params):
+            self.stats.nb_new_connections += 1
+            self.stats.setup_time += time.perf_counter() - context.connection_start
+
+        async def on_connection_reuseconn(session, context, params):
+            self.stats.nb_reused_connections += 1
+
+        async def on_dns_cache_hit(session, context, params):
+            self.stats.nb_dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, context, params):
+            self.stats.nb_dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+
+        return trace_config
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """Get the session of the host of an url for a stage, created on first use. It should be called once per
+        stage, as it counts the sessions the stages would have opened without the pool. The session has no default
+        headers, the loaders send their authorization header with each request
+
+        Parameters
+        ----------
+        url: Any url of the host, e.g. the base url of an API
+
+        Returns
+        -------
+        The shared session of the host
+        """
+        self.stats.nb_stage_sessions += 1
+        return self._host_session(url)
+
+    def _host_session(self, url: str) -> aiohttp.ClientSession:
+        """Get the session of the host of an url, created on first use, see session"""
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self._sessions:
+            self.stats.nb_hosts += 1
+            connector = aiohttp.TCPConnector(limit_per_host=self._limit_per_host, ttl_dns_cache=self._ttl_dns_cache,
+                                             keepalive_timeout=self._keepalive_timeout)
+            # No total timeout, to prevent error after 5min, which is the default timeout
+            self._sessions[host] = aiohttp.ClientSession(connector=connector,
+                                                         timeout=aiohttp.ClientTimeout(total=None),
+                                                         trace_configs=[self._trace_config()])
+
+        return self._sessions[host]
+
+    async def warm_up(self, urls: list[str], nb_connections: int = 10):
+        """Open connections to the hosts before the first stage, so that the first requests do not wait for the
+        handshakes. The status of the responses is ignored, only the connections matter
+
+        Parameters
+        ----------
+        urls: An url of each host to warm up
+        nb_connections: The number of connections to open per host
+        """
+
+        async def open_connection(url):
+            try:
+                async with self._host_session(url).head(url) as response:
+                    await response.read()
+            except aiohttp.ClientError as e:
+                print(f'Error while warming up {url}: {e}')
+
+        await asyncio.gather(*[open_connection(url) for url in urls for _ in range(nb_connections)])
+
+    def report(self) -> str:
+        """Summary of the connection statistics, with the setup time saved by sharing the sessions between the stages
+
+        Returns
+        -------
+        The summary, to be printed
+        """
+        return (f'{self.stats.nb_requests} requests, {self.stats.nb_new_connections} connections opened in '
+                f'{self.stats.setup_time:.2f}s (mean {self.stats.mean_setup_time * 1000:.1f}ms), '
+                f'{self.stats.nb_reused_connections} requests on a reused connection. {self.stats.nb_stage_sessions} '
+                f'stages shared {self.stats.nb_hosts} sessions, saving at least {self.stats.saved_setup_time:.2f}s of '
+                f'DNS lookups and handshakes compared to a session per stage. DNS cache: '
+                f'{self.stats.nb_dns_cache_hits} hits, {self.stats.nb_dns_cache_misses} misses')
+
+    async def close(self):
+        """Close all the sessions"""
+        await asyncio.gather(*[session.close() for session in self._sessions.values()])
+        self._sessions = {}
@@ -0,0 +1,91 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+
+@dataclass
+class SingleFlightStats:
+    """
+    Data class that gathers the counters of a SingleFlight
+    """
+    # Calls received, including the coalesced ones
+    nb_calls: int = 0
+    # Calls that joined a call already in flight instead of being performed
+    nb_coalesced: int = 0
+
+    @property
+    def nb_performed(self) -> int:
+        """Number of calls actually performed"""
+        return self.nb_calls - self.nb_coalesced
+
+
+class _Flight:
+    """A call in flight, along with the number of callers waiting for it"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.nb_waiters = 0
+
+
+class SingleFlight:
+    """
+    Class coalescing the concurrent calls with the same key: while a call is in flight, the calls with the same key
+    wait for its result instead of being performed again (e.g. two identical urls requested at the same time). Once
+    the call is done the key is forgotten, so that a later call is performed again
+
+    e.g. single_flight = SingleFlight()
+         response = await single_flight.do(url, lambda: perform_request(url))
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.stats = SingleFlightStats()
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable]) -> Any:
+        """Perform a call, or wait for the result of the call in flight with the same key. All the callers receive the
+        same result, or the same exception, so the result should not be modified by a caller
+
+        Parameters
+        ----------
+        key: The key identifying the call, e.g. the url of a request
+        function: The function creating the coroutine of the call, only called if no call with this key is in flight
+
+        Returns
+        -------
+        The result of the call
+        """
+        self.stats.nb_calls += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(function()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            self.stats.nb_coalesced += 1
+
+        flight.nb_waiters += 1
+        try:
+            # Shielded, so that a cancelled caller does not cancel the call of the other callers
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.nb_waiters == 1:
+                # Nobody else waits for the call
+                flight.task.cancel()
+            raise
+        finally:
+            flight.nb_waiters -= 1
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        """Remove a call that is done, unless a new call with the same key already replaced it"""
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def report(self) -> str:
+        """Summary of the counters
+
+        Returns
+        -------
+        The summary, to be printed
+        """
+        return (f'{self.stats.nb_calls} requests, {self.stats.nb_coalesced} duplicate requests avoided by joining an '
+                f'identical request in flight')
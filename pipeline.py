@@ -0,0 +1,574 @@
+"""
+This script runs the whole enrichment of the datasets as a graph of stages:
+
+    load -> clean -> revenue -> composers -> spotify_composers ------> tracks -> musics
+                                          \\-> albums ----------------/     \\-> audio_features
+
+    python pipeline.py [STAGE ...] [--force STAGE ...] [--adopt] [--workers N]
+    python pipeline.py --sample N [--seed SEED]
+    python pipeline.py --profile
+
+Each stage declares the stages it depends on, and is fingerprinted with its code, its source files and the
+fingerprints of its dependencies. A stage is executed only if its fingerprint changed since its last execution or if
+its output is missing, and the stages whose dependencies are done run in parallel (e.g. the Spotify composers lookup
+runs alongside the album search once the composers are known). All the stages run in a single event loop and share
+the TMDB and Spotify connections of a SessionPool, opened once for the whole run.
+
+With --sample, every stage runs on a sample of the cleaned movies stratified by decade and revenue bucket, in
+dataset/sample, so that a change of the matching or scoring logic can be judged in minutes. The match rates, the
+requests and the time of each stage are reported, along with their extrapolation to the whole dataset.
+
+With --profile, the CPU time, the stacks and the memory of each stage are reported in dataset/profiles (see profiling).
+"""
+import argparse
+import asyncio
+import dataclasses
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import pandas as pd
+
+from composer_matching import COMPOSER_MAPPING_PATH, link_legacy_composers, match_composers, resolve_composers
+from enrich_movie_data import enhanced_with_composer, enhanced_with_revenue
+from enrich_music_data import get_composers, get_music_dataset
+from enrich_with_spotify_data import (AUDIO_FEATURES_PATH, best_matching_album_ids,
+                                      create_db_to_link_composers_to_movies, explode_album_tracks,
+                                      get_album_ids_into_df, get_audio_features_of_tracks, get_music_from_track_ids,
+                                      get_track_ids_into_df, score_best_matching_albums)
+from helpers import clean_movies, clean_movies_revenue, load_movies, stratified_sample
+from network.session_pool import SessionPool
+from profiling import enable_profiling, profile_stage
+from spotify import get_bearer_token
+from spotify.SpotifyDataLoader import SPOTIFY_BASE_URL, SpotifyDataLoader
+from tmdb.tmdbDataLoader import TMDB_BASE_URL, TMDBDataLoader
+
+CMU_MOVIES_PATH = 'dataset/MovieSummaries/movie.metadata.tsv'
+
+# Directory of the outputs of the intermediate stages
+PIPELINE_OUTPUT_DIR = 'dataset/pipeline'
+
+# File storing the fingerprint of the last execution of each stage
+PIPELINE_STATE_PATH = 'dataset/checkpoints/pipeline_state.json'
+
+# Directory of the outputs of a sample run, see run_sample
+SAMPLE_OUTPUT_DIR = 'dataset/sample'
+SAMPLE_MOVIES_PATH = os.path.join(SAMPLE_OUTPUT_DIR, 'sample_movies.pickle')
+# Side stores of the sample run, so that it neither reuses nor appends to the ones of the full run
+SAMPLE_MAPPING_PATH = os.path.join(SAMPLE_OUTPUT_DIR, os.path.basename(COMPOSER_MAPPING_PATH))
+SAMPLE_AUDIO_FEATURES_PATH = os.path.join(SAMPLE_OUTPUT_DIR, os.path.basename(AUDIO_FEATURES_PATH))
+
+# The Spotify stages run in parallel, but the token is stored in a single .env file
+_spotify_token_lock = threading.Lock()
+
+
+@dataclass
+class Stage:
+    """
+    Class representing a stage of the pipeline
+
+    The function of the stage receives the outputs of its dependencies, in the order of the dependencies, and returns
+    a dataframe stored in output, as a parquet file if its extension is .parquet and as a pickle otherwise. A coroutine
+    function also receives the SessionPool of the run as session_pool keyword argument, so that all the stages share the
+    same connections
+    """
+    name: str
+    function: Callable[..., pd.DataFrame]
+    output: str
+    dependencies: list[str] = field(default_factory=list)
+    # Functions, classes or modules called by the function, a change in their code makes the stage run again
+    code: list = field(default_factory=list)
+    # Input files read by the function
+    sources: list[str] = field(default_factory=list)
+    # Whether to also store the output as a csv file
+    export_csv: bool = False
+    # Whether the output is only needed by the dependent stages, it is then computed again only when one of them runs
+    intermediate: bool = False
+
+
+@dataclass
+class StageMeasure:
+    """
+    Data class that gathers the measures of the execution of a stage
+    """
+    elapsed_time: float
+    # Requests sent through the SessionPool during the stage, only attributed to the stage if it ran alone
+    nb_requests: int
+    nb_rows: int
+
+
+def _refresh_spotify_token():
+    """Get a new Spotify token before a Spotify stage"""
+    with _spotify_token_lock:
+        get_bearer_token.replace_token("")
+
+
+def load_stage() -> pd.DataFrame:
+    """Load the CMU movies metadata"""
+    return load_movies(CMU_MOVIES_PATH)
+
+
+def clean_stage(raw_movies: pd.DataFrame) -> pd.DataFrame:
+    """Clean the CMU movies"""
+    # Filter only observation with all needed features (without looking at box office revenue)
+    return clean_movies(raw_movies)
+
+
+async def revenue_stage(cleaned_movies: pd.DataFrame, session_pool: SessionPool) -> pd.DataFrame:
+    """Enrich the movies with their TMDB id and revenue"""
+    # Merge revenue from cmu and tmdb and drop nan
+    return clean_movies_revenue(await enhanced_with_revenue(cleaned_movies, 15000, session_pool.session(TMDB_BASE_URL)))
+
+
+async def composers_stage(movies: pd.DataFrame, session_pool: SessionPool) -> pd.DataFrame:
+    """Enrich the movies with their composers"""
+    return await enhanced_with_composer(movies, session=session_pool.session(TMDB_BASE_URL))
+
+
+async def spotify_composers_stage(clean_enrich_movies: pd.DataFrame, session_pool: SessionPool,
+                                  mapping_path: str = COMPOSER_MAPPING_PATH) -> pd.DataFrame:
+    """Match the composers to their Spotify artist and retrieve the artists, the composers already in the mapping csv
+    mapping_path are not matched again"""
+    _refresh_spotify_token()
+    return await get_music_dataset(get_composers(clean_enrich_movies), session_pool.session(SPOTIFY_BASE_URL),
+                                   mapping_path=mapping_path)
+
+
+async def albums_stage(clean_enrich_movies: pd.DataFrame, session_pool: SessionPool) -> pd.DataFrame:
+    """Search the Spotify album of the soundtrack of each movie"""
+    # Search the albums of every (movie, composer) pair, the pairs whose composer is not on Spotify are dropped by
+    # the tracks stage, so that the search does not wait for the Spotify composers lookup
+    composers_to_movies = create_db_to_link_composers_to_movies(clean_enrich_movies)
+    movie_names_and_date = composers_to_movies[
+        ["movie_name", "release_date", "movie_revenue", "composer_name"]].reset_index(drop=True)
+
+    _refresh_spotify_token()
+    return await get_album_ids_into_df(movie_names_and_date, save=False, session=session_pool.session(SPOTIFY_BASE_URL),
+                                       priority=movie_names_and_date.movie_revenue)
+
+
+async def tracks_stage(movie_albums_df: pd.DataFrame, spotify_composers_dataset: pd.DataFrame,
+                       session_pool: SessionPool) -> pd.DataFrame:
+    """Retrieve the track ids of the albums found"""
+    spotify_composers_dataset = link_legacy_composers(
+        spotify_composers_dataset, pd.DataFrame({'tmdb_name': movie_albums_df.composer_name.unique()}))
+    movie_albums_df = movie_albums_df[movie_albums_df.composer_name.isin(spotify_composers_dataset.tmdb_name)]
+
+    # clean the dataframe
+    movie_albums_df = movie_albums_df.dropna(subset=['album_id'])
+    movie_albums_df = movie_albums_df.drop_duplicates(subset=['movie_name'])
+
+    _refresh_spotify_token()
+    return await get_track_ids_into_df(movie_albums_df.copy(), save=False,
+                                       session=session_pool.session(SPOTIFY_BASE_URL))
+
+
+async def audio_features_stage(movie_albums_df: pd.DataFrame, session_pool: SessionPool,
+                               output_path: str = AUDIO_FEATURES_PATH) -> pd.DataFrame:
+    """Retrieve the audio features of the tracks, the tracks already in the table output_path are not requested
+    again"""
+    _refresh_spotify_token()
+    return await get_audio_features_of_tracks(explode_album_tracks(movie_albums_df).track_ids, output_path=output_path,
+                                              save=False, session=session_pool.session(SPOTIFY_BASE_URL))
+
+
+async def musics_stage(movie_albums_df: pd.DataFrame, session_pool: SessionPool) -> pd.DataFrame:
+    """Retrieve the musics of the tracks"""
+    _refresh_spotify_token()
+    return await get_music_from_track_ids(explode_album_tracks(movie_albums_df), save=False,
+                                          session=session_pool.session(SPOTIFY_BASE_URL))
+
+
+# Stages of the enrichment, the final datasets are stored at the paths used by the notebook
+STAGES = [
+    Stage('load', load_stage, os.path.join(PIPELINE_OUTPUT_DIR, 'raw_movies.pickle'),
+          code=[load_movies], sources=[CMU_MOVIES_PATH], intermediate=True),
+    Stage('clean', clean_stage, os.path.join(PIPELINE_OUTPUT_DIR, 'clean_movies.pickle'), ['load'],
+          code=[clean_movies], intermediate=True),
+    Stage('revenue', revenue_stage, os.path.join(PIPELINE_OUTPUT_DIR, 'clean_movies_revenue.pickle'), ['clean'],
+          code=[enhanced_with_revenue, clean_movies_revenue, TMDBDataLoader], intermediate=True),
+    Stage('composers', composers_stage, 'dataset/clean_enrich_movies.pickle', ['revenue'],
+          code=[enhanced_with_composer, TMDBDataLoader], export_csv=True),
+    Stage('spotify_composers', spotify_composers_stage, 'dataset/spotify_composers_dataset.pickle', ['composers'],
+          code=[get_composers, get_music_dataset, resolve_composers, match_composers, SpotifyDataLoader],
+          export_csv=True),
+    Stage('albums', albums_stage, 'dataset/movie_album_and_revenue.pickle', ['composers'],
+          code=[create_db_to_link_composers_to_movies, get_album_ids_into_df, best_matching_album_ids,
+                score_best_matching_albums, SpotifyDataLoader], export_csv=True),
+    Stage('tracks', tracks_stage, 'dataset/movie_album_and_revenue_with_track_ids.pickle',
+          ['albums', 'spotify_composers'], code=[get_track_ids_into_df, SpotifyDataLoader], export_csv=True),
+    Stage('musics', musics_stage, 'dataset/album_id_and_musics.pickle', ['tracks'],
+          code=[explode_album_tracks, get_music_from_track_ids, SpotifyDataLoader], export_csv=True),
+    Stage('audio_features', audio_features_stage, AUDIO_FEATURES_PATH, ['tracks'],
+          code=[explode_album_tracks, get_audio_features_of_tracks, SpotifyDataLoader]),
+]
+
+
+def _read_output(path: str) -> pd.DataFrame:
+    """Read the output of a stage, see Stage"""
+    return pd.read_parquet(path) if path.endswith('.parquet') else pd.read_pickle(path)
+
+
+def _write_output(result: pd.DataFrame, path: str):
+    """Write the output of a stage, see Stage"""
+    if path.endswith('.parquet'):
+        result.to_parquet(path, index=False)
+    else:
+        result.to_pickle(path)
+
+
+class Pipeline:
+    """
+    Class running a graph of stages, and caching their execution with their fingerprint
+
+    e.g. pipeline = Pipeline(STAGES)
+         pipeline.run(['albums'])
+    """
+
+    def __init__(self, stages: list[Stage], state_path: str = PIPELINE_STATE_PATH, max_workers: int = 4):
+        """
+        Parameters
+        ----------
+        stages: The stages of the pipeline, a stage should be declared after its dependencies
+        state_path: The json file storing the fingerprint of the last execution of each stage
+        max_workers: The maximum number of stages running at the same time
+        """
+        if max_workers < 1:
+            raise ValueError(f'At least one worker is needed to run the stages, got {max_workers}')
+
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            unknown = set(stage.dependencies) - self.stages.keys()
+            if unknown:
+                raise ValueError(f'Unknown dependencies {unknown} of stage {stage.name}')
+
+        self._state_path = state_path
+        self._max_workers = max_workers
+
+        # Measures of the stages executed by the last run
+        self.measures = {}
+
+        self._state = {}
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                self._state = json.load(f)
+
+    def _save_state(self):
+        """Store the fingerprints of the executed stages"""
+        os.makedirs(os.path.dirname(self._state_path) or '.', exist_ok=True)
+        with open(self._state_path, 'w') as f:
+            json.dump(self._state, f, indent=2)
+
+    def fingerprints(self) -> dict[str, str]:
+        """Compute the current fingerprint of each stage, from its code, its source files and the fingerprints of its
+        dependencies. It does not need the outputs of the stages, so that it can be computed before running anything
+
+        Returns
+        -------
+        The hexadecimal fingerprint of each stage, keyed by stage name
+        """
+        fingerprints = {}
+        for name, stage in self.stages.items():
+            digest = hashlib.sha256()
+            for code in [stage.function] + stage.code:
+                if isinstance(code, functools.partial):
+                    # The arguments bound to the function are part of its code
+                    digest.update(repr((code.args, sorted(code.keywords.items()))).encode())
+                    code = code.func
+                digest.update(inspect.getsource(code).encode())
+            for source in stage.sources:
+                if os.path.isfile(source):
+                    with open(source, 'rb') as f:
+                        digest.update(hashlib.sha256(f.read()).digest())
+                else:
+                    digest.update(f'missing {source}'.encode())
+            for dependency in stage.dependencies:
+                digest.update(fingerprints[dependency].encode())
+            fingerprints[name] = digest.hexdigest()
+
+        return fingerprints
+
+    def _upstream(self, names) -> set[str]:
+        """The given stages along with all the stages they depend on"""
+        result = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in result:
+                result.add(name)
+                to_visit += self.stages[name].dependencies
+
+        return result
+
+    def plan(self, targets: list[str] = None, force: list[str] = None) -> list[str]:
+        """List the stages to execute to bring the targets up to date
+
+        Parameters
+        ----------
+        targets: The stages to bring up to date, along with their dependencies, all the stages if None
+        force: The stages to execute even if they are up to date
+
+        Returns
+        -------
+        The names of the stages to execute, in the order of declaration
+        """
+        fingerprints = self.fingerprints()
+        considered = self._upstream(targets if targets else self.stages)
+        force = set(force or [])
+
+        to_run = {name for name in considered
+                  if name in force or self._state.get(name) != fingerprints[name]
+                  or (not os.path.isfile(self.stages[name].output) and not self.stages[name].intermediate)}
+
+        # A stage to execute needs the output of its dependencies, even the up-to-date ones
+        to_visit = list(to_run)
+        while to_visit:
+            for dependency in self.stages[to_visit.pop()].dependencies:
+                if dependency not in to_run and not os.path.isfile(self.stages[dependency].output):
+                    to_run.add(dependency)
+                    to_visit.append(dependency)
+
+        return [name for name in self.stages if name in to_run]
+
+    def adopt(self):
+        """Consider the stages whose output already exists as up to date, e.g. the datasets created before the
+        pipeline existed, so that they are not computed again. The intermediate stages are considered up to date as
+        well, their output is computed only if a dependent stage runs"""
+        fingerprints = self.fingerprints()
+        for name, stage in self.stages.items():
+            if os.path.isfile(stage.output) or stage.intermediate:
+                self._state[name] = fingerprints[name]
+                print(f'{name} adopted')
+
+        self._save_state()
+
+    async def _execute(self, stage: Stage, session_pool: SessionPool) -> str:
+        """Execute a stage and store its output. A coroutine stage runs in the event loop, the other stages run in a
+        worker thread, as well as the reading and writing of the pickles
+
+        Parameters
+        ----------
+        stage: The stage to execute
+        session_pool: The sessions shared by the stages of the run
+
+        Returns
+        -------
+        The name of the stage
+        """
+        start_time = time.time()
+        start_requests = session_pool.stats.nb_requests
+        inputs = [await asyncio.to_thread(_read_output, self.stages[dependency].output)
+                  for dependency in stage.dependencies]
+
+        # A stage is profiled in the thread running it, see profiling
+        if inspect.iscoroutinefunction(stage.function):
+            with profile_stage(stage.name):
+                result = await stage.function(*inputs, session_pool=session_pool)
+        else:
+            result = await asyncio.to_thread(profile_stage(stage.name)(stage.function), *inputs)
+
+        os.makedirs(os.path.dirname(stage.output) or '.', exist_ok=True)
+        await asyncio.to_thread(_write_output, result, stage.output)
+        if stage.export_csv:
+            await asyncio.to_thread(result.to_csv, stage.output.replace('.pickle', '.csv'))
+
+        self.measures[stage.name] = StageMeasure(time.time() - start_time,
+                                                 session_pool.stats.nb_requests - start_requests, len(result))
+        print(f'Stage {stage.name} done in {time.time() - start_time:.1f}s')
+        return stage.name
+
+    def run(self, targets: list[str] = None, force: list[str] = None):
+        """Execute the stages that are not up to date, running in parallel the stages whose dependencies are done
+
+        Parameters
+        ----------
+        targets: The stages to bring up to date, along with their dependencies, all the stages if None
+        force: The stages to execute even if they are up to date
+        """
+        self.measures = {}
+        asyncio.run(self._run(targets, force))
+
+    async def _run(self, targets: list[str], force: list[str]):
+        """Execute the stages in a single event loop, see run"""
+        start_time = time.time()
+        fingerprints = self.fingerprints()
+        to_run = self.plan(targets, force)
+        print(f'Stages to execute: {to_run}')
+
+        pending = list(to_run)
+        done, failed = set(), set()
+        async with SessionPool() as session_pool:
+            running = {}
+            while pending or running:
+                for name in list(pending):
+                    dependencies = set(self.stages[name].dependencies)
+                    if dependencies & failed:
+                        pending.remove(name)
+                        failed.add(name)
+                        print(f'Stage {name} skipped, one of its dependencies failed')
+                    elif (not (dependencies & set(pending)) and not (dependencies & set(running.values()))
+                          and len(running) < self._max_workers):
+                        pending.remove(name)
+                        running[asyncio.create_task(self._execute(self.stages[name], session_pool))] = name
+
+                if not running:
+                    # Nothing runs and nothing can start, e.g. stages waiting for each other, waiting would spin forever
+                    blocked = {name: sorted(set(self.stages[name].dependencies) & set(pending)) for name in pending}
+                    print(f'Stages {sorted(pending)} skipped, they wait for stages that cannot start: {blocked}')
+                    failed.update(pending)
+                    break
+
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    name = running.pop(task)
+                    try:
+                        task.result()
+                    except Exception as e:
+                        print(f'Error while executing stage {name}: {e}')
+                        failed.add(name)
+                        continue
+                    done.add(name)
+                    # Store the state after each stage, to keep the progress if a later stage fails
+                    self._state[name] = fingerprints[name]
+                    self._save_state()
+
+            print(session_pool.report())
+
+        print(f'Executed stages: {sorted(done)}, failed stages: {sorted(failed)}')
+        print(f'Elapsed time: {time.time() - start_time}')
+
+
+def sample_stage() -> pd.DataFrame:
+    """Load the sample of the cleaned movies drawn by run_sample"""
+    return pd.read_pickle(SAMPLE_MOVIES_PATH)
+
+
+def sample_stages(stages: list[Stage]) -> list[Stage]:
+    """The stages of a sample run: the cleaned movies are replaced by the sample, and all the outputs, along with the
+    composer mapping and the audio features table the stages read and extend, are written to SAMPLE_OUTPUT_DIR, so
+    that the datasets of the full run are neither reused nor modified
+
+    Parameters
+    ----------
+    stages: The stages of the full run
+
+    Returns
+    -------
+    The stages of the sample run
+    """
+    sampled = [Stage('clean', sample_stage, os.path.join(SAMPLE_OUTPUT_DIR, 'clean_movies.pickle'),
+                     sources=[SAMPLE_MOVIES_PATH])]
+    side_stores = {'spotify_composers': {'mapping_path': SAMPLE_MAPPING_PATH},
+                   'audio_features': {'output_path': SAMPLE_AUDIO_FEATURES_PATH}}
+    sampled += [dataclasses.replace(stage, output=os.path.join(SAMPLE_OUTPUT_DIR, os.path.basename(stage.output)),
+                                    function=functools.partial(stage.function, **side_stores[stage.name])
+                                    if stage.name in side_stores else stage.function,
+                                    export_csv=False, intermediate=False)
+                for stage in stages if stage.name not in ('load', 'clean')]
+    return sampled
+
+
+def sample_match_rates(pipeline: 'Pipeline') -> dict[str, float]:
+    """The match rates of a sample run, computed from the outputs of its stages
+
+    Parameters
+    ----------
+    pipeline: The pipeline of the sample run
+
+    Returns
+    -------
+    The share of the movies found on TMDB with a revenue, of the composers found on Spotify and of the (movie,
+    composer) pairs with a soundtrack album, keyed by description. The rates of the stages that failed are missing
+    """
+    outputs = {name: _read_output(stage.output) for name, stage in pipeline.stages.items()
+               if name in pipeline.measures}
+
+    rates = {}
+    if 'clean' in outputs and 'revenue' in outputs:
+        rates['movies found on TMDB with a revenue'] = len(outputs['revenue']) / max(len(outputs['clean']), 1)
+    if 'composers' in outputs and 'spotify_composers' in outputs:
+        nb_composers = len(get_composers(outputs['composers']))
+        rates['composers found on Spotify'] = len(outputs['spotify_composers']) / max(nb_composers, 1)
+    if 'albums' in outputs:
+        rates['soundtrack albums found'] = outputs['albums'].album_id.notna().mean()
+
+    return rates
+
+
+def run_sample(size: int, seed: int = 0):
+    """Run every stage on a stratified sample of the cleaned movies, and report the match rates, and the requests and
+    time of each stage along with their extrapolation to the whole dataset. The stages run one at a time, so that the
+    requests are attributed to their stage
+
+    Parameters
+    ----------
+    size: The number of movies of the sample
+    seed: The seed of the sample, so that two runs compare the same movies
+    """
+    movies = clean_stage(load_stage())
+    sample = stratified_sample(movies, size, seed)
+    os.makedirs(SAMPLE_OUTPUT_DIR, exist_ok=True)
+    sample.to_pickle(SAMPLE_MOVIES_PATH)
+    # Start from empty side stores, so that every composer is matched and every track requested by the sample run
+    for path in (SAMPLE_MAPPING_PATH, SAMPLE_AUDIO_FEATURES_PATH):
+        if os.path.isfile(path):
+            os.remove(path)
+    print(f'Sample of {len(sample)} movies out of {len(movies)}, stratified by decade and revenue bucket')
+
+    pipeline = Pipeline(sample_stages(STAGES), state_path=os.path.join(SAMPLE_OUTPUT_DIR, 'pipeline_state.json'),
+                        max_workers=1)
+    # A sample run always executes every stage, as it measures them
+    pipeline.run(force=list(pipeline.stages))
+
+    # The number of requests and the time of a stage grow with the number of movies, e.g. the composers shared by
+    # several movies make the extrapolation an upper bound for the composers stages
+    scale = len(movies) / max(len(sample), 1)
+    print(f'Sample run, extrapolated to the {len(movies)} movies (x{scale:.1f}):')
+    for name, measure in pipeline.measures.items():
+        print(f'  {name}: {measure.nb_rows} rows, {measure.nb_requests} requests in {measure.elapsed_time:.1f}s, '
+              f'full run about {measure.nb_requests * scale:.0f} requests in '
+              f'{measure.elapsed_time * scale / 60:.1f}min')
+
+    total_requests = sum(measure.nb_requests for measure in pipeline.measures.values())
+    total_time = sum(measure.elapsed_time for measure in pipeline.measures.values())
+    print(f'  total: {total_requests} requests in {total_time:.1f}s, full run about {total_requests * scale:.0f} '
+          f'requests in {total_time * scale / 3600:.1f}h')
+
+    for description, rate in sample_match_rates(pipeline).items():
+        print(f'  {description}: {rate:.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the enrichment pipeline')
+    parser.add_argument('stages', nargs='*', help='stages to bring up to date, all of them by default')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to execute even if they are up to date')
+    parser.add_argument('--adopt', action='store_true',
+                        help='consider the existing datasets as up to date, without executing anything')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of stages running at the same time')
+    parser.add_argument('--sample', type=int,
+                        help='run every stage on a stratified sample of this number of movies, and extrapolate the '
+                             'full run cost')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sample')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the CPU and memory of each stage, the reports are written to dataset/profiles. '
+                             'The stages run one at a time, so that each one is profiled alone')
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling()
+        args.workers = 1
+
+    if args.sample:
+        run_sample(args.sample, args.seed)
+    else:
+        pipeline = Pipeline(STAGES, max_workers=args.workers)
+        if args.adopt:
+            pipeline.adopt()
+        else:
+            pipeline.run(args.stages, args.force)
@@ -0,0 +1,261 @@
+"""
+Opt-in profiling of the enrichment and analysis stages. A stage wrapped by profile_stage, as a decorator or a context
+manager, is profiled only when the profiling is enabled, either by the --profile option of the scripts or by the
+PROFILE_STAGES environment variable giving the directory of the reports:
+
+    PROFILE_STAGES=dataset/profiles python enrich_movie_data.py
+
+For each stage, the wall and CPU time, the cProfile stacks and the tracemalloc peak and top allocators are captured,
+and written to <stage>.html along with the share of the time spent in pandas, numpy, rapidfuzz, JSON, pickle and the
+network (including the waits of the event loop). The raw stacks are written to <stage>.prof, to be browsed as a
+flamegraph, e.g. with snakeviz.
+
+A single stage is profiled at a time: a stage starting while another one is profiled (e.g. a stage calling another
+profiled function, or two stages running in parallel) is not profiled on its own. cProfile only sees the thread
+enabling it, so a stage should be wrapped in the thread running it, the work it sends to other threads is missed.
+"""
+import cProfile
+import functools
+import html
+import inspect
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+# Environment variable enabling the profiling, holding the directory of the reports. It is inherited by the worker
+# processes, so that the stages they run are profiled as well
+PROFILE_ENV = 'PROFILE_STAGES'
+
+PROFILE_OUTPUT_DIR = 'dataset/profiles'
+
+# Number of functions and of allocation sites listed in a report
+NB_TOP = 25
+
+# Frames kept by tracemalloc for each allocation
+NB_TRACEBACK_FRAMES = 5
+
+# Category of a function, from its file or its name for the builtins, the first matching category wins
+CATEGORIES = [
+    ('network', ('/aiohttp/', '/asyncio/', '/selectors.py', '/ssl.py', '/socket.py', '/multidict/', '/yarl/',
+                 "'select.", "'_ssl.")),
+    ('json', ('/json/', '_json.')),
+    ('pickle', ('/pickle.py', '_pickle.')),
+    ('rapidfuzz', ('/rapidfuzz/', 'rapidfuzz.')),
+    ('pandas', ('/pandas/', 'pandas.')),
+    ('numpy', ('/numpy/', 'numpy.')),
+    ('plotly', ('/plotly/',)),
+]
+
+# Only one stage is profiled at a time, as cProfile and tracemalloc are process wide
+_lock = threading.Lock()
+
+
+def enable_profiling(output_dir: str = PROFILE_OUTPUT_DIR):
+    """Enable the profiling of the stages
+
+    Parameters
+    ----------
+    output_dir: The directory where to write the reports
+    """
+    os.environ[PROFILE_ENV] = output_dir
+
+
+def profiling_enabled() -> bool:
+    """Whether the profiling of the stages is enabled"""
+    return bool(os.environ.get(PROFILE_ENV))
+
+
+def categorize(filename: str, function_name: str) -> str:
+    """The category of a function of a cProfile
+
+    Parameters
+    ----------
+    filename: The file of the function, '~' for a builtin
+    function_name: The name of the function, e.g. "<method 'poll' of 'select.epoll' objects>" for a builtin
+
+    Returns
+    -------
+    The category of the function, 'other' if it does not match any of CATEGORIES
+    """
+    location = function_name if filename == '~' else filename.replace(os.sep, '/')
+    for category, patterns in CATEGORIES:
+        if any(pattern in location for pattern in patterns):
+            return category
+    return 'other'
+
+
+@dataclass
+class StageProfile:
+    """Measures of a profiled stage"""
+    name: str
+    wall_time: float = 0
+    cpu_time: float = 0
+    # Peak of the memory traced during the stage, in bytes
+    memory_peak: int = 0
+    # Own time of the functions, summed by category
+    category_times: dict[str, float] = field(default_factory=dict)
+    # (function, number of calls, own time, cumulative time) of the functions with the highest cumulative time
+    top_functions: list[tuple[str, int, float, float]] = field(default_factory=list)
+    # (allocation site, size in bytes, number of blocks) of the largest allocations still alive at the end of the stage
+    top_allocations: list[tuple[str, int, int]] = field(default_factory=list)
+
+    def report(self) -> str:
+        total = sum(self.category_times.values()) or 1
+        categories = ', '.join(f'{category} {duration / total:.0%}' for category, duration
+                               in sorted(self.category_times.items(), key=lambda item: -item[1]))
+        return (f'{self.name}: {self.wall_time:.1f}s wall, {self.cpu_time:.1f}s CPU, '
+                f'{self.memory_peak / 2 ** 20:.1f}MiB peak ({categories})')
+
+    def to_html(self) -> str:
+        """The report of the stage as a standalone HTML page"""
+        total = sum(self.category_times.values()) or 1
+        categories = ''.join(f'<tr><td>{category}</td><td>{duration:.3f}</td><td>{duration / total:.1%}</td></tr>'
+                             for category, duration in sorted(self.category_times.items(), key=lambda item: -item[1]))
+        functions = ''.join(f'<tr><td>{html.escape(function)}</td><td>{nb_calls}</td><td>{own_time:.3f}</td>'
+                            f'<td>{cumulative_time:.3f}</td></tr>'
+                            for function, nb_calls, own_time, cumulative_time in self.top_functions)
+        allocations = ''.join(f'<tr><td>{html.escape(site)}</td><td>{size / 2 ** 10:.1f}</td><td>{nb_blocks}</td></tr>'
+                              for site, size, nb_blocks in self.top_allocations)
+        return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Profile of {html.escape(self.name)}</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; margin-bottom: 2em; }}
+td, th {{ border: 1px solid #ccc; padding: 2px 8px; text-align: right; }}
+td:first-child {{ text-align: left; font-family: monospace; }}
+</style>
+</head>
+<body>
+<h1>Profile of {html.escape(self.name)}</h1>
+<p>Wall time {self.wall_time:.3f}s, CPU time {self.cpu_time:.3f}s, memory peak {self.memory_peak / 2 ** 20:.1f}MiB.
+The stacks are in {html.escape(self.name)}.prof, e.g. <code>snakeviz {html.escape(self.name)}.prof</code></p>
+<h2>Time by category</h2>
+<table><tr><th>Category</th><th>Own time (s)</th><th>Share</th></tr>{categories}</table>
+<h2>Top functions by cumulative time</h2>
+<table><tr><th>Function</th><th>Calls</th><th>Own time (s)</th><th>Cumulative time (s)</th></tr>{functions}</table>
+<h2>Top allocation sites alive at the end of the stage</h2>
+<table><tr><th>Site</th><th>Size (KiB)</th><th>Blocks</th></tr>{allocations}</table>
+</body>
+</html>
+"""
+
+
+def _summarize(name: str, profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot, wall_time: float,
+               cpu_time: float, memory_peak: int) -> StageProfile:
+    """Summarize the raw measures of a stage
+
+    Parameters
+    ----------
+    name: The name of the stage
+    profiler: The disabled profiler of the stage
+    snapshot: The tracemalloc snapshot taken at the end of the stage
+    wall_time: The wall time of the stage, in seconds
+    cpu_time: The CPU time of the process during the stage, in seconds
+    memory_peak: The peak of the memory traced during the stage, in bytes
+
+    Returns
+    -------
+    The profile of the stage
+    """
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+
+    category_times = {}
+    for (filename, _, function_name), (_, _, own_time, _, _) in stats.stats.items():
+        category = categorize(filename, function_name)
+        category_times[category] = category_times.get(category, 0) + own_time
+
+    top_functions = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:NB_TOP]
+    top_functions = [(pstats.func_std_string(function), nb_calls, own_time, cumulative_time)
+                     for function, (_, nb_calls, own_time, cumulative_time, _) in top_functions]
+
+    top_allocations = [(str(statistic.traceback[0]), statistic.size, statistic.count)
+                       for statistic in snapshot.statistics('lineno')[:NB_TOP]]
+
+    return StageProfile(name, wall_time, cpu_time, memory_peak, category_times, top_functions, top_allocations)
+
+
+class profile_stage:
+    """
+    Profile a stage when the profiling is enabled (see enable_profiling), as a context manager or a decorator of a
+    function or a coroutine function. It does nothing otherwise
+
+    e.g. @profile_stage('revenue')
+         async def enhanced_with_revenue(movies):
+
+         with profile_stage('figure_Q7_popularity_histogram'):
+             fig = function(data)
+    """
+
+    def __init__(self, name: str):
+        """
+        Parameters
+        ----------
+        name: The name of the stage, also the name of its report files
+        """
+        self.name = name
+        self.profile = None
+        self._profiler = None
+
+    def __call__(self, function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with profile_stage(self.name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with profile_stage(self.name):
+                    return function(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        if not profiling_enabled() or not _lock.acquire(blocking=False):
+            return self
+
+        self._was_tracing = tracemalloc.is_tracing()
+        if not self._was_tracing:
+            tracemalloc.start(NB_TRACEBACK_FRAMES)
+        tracemalloc.reset_peak()
+        self._start_wall_time = time.perf_counter()
+        self._start_cpu_time = time.process_time()
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._profiler is None:
+            return
+
+        try:
+            self._profiler.disable()
+            wall_time = time.perf_counter() - self._start_wall_time
+            cpu_time = time.process_time() - self._start_cpu_time
+            memory_peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+            if not self._was_tracing:
+                tracemalloc.stop()
+
+            self.profile = _summarize(self.name, self._profiler, snapshot, wall_time, cpu_time, memory_peak)
+            self._write_reports()
+        finally:
+            self._profiler = None
+            _lock.release()
+
+    def _write_reports(self):
+        """Write the HTML report and the stacks of the stage in the profiling directory"""
+        output_dir = os.environ[PROFILE_ENV]
+        os.makedirs(output_dir, exist_ok=True)
+        self._profiler.dump_stats(os.path.join(output_dir, f'{self.name}.prof'))
+        with open(os.path.join(output_dir, f'{self.name}.html'), 'w', encoding='utf-8') as f:
+            f.write(self.profile.to_html())
+
+        print(f'Profile of {self.profile.report()}, written to {output_dir}')
@@ -0,0 +1,492 @@
+"""
+Read-only local HTTP service over the enriched datasets, so that the website build, the notebooks and the teammates
+query them instead of each unpickling and filtering them in pandas:
+
+    python query_service.py [--port 8000] [--datasets-path dataset]
+    python query_service.py --benchmark [--requests 5000] [--concurrency 32]
+
+The movies and the Spotify composers are loaded once, and indexed by composer, tmdb id, year and genre. The answers
+are JSON, the lists being paginated with the page and page_size parameters:
+
+    GET /movies?composer=1729&year=2009&genre=thriller&page=1&page_size=50   movies matching all the given filters
+    GET /movies/19995                                                           a movie by tmdb id
+    GET /composers/1729                                                         a TMDB composer and its Spotify artist
+    GET /revenue_by_year?composer=1729&genre=drama                              box office revenue by release year
+
+The movies are listed in the order of the dataset, by decreasing box office revenue. The answers are kept in an LRU
+cache, and --benchmark measures the latency percentiles of typical queries under concurrent load.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import aiohttp
+import numpy as np
+import pandas as pd
+
+from composer_matching import normalize_person_name
+
+# Number of movies of a page when page_size is not given, and maximum page_size
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Number of answers kept in the LRU cache
+CACHE_SIZE = 4096
+
+# Filters of the movies, see MovieIndex.select
+FILTERS = ('composer', 'year', 'genre')
+
+
+class QueryError(Exception):
+    """Error of a query, answered with its HTTP status"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _release_year(release_date: str) -> int:
+    """The year of a release date, e.g. 2009 for '2009' or '2009-12-10', -1 if missing"""
+    return int(release_date[:4]) if isinstance(release_date, str) and release_date[:4].isdigit() else -1
+
+
+def _to_json(value):
+    """Convert a dataset value to a JSON value, a missing value being None"""
+    if isinstance(value, (list, np.ndarray)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _positions_by_key(keys: pd.Series) -> dict:
+    """Index the movies by key
+
+    Parameters
+    ----------
+    keys: The key, or the list of keys, of each movie, indexed by the position of the movie
+
+    Returns
+    -------
+    The sorted positions of the movies of each key
+    """
+    keys = keys.explode().dropna()
+    return {key: np.unique(keys.index[positions].to_numpy()) for key, positions in
+            keys.groupby(keys.to_numpy()).indices.items()}
+
+
+class MovieIndex:
+    """
+    In-memory indexes of the enriched movies and of the Spotify composers
+
+    e.g. index = MovieIndex.load('dataset')
+         positions = index.select({'composer': '1729', 'genre': 'drama'})
+    """
+
+    def __init__(self, movies: pd.DataFrame, spotify_composers: pd.DataFrame):
+        """
+        Parameters
+        ----------
+        movies: The enriched movies, see enrich_movie_data
+        spotify_composers: The composers found on Spotify, see enrich_music_data
+        """
+        movies = movies.reset_index(drop=True)
+        self._years = movies.release_date.map(_release_year).to_numpy()
+        self._revenues = movies.box_office_revenue.to_numpy(dtype='float64')
+
+        # The movies are converted once to JSON values, the answers only select them
+        composers = movies.composers.map(lambda composers: list(composers) if isinstance(composers, list) else [])
+        self._movies = [{
+            'tmdb_id': None if pd.isna(tmdb_id) else int(tmdb_id),
+            'name': name,
+            'year': None if year < 0 else int(year),
+            'box_office_revenue': _to_json(revenue),
+            'countries': _to_json(countries),
+            'genres': _to_json(genres),
+            'composers': [{'id': str(composer.id), 'name': composer.name} for composer in movie_composers],
+        } for tmdb_id, name, year, revenue, countries, genres, movie_composers in
+            zip(movies.tmdb_id, movies.name, self._years, self._revenues, movies.countries, movies.genres, composers)]
+
+        self._by_tmdb_id = {movie['tmdb_id']: position for position, movie in enumerate(self._movies)
+                            if movie['tmdb_id'] is not None}
+        self._by_year = _positions_by_key(pd.Series(self._years))
+        self._by_genre = _positions_by_key(movies.genres.map(
+            lambda genres: [genre.lower() for genre in genres] if isinstance(genres, list) else []))
+        self._by_composer = _positions_by_key(composers.map(
+            lambda movie_composers: [str(composer.id) for composer in movie_composers]))
+
+        self._composers = {str(composer.id): composer for movie_composers in composers
+                           for composer in movie_composers}
+        # The Spotify artist of a composer, by TMDB id, or by name for the datasets created before the explicit mapping
+        if 'tmdb_person_id' in spotify_composers:
+            self._spotify_by_composer = {str(row.tmdb_person_id): row for row in spotify_composers.itertuples()}
+        else:
+            ids_by_name = self._composer_ids_by_name()
+            self._spotify_by_composer = {composer_id: row for row in spotify_composers.itertuples()
+                                         for composer_id in ids_by_name.get(normalize_person_name(row.name), [])}
+
+    @classmethod
+    def load(cls, datasets_path: str = 'dataset') -> 'MovieIndex':
+        """Load and index the enriched datasets
+
+        Parameters
+        ----------
+        datasets_path: The directory containing clean_enrich_movies.pickle and spotify_composers_dataset.pickle
+
+        Returns
+        -------
+        The index of the datasets
+        """
+        movies = pd.read_pickle(os.path.join(datasets_path, 'clean_enrich_movies.pickle'))
+        spotify_composers = pd.read_pickle(os.path.join(datasets_path, 'spotify_composers_dataset.pickle'))
+        return cls(movies, spotify_composers)
+
+    def __len__(self) -> int:
+        return len(self._movies)
+
+    def _composer_ids_by_name(self) -> dict[str, list[str]]:
+        """The TMDB ids of the composers of each normalized name"""
+        ids_by_name = {}
+        for composer_id, composer in self._composers.items():
+            ids_by_name.setdefault(normalize_person_name(composer.name), []).append(composer_id)
+        return ids_by_name
+
+    def select(self, filters: dict[str, str]) -> np.ndarray:
+        """Select the movies matching all the filters
+
+        Parameters
+        ----------
+        filters: The TMDB id of a composer, a release year and a genre (case insensitive), keyed by filter name. A
+        missing filter selects all the movies
+
+        Returns
+        -------
+        The sorted positions of the movies
+        """
+        positions = None
+        for name in FILTERS:
+            if name not in filters:
+                continue
+            if name == 'year':
+                try:
+                    matching = self._by_year.get(int(filters[name]))
+                except ValueError:
+                    raise QueryError(400, f'Invalid year: {filters[name]}')
+            elif name == 'genre':
+                matching = self._by_genre.get(filters[name].lower())
+            else:
+                matching = self._by_composer.get(filters[name])
+
+            if matching is None:
+                return np.empty(0, dtype=int)
+            positions = matching if positions is None else np.intersect1d(positions, matching, assume_unique=True)
+
+        return np.arange(len(self._movies)) if positions is None else positions
+
+    def movies(self, positions: np.ndarray) -> list[dict]:
+        """The JSON values of the movies at the given positions"""
+        return [self._movies[position] for position in positions]
+
+    def movie(self, tmdb_id: int) -> dict:
+        """The JSON value of a movie, None if there is no such movie"""
+        position = self._by_tmdb_id.get(tmdb_id)
+        return None if position is None else self._movies[position]
+
+    def composer(self, composer_id: str) -> dict:
+        """The JSON value of a TMDB composer along with its Spotify artist, None if there is no such composer"""
+        composer = self._composers.get(composer_id)
+        if composer is None:
+            return None
+
+        spotify = self._spotify_by_composer.get(composer_id)
+        return {
+            'id': composer_id,
+            'name': composer.name,
+            'birthday': composer.birthday,
+            'place_of_birth': composer.place_of_birth,
+            'nb_movies': len(self._by_composer.get(composer_id, [])),
+            'spotify': None if spotify is None else {
+                'id': spotify.id,
+                'name': spotify.name,
+                'genres': _to_json(spotify.genres),
+                'followers': int(spotify.followers),
+                'popularity': int(spotify.popularity),
+            },
+        }
+
+    def revenue_by_year(self, positions: np.ndarray) -> list[dict]:
+        """The number of movies and the total box office revenue by release year of the movies at the given positions,
+        by increasing year"""
+        years, inverse = np.unique(self._years[positions], return_inverse=True)
+        revenues = self._revenues[positions]
+        known = ~np.isnan(revenues)
+        nb_movies = np.bincount(inverse, minlength=len(years))
+        totals = np.bincount(inverse[known], weights=revenues[known], minlength=len(years))
+        return [{'year': int(year), 'nb_movies': int(count), 'box_office_revenue': float(total)}
+                for year, count, total in zip(years, nb_movies, totals) if year >= 0]
+
+    def sample_paths(self, nb_paths: int, seed: int = 0) -> list[str]:
+        """Typical queries of the service, used by the benchmark
+
+        Parameters
+        ----------
+        nb_paths: The number of queries
+        seed: The seed of the random choice of the queries
+
+        Returns
+        -------
+        The paths of the queries
+        """
+        rng = random.Random(seed)
+        composer_ids = list(self._by_composer)
+        years = [year for year in self._by_year if year >= 0]
+        genres = list(self._by_genre)
+        tmdb_ids = list(self._by_tmdb_id)
+        queries = [
+            lambda: f'/movies?composer={rng.choice(composer_ids)}',
+            lambda: f'/composers/{rng.choice(composer_ids)}',
+            lambda: f'/revenue_by_year?composer={rng.choice(composer_ids)}',
+            lambda: f'/revenue_by_year?genre={rng.choice(genres)}',
+            lambda: f'/movies?year={rng.choice(years)}&page={rng.randint(1, 3)}',
+            lambda: f'/movies?genre={rng.choice(genres)}&year={rng.choice(years)}',
+            lambda: f'/movies/{rng.choice(tmdb_ids)}',
+        ]
+        return [rng.choice(queries)() for _ in range(nb_paths)]
+
+
+def _paginate(items: list, query: dict[str, str]) -> dict:
+    """The page of a list asked by the page and page_size parameters of a query"""
+    try:
+        page = int(query.get('page', 1))
+        page_size = int(query.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise QueryError(400, 'page and page_size must be integers')
+    if page < 1 or not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise QueryError(400, f'page must be at least 1 and page_size between 1 and {MAX_PAGE_SIZE}')
+
+    start = (page - 1) * page_size
+    return {'total': len(items), 'page': page, 'page_size': page_size, 'items': items[start:start + page_size]}
+
+
+class QueryService:
+    """
+    Answers of the queries, kept in an LRU cache
+    """
+
+    def __init__(self, index: MovieIndex, cache_size: int = CACHE_SIZE):
+        """
+        Parameters
+        ----------
+        index: The indexed datasets
+        cache_size: The number of answers kept in the cache
+        """
+        self.index = index
+        self.respond = functools.lru_cache(maxsize=cache_size)(self._respond)
+
+    def _respond(self, path: str, query: tuple[tuple[str, str], ...]) -> tuple[int, bytes]:
+        """Answer a query
+
+        Parameters
+        ----------
+        path: The path of the query, e.g. '/movies'
+        query: The sorted parameters of the query
+
+        Returns
+        -------
+        The HTTP status and the JSON body of the answer
+        """
+        try:
+            body = self._route(path.rstrip('/').split('/')[1:], dict(query))
+            status = 200
+        except QueryError as e:
+            body = {'error': str(e)}
+            status = e.status
+        return status, json.dumps(body).encode()
+
+    def _route(self, parts: list[str], query: dict[str, str]):
+        """The JSON value answering a query, see the routes in the module docstring"""
+        filters = {name: value for name, value in query.items() if name in FILTERS}
+
+        if parts == ['movies']:
+            return _paginate(self.index.movies(self.index.select(filters)), query)
+        if parts == ['revenue_by_year']:
+            return _paginate(self.index.revenue_by_year(self.index.select(filters)), query)
+        if len(parts) == 2 and parts[0] == 'movies':
+            try:
+                movie = self.index.movie(int(parts[1]))
+            except ValueError:
+                raise QueryError(400, f'Invalid tmdb id: {parts[1]}')
+            if movie is None:
+                raise QueryError(404, f'No movie with the tmdb id {parts[1]}')
+            return movie
+        if len(parts) == 2 and parts[0] == 'composers':
+            composer = self.index.composer(parts[1])
+            if composer is None:
+                raise QueryError(404, f'No composer with the id {parts[1]}')
+            return composer
+
+        raise QueryError(404, f'Unknown route: /{"/".join(parts)}')
+
+    def report(self) -> str:
+        cache_info = self.respond.cache_info()
+        nb_queries = cache_info.hits + cache_info.misses
+        return (f'{nb_queries} queries, {cache_info.hits / max(nb_queries, 1):.0%} answered from the cache '
+                f'({cache_info.currsize} answers cached)')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 connections drops the connections of a burst of clients, which retry a second later
+    request_queue_size = 128
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # Keeps the connections alive between the requests of a client
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, Nagle's algorithm would delay the body until the headers are
+    # acknowledged, i.e. by about 40ms
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        status, body = self.server.service.respond(url.path, tuple(sorted(parse_qsl(url.query))))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request would slow down the service under load
+        pass
+
+
+def create_server(service: QueryService, host: str = 'localhost', port: int = 8000) -> ThreadingHTTPServer:
+    """Create the HTTP server of a service, each request being answered in its own thread
+
+    Parameters
+    ----------
+    service: The service answering the queries
+    host: The host to listen on
+    port: The port to listen on, any free port if 0
+
+    Returns
+    -------
+    The server, not started
+    """
+    server = _Server((host, port), _RequestHandler)
+    server.service = service
+    return server
+
+
+@dataclass
+class LatencyReport:
+    """Latencies of a benchmark, in seconds"""
+    nb_requests: int
+    nb_errors: int
+    elapsed_time: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+    def report(self) -> str:
+        return (f'{self.nb_requests} requests ({self.nb_errors} errors) in {self.elapsed_time:.1f}s, '
+                f'{self.nb_requests / self.elapsed_time:.0f} requests/s, latency p50 {self.p50 * 1000:.1f}ms, '
+                f'p95 {self.p95 * 1000:.1f}ms, p99 {self.p99 * 1000:.1f}ms, max {self.max * 1000:.1f}ms')
+
+
+async def benchmark(base_url: str, paths: list[str], concurrency: int = 32) -> LatencyReport:
+    """Measure the latency of queries sent by concurrent clients
+
+    Parameters
+    ----------
+    base_url: The url of the service, e.g. 'http://localhost:8000'
+    paths: The paths of the queries, each one sent once
+    concurrency: The number of clients sending their queries at the same time
+
+    Returns
+    -------
+    The latencies of the queries
+    """
+    latencies = []
+    nb_errors = 0
+    remaining = iter(paths)
+
+    async def client(session: aiohttp.ClientSession):
+        nonlocal nb_errors
+        for path in remaining:
+            start_time = time.perf_counter()
+            async with session.get(base_url + path) as response:
+                await response.read()
+                if response.status >= 500:
+                    nb_errors += 1
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+    elapsed_time = time.perf_counter() - start_time
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return LatencyReport(len(latencies), nb_errors, elapsed_time, p50, p95, p99, max(latencies))
+
+
+def run_benchmark(service: QueryService, nb_requests: int = 5000, concurrency: int = 32):
+    """Serve the datasets on a free port, and benchmark typical queries sent by concurrent clients
+
+    Parameters
+    ----------
+    service: The service answering the queries
+    nb_requests: The number of queries sent
+    concurrency: The number of clients sending their queries at the same time
+    """
+    server = create_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        host, port = server.server_address[:2]
+        latencies = asyncio.run(benchmark(f'http://{host}:{port}', service.index.sample_paths(nb_requests),
+                                          concurrency))
+        print(latencies.report())
+        print(service.report())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the enriched datasets as JSON over HTTP')
+    parser.add_argument('--host', default='localhost', help='host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--datasets-path', default='dataset', help='directory containing the datasets')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help='number of answers kept in the cache')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='measure the latency of typical queries under concurrent load, instead of serving')
+    parser.add_argument('--requests', type=int, default=5000, help='number of queries sent by the benchmark')
+    parser.add_argument('--concurrency', type=int, default=32, help='number of concurrent clients of the benchmark')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    query_service = QueryService(MovieIndex.load(args.datasets_path), args.cache_size)
+    print(f'{len(query_service.index)} movies indexed in {time.time() - start_time:.1f}s')
+
+    if args.benchmark:
+        run_benchmark(query_service, args.requests, args.concurrency)
+    else:
+        http_server = create_server(query_service, args.host, args.port)
+        print(f'Serving on http://{args.host}:{args.port}')
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            print(query_service.report())
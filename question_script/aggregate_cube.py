@@ -0,0 +1,202 @@
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from composer_matching import link_legacy_composers
+from question_script.question_helper import drop_incomplete_movies, year_bin_label
+
+# Dimensions of the cube, in the order used for the grouping sets
+DIMENSIONS = ['composer_name', 'year_bin', 'genre', 'country']
+
+# Measures computed for each cell of the cube
+MEASURES = ['nb_movies', 'revenue_sum', 'revenue_mean', 'popularity_mean', 'popularity_max']
+
+# Value stored in a dimension that has been rolled up
+ALL = '*'
+
+
+class AggregateCube:
+    """
+    Class representing the materialized composer x year bin x genre x country aggregate cube
+
+    Every grouping set of the dimensions is precomputed, so that the number of movies and the revenue are counted once
+    per distinct movie at any level of aggregation. A rolled up dimension holds the ALL value
+
+    e.g. cube = AggregateCube.build(clean_enrich_movies, spotify_composers_dataset)
+         cube.save('dataset/aggregate_cube.parquet')
+         cube.query(['composer_name', 'year_bin'], composer_name=['John Williams', 'Hans Zimmer'])
+    """
+
+    def __init__(self, cells: pd.DataFrame):
+        """
+        Parameters
+        ----------
+        cells: One row per cell of the cube, with the DIMENSIONS, MEASURES and 'grouping_set' columns
+        """
+        self.cells = cells
+        # Split the cells per grouping set once, so that a query only has to filter a single small dataframe
+        self._grouping_sets = {grouping_set: cells_set.reset_index(drop=True)
+                               for grouping_set, cells_set in cells.groupby('grouping_set')}
+
+    @staticmethod
+    def _grouping_set_id(dimensions) -> int:
+        """Bit mask identifying a grouping set, bit i is set when DIMENSIONS[i] is kept"""
+        return sum(1 << DIMENSIONS.index(dimension) for dimension in dimensions)
+
+    @staticmethod
+    def _base_table(movies: pd.DataFrame, spotify_composers: pd.DataFrame, bin_size: int) -> pd.DataFrame:
+        """Explode the movies to one row per (movie, composer, genre, country). The movies are filtered and binned as in
+        create_top_composers_dataset, so that the cube counts the same movies as the question 3 dataset"""
+        movies = drop_incomplete_movies(movies)
+        base = pd.DataFrame({'movie': np.arange(len(movies)),
+                             'year_bin': year_bin_label(movies.release_date, bin_size).to_numpy(),
+                             'box_office_revenue': movies.box_office_revenue.to_numpy(dtype=np.float64),
+                             'composer_name': movies.composers.apply(
+                                 lambda composers: [c.name for c in composers] if isinstance(composers, list) else []
+                             ).to_numpy(),
+                             'genre': movies.genres.to_numpy(),
+                             'country': movies.countries.to_numpy()})
+
+        for column in ['composer_name', 'genre', 'country']:
+            base = base.explode(column)
+
+        # Spotify popularity of the composer, through the TMDB name of the artist matched to it
+        spotify_composers = link_legacy_composers(spotify_composers,
+                                                  pd.DataFrame({'tmdb_name': base.composer_name.dropna().unique()}))
+        popularity = spotify_composers.groupby('tmdb_name')['popularity'].max()
+        base['popularity'] = base.composer_name.map(popularity).astype(np.float64)
+
+        return base.reset_index(drop=True)
+
+    @classmethod
+    def build(cls, movies: pd.DataFrame, spotify_composers: pd.DataFrame, bin_size: int = 5) -> 'AggregateCube':
+        """Build the cube from the enriched datasets
+
+        Parameters
+        ----------
+        movies: The enriched movies dataframe (clean_enrich_movies)
+        spotify_composers: The spotify composers dataframe (spotify_composers_dataset), used for the popularity
+        bin_size: The number of years in each year bin
+
+        Returns
+        -------
+        The aggregate cube
+        """
+        base = cls._base_table(movies, spotify_composers, bin_size)
+
+        cells = []
+        for nb_dimensions in range(len(DIMENSIONS) + 1):
+            for dimensions in combinations(DIMENSIONS, nb_dimensions):
+                dimensions = list(dimensions)
+
+                # Each movie should be counted once per cell, whatever the number of values of the other dimensions
+                movies_set = base.drop_duplicates(subset=['movie'] + dimensions)
+                # Group on a constant key for the grand total
+                keys_movies = dimensions if dimensions else np.zeros(len(movies_set), dtype=np.int8)
+                revenue = movies_set.groupby(keys_movies).agg(
+                    nb_movies=('movie', 'size'),
+                    revenue_sum=('box_office_revenue', 'sum'),
+                    revenue_mean=('box_office_revenue', 'mean'))
+
+                # The popularity belongs to the composer, so count each composer once per movie
+                composers_set = base.dropna(subset='composer_name').drop_duplicates(
+                    subset=['movie', 'composer_name'] + dimensions)
+                keys_composers = dimensions if dimensions else np.zeros(len(composers_set), dtype=np.int8)
+                popularity = composers_set.groupby(keys_composers).agg(
+                    popularity_mean=('popularity', 'mean'),
+                    popularity_max=('popularity', 'max'))
+
+                cells_set = revenue.join(popularity, how='left')
+                cells_set = cells_set.reset_index(drop=not dimensions)
+                for dimension in DIMENSIONS:
+                    if dimension not in dimensions:
+                        cells_set[dimension] = ALL
+                cells_set['grouping_set'] = cls._grouping_set_id(dimensions)
+                cells.append(cells_set[DIMENSIONS + MEASURES + ['grouping_set']])
+
+        return cls(pd.concat(cells, ignore_index=True).astype({dimension: str for dimension in DIMENSIONS}))
+
+    def save(self, path: str = 'dataset/aggregate_cube.parquet'):
+        """Store the cube as a parquet file
+
+        Parameters
+        ----------
+        path: The path of the parquet file
+        """
+        self.cells.to_parquet(path, index=False)
+
+    @classmethod
+    def load(cls, path: str = 'dataset/aggregate_cube.parquet') -> 'AggregateCube':
+        """Load a cube stored with save
+
+        Parameters
+        ----------
+        path: The path of the parquet file
+
+        Returns
+        -------
+        The aggregate cube
+        """
+        return cls(pd.read_parquet(path))
+
+    def query(self, by: list[str] = None, **filters) -> pd.DataFrame:
+        """Roll up the cube to the given dimensions, and slice it on the given values, e.g.
+        cube.query(['year_bin'], composer_name='Hans Zimmer') returns the measures per year bin for Hans Zimmer
+
+        Parameters
+        ----------
+        by: The dimensions to keep, all the others are rolled up
+        filters: The value, or list of values, to keep for a dimension, keyed by dimension name. A filtered dimension
+        is kept in the result, even if it is not listed in by
+
+        Returns
+        -------
+        A dataframe indexed by the kept dimensions (by first, then the filtered ones), with the MEASURES as columns
+        """
+        by = list(by) if by else []
+        kept = by + [dimension for dimension in filters if dimension not in by]
+
+        unknown = set(kept) - set(DIMENSIONS)
+        if unknown:
+            raise ValueError(f'Unknown dimensions {unknown}, should be in {DIMENSIONS}')
+
+        cells = self._grouping_sets.get(self._grouping_set_id(kept), pd.DataFrame(columns=DIMENSIONS + MEASURES))
+
+        mask = np.ones(len(cells), dtype=bool)
+        for dimension, values in filters.items():
+            values = [values] if isinstance(values, str) else list(values)
+            mask &= cells[dimension].isin(values).to_numpy()
+
+        result = cells.loc[mask, kept + MEASURES]
+        return result.set_index(kept) if kept else result.reset_index(drop=True)
+
+
+def create_aggregate_cube(datasets_path: str = 'dataset/', bin_size: int = 5) -> AggregateCube:
+    """Build the cube from the enriched datasets, check that it gives the same question 3 frames as grouping
+    create_top_composers_dataset, and store it in the datasets directory
+
+    Parameters
+    ----------
+    datasets_path: The directory of the datasets
+    bin_size: The number of years in each year bin
+
+    Returns
+    -------
+    The aggregate cube
+    """
+    # Imported here as the figures themselves import the cube
+    from question_script.plotly_graph import check_cube_frames
+    from question_script.question_helper import create_top_composers_dataset
+
+    movies = pd.read_pickle(datasets_path + 'clean_enrich_movies.pickle')
+    cube = AggregateCube.build(movies, pd.read_pickle(datasets_path + 'spotify_composers_dataset.pickle'), bin_size)
+
+    check_cube_frames(create_top_composers_dataset(movies, bin_size=bin_size), cube)
+
+    cube.save(datasets_path + 'aggregate_cube.parquet')
+    return cube
+
+
+if __name__ == '__main__':
+    create_aggregate_cube()
@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from question_script.multi_hot import encode_multi_hot
+
+
+class ComposerMovieGraph:
+    """
+    Class representing the bipartite graph between movies and their composers, stored as a sparse CSR adjacency matrix
+    of shape (number of movies, number of composers)
+
+    The graph should be built from the enriched dataset with ComposerMovieGraph.from_movies
+
+    e.g. graph = ComposerMovieGraph.from_movies(clean_enrich_movies)
+         graph.degree().nlargest(5)
+    """
+
+    def __init__(self, adjacency: sparse.csr_matrix, movies: pd.DataFrame, composers: pd.DataFrame):
+        """
+        Parameters
+        ----------
+        adjacency: The movies x composers adjacency matrix, with a 1 when the composer worked on the movie
+        movies: The movies attributes ('tmdb_id', 'name', 'release_date', 'year', 'box_office_revenue'), aligned with
+        the rows of the adjacency matrix
+        composers: The composers attributes ('name', 'place_of_birth') indexed by composer id, aligned with the
+        columns of the adjacency matrix
+        """
+        self._adjacency = adjacency
+        self.movies = movies
+        self.composers = composers
+
+    @classmethod
+    def from_movies(cls, movies: pd.DataFrame) -> 'ComposerMovieGraph':
+        """Build the graph from the enriched movies dataframe
+
+        Parameters
+        ----------
+        movies: The movies dataframe, with a 'composers' column containing a list of Composer or nan
+
+        Returns
+        -------
+        The composer-movie graph
+        """
+        encoding = encode_multi_hot(movies.composers.apply(
+            lambda composers: [c.id for c in composers] if isinstance(composers, list) else []))
+
+        # Keep the attributes of the first occurrence of each composer
+        all_composers = {}
+        for composers in movies.composers.dropna():
+            for composer in composers:
+                all_composers.setdefault(composer.id, (composer.name, composer.place_of_birth))
+        composers_df = pd.DataFrame.from_dict(all_composers, orient='index', columns=['name', 'place_of_birth'])
+        composers_df = composers_df.reindex(encoding.vocabulary)
+        composers_df.index.name = 'comp_id'
+
+        movies_df = pd.DataFrame({'tmdb_id': movies.tmdb_id.to_numpy(),
+                                  'name': movies.name.to_numpy(),
+                                  'release_date': movies.release_date.to_numpy(),
+                                  'year': pd.to_numeric(movies.release_date, errors='coerce').to_numpy(),
+                                  'box_office_revenue': movies.box_office_revenue.to_numpy(dtype=np.float64)},
+                                 index=movies.index)
+
+        return cls(encoding.matrix, movies_df, composers_df)
+
+    @property
+    def adjacency(self) -> sparse.csr_matrix:
+        """The movies x composers adjacency matrix"""
+        return self._adjacency
+
+    def degree(self) -> pd.Series:
+        """Number of movies of each composer
+
+        Returns
+        -------
+        A series indexed by composer id
+        """
+        return pd.Series(np.asarray(self._adjacency.sum(axis=0)).ravel(), index=self.composers.index, name='degree')
+
+    def collaboration_matrix(self) -> sparse.csr_matrix:
+        """Composer x composer matrix where each entry is the number of movies the two composers worked on together.
+        The diagonal holds the degree of each composer
+
+        Returns
+        -------
+        The sparse collaboration matrix
+        """
+        return (self._adjacency.T @ self._adjacency).tocsr()
+
+    def collaborations(self, min_movies: int = 1) -> pd.DataFrame:
+        """List each pair of composers that worked together
+
+        Parameters
+        ----------
+        min_movies: Minimum number of shared movies to keep the pair
+
+        Returns
+        -------
+        A dataframe with one row per pair, sorted by decreasing number of shared movies
+        """
+        # Upper triangle only, to have each pair once and drop the diagonal
+        pairs = sparse.triu(self.collaboration_matrix(), k=1).tocoo()
+        keep = pairs.data >= min_movies
+        rows, cols = pairs.row[keep], pairs.col[keep]
+
+        result = pd.DataFrame({'comp_id_a': self.composers.index[rows],
+                               'composer_name_a': self.composers.name.to_numpy()[rows],
+                               'comp_id_b': self.composers.index[cols],
+                               'composer_name_b': self.composers.name.to_numpy()[cols],
+                               'shared_movies': pairs.data[keep]})
+
+        return result.sort_values(by='shared_movies', ascending=False, ignore_index=True)
+
+    def revenue_centrality(self, split_revenue: bool = True) -> pd.Series:
+        """Revenue weighted degree of each composer
+
+        Parameters
+        ----------
+        split_revenue: Whether to split the box office revenue of a movie evenly between its composers, otherwise each
+        composer is credited with the full revenue
+
+        Returns
+        -------
+        A series indexed by composer id, movies without revenue are ignored
+        """
+        revenue = np.nan_to_num(self.movies.box_office_revenue.to_numpy())
+        if split_revenue:
+            nb_composers = np.asarray(self._adjacency.sum(axis=1)).ravel()
+            revenue = np.divide(revenue, nb_composers, out=np.zeros_like(revenue), where=nb_composers > 0)
+
+        return pd.Series(self._adjacency.T @ revenue, index=self.composers.index, name='revenue_centrality')
+
+    def year_slice(self, start: int = None, end: int = None) -> 'ComposerMovieGraph':
+        """Sub-graph restricted to the movies released between start and end (both included)
+
+        Parameters
+        ----------
+        start: First year to keep, unbounded if None
+        end: Last year to keep, unbounded if None
+
+        Returns
+        -------
+        The sub-graph, composers without any movie in the period are kept with a degree of 0
+        """
+        years = self.movies.year.to_numpy()
+        mask = np.ones(len(years), dtype=bool)
+        if start is not None:
+            mask &= years >= start
+        if end is not None:
+            mask &= years <= end
+
+        return ComposerMovieGraph(self._adjacency[mask], self.movies[mask], self.composers)
+
+    def link_table(self) -> pd.DataFrame:
+        """One row per (movie, composer) pair, with the movie and composer attributes
+
+        Returns
+        -------
+        A dataframe indexed by ('tmdb_id', 'comp_id') with the columns 'movie_name', 'movie_revenue', 'composer_name',
+        'release_date' and 'composer_place_of_birth'
+        """
+        edges = self._adjacency.tocoo()
+        movies = self.movies.iloc[edges.row]
+        composers = self.composers.iloc[edges.col]
+
+        result = pd.DataFrame({'tmdb_id': movies.tmdb_id.to_numpy(),
+                               'comp_id': composers.index.to_numpy(),
+                               'movie_name': movies.name.to_numpy(),
+                               'movie_revenue': movies.box_office_revenue.to_numpy(),
+                               'composer_name': composers.name.to_numpy(),
+                               'release_date': movies.release_date.to_numpy(),
+                               'composer_place_of_birth': composers.place_of_birth.to_numpy()})
+
+        # The edges of a csr matrix are ordered by row, so the pairs follow the order of the movies dataframe
+        return result.set_index(['tmdb_id', 'comp_id'])
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+
+from question_script.grouped_stats import grouped_ols
+
+# Number of points from which scatter traces are rendered with WebGL instead of SVG
+WEBGL_THRESHOLD = 5000
+
+# Maximum number of points drawn in a scatter figure, larger series are decimated
+MAX_POINTS = 200000
+
+
+def decimate(df: pd.DataFrame, y: str, max_points: int = MAX_POINTS, seed: int = 0) -> pd.DataFrame:
+    """Randomly subsample a dataframe to at most max_points rows, keeping the extrema of the y column so that the
+    range of the figure is unchanged
+
+    Parameters
+    ----------
+    df: The dataframe to decimate
+    y: The column plotted on the y axis
+    max_points: The maximum number of rows to keep
+    seed: The seed of the random sampling, so that exported figures are reproducible
+
+    Returns
+    -------
+    The decimated dataframe, in the original order
+    """
+    if len(df) <= max_points:
+        return df
+
+    extrema = [df[y].idxmin(), df[y].idxmax()]
+    sample = df.drop(index=extrema).sample(n=max_points - len(extrema), random_state=seed)
+
+    return df.loc[df.index.isin(sample.index) | df.index.isin(extrema)]
+
+
+def scatter(df: pd.DataFrame, x: str, y: str, color: str = None, trendline: bool = True,
+            max_points: int = MAX_POINTS, webgl_threshold: int = WEBGL_THRESHOLD, fits: pd.DataFrame = None) \
+        -> go.Figure:
+    """Create a scatter figure, with one trace per value of color, that scales to large dataframes:
+    - the traces are rendered with WebGL above webgl_threshold points
+    - the points drawn are decimated to max_points
+    - the OLS trendlines of all the traces are fitted at once on the full data, see grouped_stats
+
+    Parameters
+    ----------
+    df: The dataframe to plot
+    x: The column on the x axis
+    y: The column on the y axis
+    color: The column used to split the points into traces, a single trace if None
+    trendline: Whether to add an OLS trendline for each trace
+    max_points: The maximum number of points drawn
+    webgl_threshold: The number of points from which WebGL traces are used
+    fits: The OLS fits of y on x already computed for each value of color, as returned by grouped_ols or
+    grouped_statistics, so that several figures share them. They are computed if None
+
+    Returns
+    -------
+    The figure
+    """
+    scatter_trace = go.Scattergl if len(df) > webgl_threshold else go.Scatter
+    drawn = decimate(df, y, max_points)
+
+    names = [None] if color is None else pd.Index(df[color].dropna().unique()).sort_values()
+    if trendline and fits is None:
+        fits = grouped_ols(df[x], df[y], None if color is None else df[color])
+
+    fig = go.Figure()
+    for name in names:
+        group_drawn = drawn if color is None else drawn[drawn[color] == name]
+        fig.add_trace(scatter_trace(x=group_drawn[x], y=group_drawn[y], mode='markers', name=str(name),
+                                    legendgroup=str(name), showlegend=color is not None))
+
+        if trendline:
+            fit = fits.iloc[0] if color is None else fits.loc[name]
+            slope, intercept = fit.slope, fit.intercept
+            if not np.isnan(slope):
+                x_range = np.array([fit.x_min, fit.x_max])
+                fig.add_trace(scatter_trace(x=x_range, y=slope * x_range + intercept, mode='lines',
+                                            name=f'{name} OLS' if color is not None else 'OLS',
+                                            legendgroup=str(name), showlegend=False,
+                                            hovertemplate=f'y = {slope:.4g} x + {intercept:.4g}<extra></extra>'))
+
+    fig.update_layout(xaxis_title=x, yaxis_title=y, legend_title_text=color)
+
+    return fig
+
+
+def dropdown_menu(fig: go.Figure, all_label: str = 'All') -> list[dict]:
+    """Create the buttons of a dropdown menu showing one trace of the figure at a time, plus a button showing them all
+
+    Parameters
+    ----------
+    fig: The figure, with one trace per item of the dropdown
+    all_label: The label of the button showing all the traces
+
+    Returns
+    -------
+    The list of buttons, sorted by label
+    """
+    names = [trace.name for trace in fig.data]
+
+    # Each button needs the visibility of every trace, read them from the rows of the identity matrix
+    visibility = np.eye(len(names), dtype=bool).tolist()
+    dropdown = [dict(method='update', label=name, args=[{'visible': visible}, {'title': name}])
+                for name, visible in zip(names, visibility)]
+    dropdown.append(dict(method='update', label=all_label,
+                         args=[{'visible': [True] * len(names)}, {'title': all_label}]))
+
+    dropdown.sort(key=lambda x: x['label'])
+    return dropdown
+
+
+def write_html(fig: go.Figure, path: str):
+    """Write the figure as an HTML page that loads plotly.js from a plotly.min.js file shared by all the pages of
+    the same directory, instead of embedding its own copy of the library
+
+    Parameters
+    ----------
+    fig: The figure to write
+    path: The path of the HTML file, plotly.min.js is copied next to it if not already present
+    """
+    fig.write_html(path, include_plotlyjs='directory')
@@ -0,0 +1,274 @@
+"""
+Statistics of the relation between two variables computed for many groups at once, e.g. the correlation between the
+revenue and the popularity of the movies of each year. The sums of each group are computed with a single bincount over
+all the rows instead of a groupby().corr() or a fit per group, and the bootstrap resamples of all the groups are drawn
+and reduced in batches of arrays.
+
+e.g. stats = grouped_statistics(merged_df.popularity, merged_df.movie_revenue, groups=merged_df.release_date,
+                                nb_resamples=1000)
+     stats.loc[2009, ['pearson', 'pearson_low', 'pearson_high', 'slope', 'intercept']]
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Label of the single group when no groups are given
+ALL_GROUPS = 'all'
+
+# Maximum number of resampled values held in memory at once by the bootstrap
+BOOTSTRAP_BATCH_SIZE = 2_000_000
+
+# Statistics that can be bootstrapped
+BOOTSTRAP_STATISTICS = ('pearson', 'slope')
+
+
+def _prepare(x, y, groups=None) -> tuple[np.ndarray, np.ndarray, np.ndarray, pd.Index]:
+    """Convert the variables to arrays and the groups to integer codes, dropping the rows with a missing value
+
+    Parameters
+    ----------
+    x: The values of the first variable
+    y: The values of the second variable
+    groups: The group of each row, a single group if None
+
+    Returns
+    -------
+    The values of x and y, the code of the group of each row, and the sorted labels of the groups
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if groups is None:
+        codes, labels = np.zeros(len(x), dtype=np.intp), pd.Index([ALL_GROUPS])
+    else:
+        codes, labels = pd.factorize(np.asarray(groups), sort=True)
+        labels = pd.Index(labels)
+
+    valid = (codes >= 0) & ~np.isnan(x) & ~np.isnan(y)
+    return x[valid], y[valid], codes[valid], labels
+
+
+def _moments(x: np.ndarray, y: np.ndarray, codes: np.ndarray, nb_groups: int) -> tuple[np.ndarray, ...]:
+    """The size, the means and the centered sums of squares and products of each group. The deviations are taken from
+    the means of the groups, so that the large revenues do not lose the precision of their sums of squares
+
+    Parameters
+    ----------
+    x: The values of the first variable
+    y: The values of the second variable
+    codes: The code of the group of each value, between 0 and nb_groups - 1
+    nb_groups: The number of groups
+
+    Returns
+    -------
+    n, mean_x, mean_y, sxx, syy and sxy, one value per group
+    """
+    n = np.bincount(codes, minlength=nb_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(codes, weights=x, minlength=nb_groups) / n
+        mean_y = np.bincount(codes, weights=y, minlength=nb_groups) / n
+
+    dx = x - mean_x[codes]
+    dy = y - mean_y[codes]
+    sxx = np.bincount(codes, weights=dx * dx, minlength=nb_groups)
+    syy = np.bincount(codes, weights=dy * dy, minlength=nb_groups)
+    sxy = np.bincount(codes, weights=dx * dy, minlength=nb_groups)
+    return n, mean_x, mean_y, sxx, syy, sxy
+
+
+def _pearson(sxx: np.ndarray, syy: np.ndarray, sxy: np.ndarray) -> np.ndarray:
+    """The Pearson correlation of each group from its sums, nan for a constant variable"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where((sxx > 0) & (syy > 0), sxy / np.sqrt(sxx * syy), np.nan)
+
+
+def _slope(sxx: np.ndarray, sxy: np.ndarray) -> np.ndarray:
+    """The OLS slope of each group from its sums, nan for a constant explanatory variable"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(sxx > 0, sxy / sxx, np.nan)
+
+
+def _group_ranks(values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """The rank of each value within its group, the ties sharing their average rank"""
+    return pd.Series(values).groupby(codes).rank(method='average').to_numpy()
+
+
+def grouped_pearson(x, y, groups=None) -> pd.DataFrame:
+    """Pearson correlation between x and y within each group, ignoring the rows with a missing value
+
+    Parameters
+    ----------
+    x: The values of the first variable
+    y: The values of the second variable
+    groups: The group of each row, a single group labelled ALL_GROUPS if None
+
+    Returns
+    -------
+    The columns 'n' and 'pearson', indexed by the sorted groups. The correlation is nan for a group of less than two
+    rows or with a constant variable
+    """
+    return _grouped_pearson(*_prepare(x, y, groups))
+
+
+def _grouped_pearson(x: np.ndarray, y: np.ndarray, codes: np.ndarray, labels: pd.Index) -> pd.DataFrame:
+    n, _, _, sxx, syy, sxy = _moments(x, y, codes, len(labels))
+    return pd.DataFrame({'n': n, 'pearson': _pearson(sxx, syy, sxy)}, index=labels)
+
+
+def grouped_spearman(x, y, groups=None) -> pd.DataFrame:
+    """Spearman correlation between x and y within each group, i.e. the Pearson correlation of their ranks in the
+    group, ignoring the rows with a missing value
+
+    Parameters
+    ----------
+    x: The values of the first variable
+    y: The values of the second variable
+    groups: The group of each row, a single group labelled ALL_GROUPS if None
+
+    Returns
+    -------
+    The columns 'n' and 'spearman', indexed by the sorted groups
+    """
+    return _grouped_spearman(*_prepare(x, y, groups))
+
+
+def _grouped_spearman(x: np.ndarray, y: np.ndarray, codes: np.ndarray, labels: pd.Index) -> pd.DataFrame:
+    n, _, _, sxx, syy, sxy = _moments(_group_ranks(x, codes), _group_ranks(y, codes), codes, len(labels))
+    return pd.DataFrame({'n': n, 'spearman': _pearson(sxx, syy, sxy)}, index=labels)
+
+
+def grouped_ols(x, y, groups=None) -> pd.DataFrame:
+    """Ordinary least squares line y = slope * x + intercept fitted within each group, ignoring the rows with a missing
+    value
+
+    Parameters
+    ----------
+    x: The values of the explanatory variable
+    y: The values of the response variable
+    groups: The group of each row, a single group labelled ALL_GROUPS if None
+
+    Returns
+    -------
+    The columns 'n', 'slope', 'intercept', 'r2', and 'x_min' and 'x_max' the range of x fitted, indexed by the sorted
+    groups. The line is nan for a group of less than two rows or with a constant x
+    """
+    return _grouped_ols(*_prepare(x, y, groups))
+
+
+def _grouped_ols(x: np.ndarray, y: np.ndarray, codes: np.ndarray, labels: pd.Index) -> pd.DataFrame:
+    n, mean_x, mean_y, sxx, syy, sxy = _moments(x, y, codes, len(labels))
+    slope = _slope(sxx, sxy)
+
+    x_min = np.full(len(labels), np.inf)
+    x_max = np.full(len(labels), -np.inf)
+    np.minimum.at(x_min, codes, x)
+    np.maximum.at(x_max, codes, x)
+
+    return pd.DataFrame({
+        'n': n,
+        'slope': slope,
+        'intercept': mean_y - slope * mean_x,
+        'r2': _pearson(sxx, syy, sxy) ** 2,
+        'x_min': np.where(n > 0, x_min, np.nan),
+        'x_max': np.where(n > 0, x_max, np.nan),
+    }, index=labels)
+
+
+def grouped_bootstrap_ci(x, y, groups=None, statistics: tuple[str, ...] = BOOTSTRAP_STATISTICS,
+                         nb_resamples: int = 1000, confidence: float = 0.95, seed: int = 0) -> pd.DataFrame:
+    """Percentile bootstrap confidence intervals of statistics within each group. Each resample draws, with
+    replacement, as many rows from each group as it has. The resamples of all the groups are reduced at once,
+    BOOTSTRAP_BATCH_SIZE values at a time, and shared by the statistics
+
+    Parameters
+    ----------
+    x: The values of the first (explanatory) variable
+    y: The values of the second (response) variable
+    groups: The group of each row, a single group labelled ALL_GROUPS if None
+    statistics: The statistics among BOOTSTRAP_STATISTICS, 'pearson' for the correlation and 'slope' for the OLS slope
+    nb_resamples: The number of bootstrap resamples
+    confidence: The confidence level of the intervals
+    seed: The seed of the resampling, so that the intervals are reproducible
+
+    Returns
+    -------
+    The columns '<statistic>_low' and '<statistic>_high' of each statistic, indexed by the sorted groups, nan for a
+    group whose statistic is undefined in every resample
+    """
+    unknown = set(statistics) - set(BOOTSTRAP_STATISTICS)
+    if unknown:
+        raise ValueError(f'Unknown statistics {sorted(unknown)}, expected some of {BOOTSTRAP_STATISTICS}')
+
+    return _grouped_bootstrap_ci(*_prepare(x, y, groups), statistics, nb_resamples, confidence, seed)
+
+
+def _grouped_bootstrap_ci(x: np.ndarray, y: np.ndarray, codes: np.ndarray, labels: pd.Index,
+                          statistics: tuple[str, ...], nb_resamples: int, confidence: float, seed: int) \
+        -> pd.DataFrame:
+    nb_groups = len(labels)
+
+    # The rows are sorted by group, so that the rows of a group are drawn from its slice
+    order = np.argsort(codes, kind='stable')
+    x, y, codes = x[order], y[order], codes[order]
+    sizes = np.bincount(codes, minlength=nb_groups)
+    starts = np.cumsum(sizes) - sizes
+
+    rng = np.random.default_rng(seed)
+    batch_size = max(1, BOOTSTRAP_BATCH_SIZE // max(len(x), 1))
+    resampled = {statistic: [np.full((0, nb_groups), np.nan)] for statistic in statistics}
+    for start in range(0, nb_resamples if len(x) else 0, batch_size):
+        nb_batch = min(batch_size, nb_resamples - start)
+        # Row drawn for each resample and each slot, the slot i of a resample being drawn from the group of the row i
+        drawn = starts[codes] + (rng.random((nb_batch, len(x))) * sizes[codes]).astype(np.intp)
+        # Each (resample, group) pair is a group of its own
+        batch_codes = (np.arange(nb_batch)[:, None] * nb_groups + codes).ravel()
+        _, _, _, sxx, syy, sxy = _moments(x[drawn].ravel(), y[drawn].ravel(), batch_codes, nb_batch * nb_groups)
+        if 'pearson' in resampled:
+            resampled['pearson'].append(_pearson(sxx, syy, sxy).reshape(nb_batch, nb_groups))
+        if 'slope' in resampled:
+            resampled['slope'].append(_slope(sxx, sxy).reshape(nb_batch, nb_groups))
+
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for statistic, values in resampled.items():
+        values = np.concatenate(values)
+        if len(values) == 0:
+            low = high = np.full(nb_groups, np.nan)
+        else:
+            with warnings.catch_warnings():
+                # A group whose statistic is undefined in every resample has a nan interval
+                warnings.simplefilter('ignore', RuntimeWarning)
+                low, high = np.nanpercentile(values, [100 * alpha, 100 * (1 - alpha)], axis=0)
+        intervals[f'{statistic}_low'] = low
+        intervals[f'{statistic}_high'] = high
+
+    return pd.DataFrame(intervals, index=labels)
+
+
+def grouped_statistics(x, y, groups=None, nb_resamples: int = 0, confidence: float = 0.95, seed: int = 0) \
+        -> pd.DataFrame:
+    """All the statistics of the relation between x and y within each group, to be computed once and shared by the
+    figures and the notebook
+
+    Parameters
+    ----------
+    x: The values of the explanatory variable
+    y: The values of the response variable
+    groups: The group of each row, a single group labelled ALL_GROUPS if None
+    nb_resamples: The number of bootstrap resamples of the confidence intervals, no interval if 0
+    confidence: The confidence level of the intervals
+    seed: The seed of the resampling
+
+    Returns
+    -------
+    The columns 'n', 'pearson', 'spearman', 'slope', 'intercept', 'r2', 'x_min', 'x_max', and with nb_resamples the
+    intervals 'pearson_low', 'pearson_high', 'slope_low' and 'slope_high', indexed by the sorted groups
+    """
+    prepared = _prepare(x, y, groups)
+    stats = _grouped_ols(*prepared)
+    stats.insert(1, 'pearson', _grouped_pearson(*prepared).pearson)
+    stats.insert(2, 'spearman', _grouped_spearman(*prepared).spearman)
+
+    if nb_resamples:
+        stats = stats.join(_grouped_bootstrap_ci(*prepared, BOOTSTRAP_STATISTICS, nb_resamples, confidence, seed))
+    return stats
@@ -0,0 +1,147 @@
+from dataclasses import dataclass
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+@dataclass
+class MultiHotEncoding:
+    """
+    Data class that represent a multi-valued column (e.g. 'genres' or 'countries') encoded as a sparse multi-hot matrix.
+    Row i of the matrix corresponds to the i-th entry of index, column j to the j-th label of vocabulary
+    """
+    matrix: sparse.csr_matrix
+    vocabulary: pd.Index
+    index: pd.Index
+
+
+def encode_multi_hot(column: pd.Series) -> MultiHotEncoding:
+    """Encode a column of lists into a sparse multi-hot CSR matrix along with its vocabulary
+
+    Parameters
+    ----------
+    column: A series where each entry is a list of labels, as the 'genres' and 'countries' columns returned by
+    clean_movies. Missing entries (nan) are encoded as an empty row
+
+    Returns
+    -------
+    The multi-hot encoding of the column, where the vocabulary is sorted alphabetically
+    """
+    lists = [labels if isinstance(labels, list) else [] for labels in column]
+    lengths = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+
+    # Factorize all labels at once instead of exploding the dataframe
+    flat_labels = np.fromiter(chain.from_iterable(lists), dtype=object, count=int(lengths.sum()))
+    codes, vocabulary = pd.factorize(flat_labels, sort=True)
+
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    matrix = sparse.csr_matrix((np.ones(len(codes), dtype=np.int32), codes, indptr),
+                               shape=(len(lists), len(vocabulary)))
+
+    # A label listed twice for the same movie should still be counted once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    return MultiHotEncoding(matrix, pd.Index(vocabulary), column.index)
+
+
+def contains_mask(encoding: MultiHotEncoding, labels, match: str = 'all') -> np.ndarray:
+    """Compute for each row whether it contains the given labels
+
+    Parameters
+    ----------
+    encoding: The multi-hot encoding to query
+    labels: A single label or a list of labels
+    match: 'all' to require every label to be present, 'any' to require at least one of them
+
+    Returns
+    -------
+    A boolean array aligned with the rows of the encoding
+    """
+    if match not in ('all', 'any'):
+        raise ValueError(f"match should be either 'all' or 'any', got {match}")
+
+    labels = [labels] if isinstance(labels, str) else list(labels)
+    columns = encoding.vocabulary.get_indexer(labels)
+    known_columns = columns[columns != -1]
+
+    # Number of requested labels present in each row
+    hits = np.asarray(encoding.matrix[:, known_columns].sum(axis=1)).ravel()
+
+    if match == 'all':
+        # A label that never appears cannot be matched by any row
+        return hits == len(labels) if len(known_columns) == len(labels) else np.zeros(len(hits), dtype=bool)
+    return hits > 0
+
+
+def filter_movies(df: pd.DataFrame, encodings: dict[str, MultiHotEncoding], match: str = 'all',
+                  **labels) -> pd.DataFrame:
+    """Filter the movies containing the given labels in each multi-valued column, e.g.
+    filter_movies(movies, encodings, genres='Drama', countries=['France', 'Italy'])
+
+    Parameters
+    ----------
+    df: The dataframe that was encoded
+    encodings: The encoding of each multi-valued column, keyed by column name
+    match: 'all' or 'any', see contains_mask, applied within each column (columns are always combined with a logical and)
+    labels: The labels to look for, keyed by column name
+
+    Returns
+    -------
+    The filtered dataframe
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for column, column_labels in labels.items():
+        encoding = encodings[column]
+        if not encoding.index.equals(df.index):
+            raise ValueError(f'The encoding of {column} is not aligned with the dataframe index')
+        mask &= contains_mask(encoding, column_labels, match)
+
+    return df[mask]
+
+
+def aggregate_by_label(encoding: MultiHotEncoding, values: pd.Series) -> pd.DataFrame:
+    """Aggregate a numerical column (e.g. 'box_office_revenue') per label, with a sparse matrix product
+
+    Parameters
+    ----------
+    encoding: The multi-hot encoding used to group the rows
+    values: The values to aggregate, aligned with the rows of the encoding. Nan values are ignored
+
+    Returns
+    -------
+    A dataframe indexed by label with the 'count', 'sum' and 'mean' of the values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    not_na = ~np.isnan(values)
+
+    transposed = encoding.matrix.T.tocsr()
+    count = transposed @ not_na.astype(np.float64)
+    total = transposed @ np.where(not_na, values, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+
+    return pd.DataFrame({'count': count.astype(np.int64), 'sum': total, 'mean': mean}, index=encoding.vocabulary)
+
+
+def co_occurrence(encoding: MultiHotEncoding, other: MultiHotEncoding = None) -> pd.DataFrame:
+    """Count the number of rows in which each pair of labels appears together
+
+    Parameters
+    ----------
+    encoding: The multi-hot encoding of the first column
+    other: The multi-hot encoding of a second column (e.g. genres x countries), defaults to the first one
+
+    Returns
+    -------
+    A sparse dataframe with the labels of encoding as index and the labels of other as columns. With a single
+    encoding, the diagonal holds the number of rows containing each label
+    """
+    other = encoding if other is None else other
+
+    counts = (encoding.matrix.T @ other.matrix).tocsr()
+
+    return pd.DataFrame.sparse.from_spmatrix(counts, index=encoding.vocabulary, columns=other.vocabulary)
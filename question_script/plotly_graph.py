@@ -1,66 +1,109 @@
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objs as go
+from IPython.core.display_functions import display
 from plotly.subplots import make_subplots
 
+from question_script.aggregate_cube import AggregateCube
+from question_script.figure_builder import dropdown_menu, scatter, write_html
+from question_script.grouped_stats import grouped_statistics
 
-def create_plotly_number_of_movies(movie_grouped_by_top_composer):
+
+def number_of_movies_per_bin(movie_grouped_by_top_composer, cube: AggregateCube = None) -> pd.DataFrame:
     """
-    Save the plotly figure for the number of movies per composer
+    Count the movies of each composer per year bin
     :param movie_grouped_by_top_composer: The dataframe grouped by composer
-    :return: None
+    :param cube: The precomputed aggregate cube, if given the counts of the composers of movie_grouped_by_top_composer
+    are looked up in it instead of grouping the dataframe again
+    :return: The dataframe with the year_bin column and one column of counts per composer, sorted by year bin
     """
     new_df = movie_grouped_by_top_composer.copy()
 
     new_df.dropna(inplace=True)
 
     # Create a column count which contains the number of movies per year and per composer
-    # Group by composer and year bin, count the number of movies
-    movie_counts = movie_grouped_by_top_composer.groupby(['composer_name', 'year_bin'], observed=False).size()
+    if cube is None:
+        # Group by composer and year bin, count the number of movies
+        movie_counts = movie_grouped_by_top_composer.groupby(['composer_name', 'year_bin'], observed=False).size()
+    else:
+        movie_counts = cube.query(['composer_name', 'year_bin'],
+                                  composer_name=list(new_df['composer_name'].unique()))['nb_movies']
 
-    # Unstack the 'composer_name' level to create a DataFrame
-    movie_counts_df = movie_counts.unstack(level='composer_name')
+    # Unstack the 'composer_name' level to create a DataFrame, bins without movies are missing from the cube
+    movie_counts_df = movie_counts.unstack(level='composer_name', fill_value=0)
 
     # Create a df with the year bins and composer_name as columns
     movie_counts_df = movie_counts_df.reset_index()
 
     # Rename the columns
     movie_counts_df.columns = ['year_bin'] + list(movie_counts_df.columns[1:])
-    movie_counts_df = movie_counts_df.sort_values(by='year_bin')
 
-    # Replace bins like (1900, 1905] by 1900 - 1905
-    movie_counts_df['year_bin'] = movie_counts_df['year_bin'].apply(
-        lambda x: str(x).replace('(', '')
-        .replace(']', '')
-        .replace(',', ' -')
-    )
+    return movie_counts_df.sort_values(by='year_bin').reset_index(drop=True)
+
+
+def box_office_revenue_per_bin(movie_grouped_by_top_composer, cube: AggregateCube = None) -> pd.DataFrame:
+    """
+    Sum the box office revenue of the movies of each composer per year bin
+    :param movie_grouped_by_top_composer: The dataframe grouped by composer
+    :param cube: The precomputed aggregate cube, if given the revenues of the composers of
+    movie_grouped_by_top_composer are looked up in it instead of grouping the dataframe again
+    :return: The dataframe with the composer_name, year_bin and box_office_revenue columns, sorted by year bin
+    """
+    new_df = movie_grouped_by_top_composer.copy()
+
+    new_df.dropna(inplace=True)
+    new_df['year_bin'] = new_df['year_bin'].astype(str)
+
+    # Sum the box office revenue per year and per composer
+    if cube is None:
+        new_df = new_df.groupby(['composer_name', 'year_bin'], observed=False)['box_office_revenue'].sum().reset_index()
+    else:
+        new_df = cube.query(['composer_name', 'year_bin'], composer_name=list(new_df['composer_name'].unique()))[
+            'revenue_sum'].rename('box_office_revenue').reset_index()
+
+    return new_df.sort_values(by=['year_bin', 'composer_name']).reset_index(drop=True)
+
+
+def check_cube_frames(movie_grouped_by_top_composer, cube: AggregateCube):
+    """
+    Check that the aggregate cube gives the same counts and revenues as grouping the question 3 dataset
+    :param movie_grouped_by_top_composer: The dataframe grouped by composer (create_top_composers_dataset)
+    :param cube: The aggregate cube built from the same movies and with the same bin size
+    :raises AssertionError: If a frame computed from the cube differs from the one grouped from the dataframe
+    """
+    pd.testing.assert_frame_equal(number_of_movies_per_bin(movie_grouped_by_top_composer, cube),
+                                  number_of_movies_per_bin(movie_grouped_by_top_composer), check_dtype=False)
+    pd.testing.assert_frame_equal(box_office_revenue_per_bin(movie_grouped_by_top_composer, cube),
+                                  box_office_revenue_per_bin(movie_grouped_by_top_composer), check_dtype=False)
+
+
+def create_plotly_number_of_movies(movie_grouped_by_top_composer, cube: AggregateCube = None):
+    """
+    Save the plotly figure for the number of movies per composer
+    :param movie_grouped_by_top_composer: The dataframe grouped by composer
+    :param cube: The precomputed aggregate cube, see figure_number_of_movies
+    :return: None
+    """
+    fig = figure_number_of_movies(movie_grouped_by_top_composer, cube)
+
+    write_html(fig, "Q3_number_of_movies_per_year.html")
+
+
+def figure_number_of_movies(movie_grouped_by_top_composer, cube: AggregateCube = None) -> go.Figure:
+    """
+    Create the plotly figure for the number of movies per composer
+    :param movie_grouped_by_top_composer: The dataframe grouped by composer
+    :param cube: The precomputed aggregate cube, if given the counts of the composers of movie_grouped_by_top_composer
+    are looked up in it instead of grouping the dataframe again
+    :return: The figure
+    """
+    movie_counts_df = number_of_movies_per_bin(movie_grouped_by_top_composer, cube)
 
     fig = px.line(movie_counts_df, x='year_bin', y=list(movie_counts_df.columns[1:]),
                   title='Number of movies per composer')
 
-    # Get the list of unique composers
-    composers = new_df['composer_name'].unique()
-
-    # Add a dropdown menu to select the composers to display
-    dropdown = []
-    for i, composer in enumerate(composers):
-        visible = [False] * len(composers)
-        visible[i] = True
-        dropdown.append(dict(
-            method='update',
-            label=composer,
-            args=[{'visible': visible},
-                  {'title': composer}]))
-    all_button = dict(
-        method='update',
-        label='All',
-        args=[{'visible': new_df['composer_name'].isin(new_df['composer_name'].unique())},
-              {'title': 'All'}])
-
-    # Prepend the "All" button to the dropdown list
-    dropdown.insert(0, all_button)
-
-    dropdown.sort(key=lambda x: x['label'])
+    # Add a dropdown menu to select the composers to display, one trace per composer
+    dropdown = dropdown_menu(fig)
 
     # Add Dropdown menu and select All by default
     fig.update_layout(
@@ -85,59 +128,36 @@ def create_plotly_number_of_movies(movie_grouped_by_top_composer):
     )
     fig.update_traces(mode='lines')
 
-    fig.write_html("Q3_number_of_movies_per_year.html")
+    return fig
 
 
-def create_plotly_box_office_revenue(movie_grouped_by_top_composer):
+def create_plotly_box_office_revenue(movie_grouped_by_top_composer, cube: AggregateCube = None):
     """
     Save the plotly figure for the box office revenue per composer
     :param movie_grouped_by_top_composer: The dataframe grouped by composer
+    :param cube: The precomputed aggregate cube, see figure_box_office_revenue
     :return: None
     """
-    new_df = movie_grouped_by_top_composer.copy()
+    fig = figure_box_office_revenue(movie_grouped_by_top_composer, cube)
 
-    new_df.dropna(inplace=True)
-    new_df['year_bin'] = new_df['year_bin'].astype(str)
-
-    # Sum the box office revenue per year and per composer
-    new_df = new_df.groupby(['composer_name', 'year_bin'], observed=False)['box_office_revenue'].sum().reset_index()
+    write_html(fig, "Q3_box_office_revenue_per_year.html")
 
-    new_df = new_df.sort_values(by='year_bin')
 
-    # Replace bins like (1900, 1905] by 1900 - 1905
-    new_df['year_bin'] = new_df['year_bin'].apply(
-        lambda x: str(x).replace('(', '')
-        .replace(']', '')
-        .replace(',', ' -')
-    )
+def figure_box_office_revenue(movie_grouped_by_top_composer, cube: AggregateCube = None) -> go.Figure:
+    """
+    Create the plotly figure for the box office revenue per composer
+    :param movie_grouped_by_top_composer: The dataframe grouped by composer
+    :param cube: The precomputed aggregate cube, if given the revenues of the composers of
+    movie_grouped_by_top_composer are looked up in it instead of grouping the dataframe again
+    :return: The figure
+    """
+    new_df = box_office_revenue_per_bin(movie_grouped_by_top_composer, cube)
 
     fig = px.line(new_df, x='year_bin', y='box_office_revenue', color='composer_name',
                   title='Sum of the Box-Office Revenues per composer')
 
-    # Get the list of unique composers
-    composers = new_df['composer_name'].unique()
-
-    # Add a dropdown menu to select the composers to display
-    dropdown = []
-    for i, composer in enumerate(composers):
-        visible = [False] * len(composers)
-        visible[i] = True
-        dropdown.append(dict(
-            method='update',
-            label=composer,
-            args=[{'visible': visible},
-                  {'title': composer}]))
-
-    all_button = dict(
-        method='update',
-        label='All',
-        args=[{'visible': new_df['composer_name'].isin(new_df['composer_name'].unique())},
-              {'title': 'All'}])
-
-    # Prepend the "All" button to the dropdown list
-    dropdown.insert(0, all_button)
-
-    dropdown.sort(key=lambda x: x['label'])
+    # Add a dropdown menu to select the composers to display, one trace per composer
+    dropdown = dropdown_menu(fig)
 
     # Add Dropdown menu and select All by default
     fig.update_layout(
@@ -163,7 +183,7 @@ def create_plotly_box_office_revenue(movie_grouped_by_top_composer):
 
     fig.update_traces(mode='lines')
 
-    fig.write_html("Q3_box_office_revenue_per_year.html")
+    return fig
 
 
 def plot_popularity_histogram(pop_df: pd.DataFrame):
@@ -175,6 +195,25 @@ def plot_popularity_histogram(pop_df: pd.DataFrame):
     pop_df: pd.DataFrame
         The dataframe containing the popularity information
     """
+    fig = figure_popularity_histogram(pop_df)
+
+    # Show the plot
+    fig.show()
+
+
+def figure_popularity_histogram(pop_df: pd.DataFrame) -> go.Figure:
+    """
+    Create the histogram of the popularity
+
+    Parameters
+    ----------
+    pop_df: pd.DataFrame
+        The dataframe containing the popularity information
+
+    Returns
+    -------
+    fig: go.Figure
+    """
     fig = make_subplots()
     fig.add_trace(go.Histogram(x=pop_df['popularity'], nbinsx=5))
 
@@ -194,8 +233,7 @@ def plot_popularity_histogram(pop_df: pd.DataFrame):
     fig.update_yaxes(title_text='Count')
     fig.update_layout(title_text='Interactive Histogram of Popularity')
 
-    # Show the plot
-    fig.show()
+    return fig
 
 
 def plot_scatter_popularity_revenue_by_year(merged_df: pd.DataFrame):
@@ -207,10 +245,29 @@ def plot_scatter_popularity_revenue_by_year(merged_df: pd.DataFrame):
     merged_df: pd.DataFrame
         The dataframe containing the popularity and revenue information
     """
-    fig = px.scatter(merged_df, x="popularity", y="movie_revenue", color='release_date', trendline="ols")
+    fig = figure_scatter_popularity_revenue_by_year(merged_df)
     fig.show()
 
 
+def figure_scatter_popularity_revenue_by_year(merged_df: pd.DataFrame, fits: pd.DataFrame = None) -> go.Figure:
+    """
+    Create the scatter plot of popularity and revenue by year
+
+    Parameters
+    ----------
+    merged_df: pd.DataFrame
+        The dataframe containing the popularity and revenue information
+
+    fits: pd.DataFrame
+        The fits of the revenue on the popularity by release date, as returned by grouped_statistics, computed if None
+
+    Returns
+    -------
+    fig: go.Figure
+    """
+    return scatter(merged_df, x="popularity", y="movie_revenue", color='release_date', fits=fits)
+
+
 def plot_scatter_popularity_revenue_overall(merged_df: pd.DataFrame):
     """
     Plot the scatter plot of popularity and revenue overall
@@ -220,10 +277,29 @@ def plot_scatter_popularity_revenue_overall(merged_df: pd.DataFrame):
     merged_df: pd.DataFrame
         The dataframe containing the popularity and revenue information
     """
-    fig = px.scatter(merged_df, x="popularity", y="movie_revenue", trendline="ols")
+    fig = figure_scatter_popularity_revenue_overall(merged_df)
     fig.show()
 
 
+def figure_scatter_popularity_revenue_overall(merged_df: pd.DataFrame, fits: pd.DataFrame = None) -> go.Figure:
+    """
+    Create the scatter plot of popularity and revenue overall
+
+    Parameters
+    ----------
+    merged_df: pd.DataFrame
+        The dataframe containing the popularity and revenue information
+
+    fits: pd.DataFrame
+        The fit of the revenue on the popularity, as returned by grouped_statistics without groups, computed if None
+
+    Returns
+    -------
+    fig: go.Figure
+    """
+    return scatter(merged_df, x="popularity", y="movie_revenue", fits=fits)
+
+
 def plot_heatmap_correlation(merged_df: pd.DataFrame):
     """
     Plot the heatmap of correlation between popularity and revenue
@@ -233,28 +309,65 @@ def plot_heatmap_correlation(merged_df: pd.DataFrame):
     merged_df: pd.DataFrame
         The dataframe containing the popularity and revenue information
     """
-    merged_df_modified = merged_df.copy()
-    merged_df_modified['release_date'] = pd.to_datetime(merged_df_modified['release_date'])
+    correlation_by_year = compute_correlation_by_year(merged_df)
+
+    display(correlation_by_year)
+
+    fig = figure_heatmap_correlation(correlation_by_year)
+
+    fig.show()
+    write_html(fig, "Q7_correlation_heatmap.html")
+
+
+def compute_correlation_by_year(merged_df: pd.DataFrame, nb_resamples: int = 0) -> pd.DataFrame:
+    """
+    Compute the correlation between popularity and revenue for each year, along with the mean revenue of the year
+
+    Parameters
+    ----------
+    merged_df: pd.DataFrame
+        The dataframe containing the popularity and revenue information
 
+    nb_resamples: int
+        The number of bootstrap resamples of the confidence intervals of the correlations, no interval if 0
+
+    Returns
+    -------
+    correlation_by_year: pd.DataFrame
+        The dataframe with the columns 'year', 'correlation' and 'mean_revenue', along with the other statistics of
+        grouped_statistics ('spearman', 'pearson_low', 'pearson_high', 'slope', ...)
+    """
     # Extract the year from the 'release_date'
-    merged_df_modified['year'] = merged_df_modified['release_date'].dt.year
+    years = pd.to_datetime(merged_df['release_date']).dt.year
 
-    # Group by year and calculate the correlation between 'movie_revenue' and 'popularity'
-    correlation_by_year = merged_df_modified.groupby('year')[['movie_revenue', 'popularity']].corr().iloc[0::2,
-                          -1].reset_index()
-    mean_revenue_by_year = merged_df_modified.groupby('year')['movie_revenue'].mean().reset_index()
+    # Correlations of all the years at once, instead of a groupby().corr()
+    stats = grouped_statistics(merged_df['popularity'], merged_df['movie_revenue'], years, nb_resamples)
+    mean_revenue = merged_df['movie_revenue'].groupby(years).mean()
 
-    correlation_by_year['mean_revenue'] = mean_revenue_by_year['movie_revenue']
+    correlation_by_year = pd.concat([stats['pearson'].rename('correlation'), mean_revenue.rename('mean_revenue'),
+                                     stats.drop(columns='pearson')], axis=1)
+    correlation_by_year = correlation_by_year.rename_axis('year').reset_index()
 
-    # Rename the columns for the heatmap
-    correlation_by_year.columns = ['year', 'drop', 'correlation', 'mean_revenue']
-    correlation_by_year = correlation_by_year.drop(columns='drop')
-    correlation_by_year.dropna(inplace=True)
+    correlation_by_year.dropna(subset=['correlation', 'mean_revenue'], inplace=True)
     correlation_by_year = correlation_by_year[correlation_by_year["correlation"] < 0.99]
     correlation_by_year = correlation_by_year[correlation_by_year["correlation"] > -0.99]
 
-    display(correlation_by_year)
+    return correlation_by_year
+
 
+def figure_heatmap_correlation(correlation_by_year: pd.DataFrame) -> go.Figure:
+    """
+    Create the heatmap of correlation between popularity and revenue
+
+    Parameters
+    ----------
+    correlation_by_year: pd.DataFrame
+        The correlation by year, as returned by compute_correlation_by_year
+
+    Returns
+    -------
+    fig: go.Figure
+    """
     # Create the heatmap using Graph Objects
     fig = go.Figure(data=go.Scatter(
         x=correlation_by_year['correlation'],
@@ -311,5 +424,4 @@ def plot_heatmap_correlation(merged_df: pd.DataFrame):
         ])
     )
 
-    fig.show()
-    fig.write_html("Q7_correlation_heatmap.html")
+    return fig
@@ -40,3 +40,103 @@ def extract_composers_data(df: pd.DataFrame, group_by_composer_id: bool = False)
         exploded_df = exploded_df.groupby('c_id')
 
     return exploded_df
+
+
+# Columns a movie needs to be counted in the question 3 datasets
+TOP_COMPOSERS_COLUMNS = ['release_date', 'composers', 'box_office_revenue']
+
+
+def drop_incomplete_movies(movies: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keep the movies counted in the question 3 datasets, i.e. with a release date, composers and a box office revenue
+
+    Parameters
+    ----------
+    movies: The movies dataframe
+
+    Returns
+    -------
+    The movies without a missing value in TOP_COMPOSERS_COLUMNS
+    """
+    return movies.dropna(subset=TOP_COMPOSERS_COLUMNS)
+
+
+def year_bin_label(years: pd.Series, bin_size: int = 5) -> pd.Series:
+    """
+    Map each year to its bin label, bins are right-closed as with pandas.cut, e.g. 1998 -> '1995 - 2000'
+
+    Parameters
+    ----------
+    years: The years to map
+    bin_size: The number of years in each bin
+
+    Returns
+    -------
+    A series of labels, nan where the year is missing
+    """
+    years = pd.to_numeric(years, errors='coerce')
+    start = ((years - 1) // bin_size) * bin_size
+    labels = start.astype('Int64').astype(str) + ' - ' + (start + bin_size).astype('Int64').astype(str)
+
+    return labels.where(years.notna())
+
+
+def create_top_composers_dataset(movies: pd.DataFrame, nb_composers: int = 5, bin_size: int = 5) -> pd.DataFrame:
+    """
+    Create the dataset of question 3: the movies of the composers with the highest number of movies, binned by year
+
+    Parameters
+    ----------
+    movies: The movies dataframe
+    nb_composers: The number of top composers to keep
+    bin_size: The number of years in each bin
+
+    Returns
+    -------
+    The dataframe with the columns "release_year, composer_id, composer_name, box_office_revenue, year_bin", where the
+    year bins are formatted as "1900 - 1905"
+    (see year_bin_label)
+    """
+    df = drop_incomplete_movies(movies)[TOP_COMPOSERS_COLUMNS]
+
+    df = extract_composers_data(df)[['release_date', 'c_id', 'c_name', 'box_office_revenue']]
+    df = df.rename(columns={'release_date': 'release_year', 'c_id': 'composer_id', 'c_name': 'composer_name'})
+
+    # Keep the composers with the highest number of movies they contributed to
+    top_composers = df['composer_id'].value_counts().head(nb_composers).index
+    df = df[df['composer_id'].isin(top_composers)].copy()
+
+    df['release_year'] = df['release_year'].astype(int)
+
+    # Add the bin each year falls into, formatted as a string
+    df['year_bin'] = year_bin_label(df['release_year'], bin_size)
+
+    return df
+
+
+def create_popularity_revenue_dataset(album_id_and_musics: pd.DataFrame,
+                                      movie_album_and_revenue: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Create the datasets of question 7: the mean popularity of each soundtrack album, and the movies merged with the
+    popularity of their album
+
+    Parameters
+    ----------
+    album_id_and_musics: The album_id_and_musics dataframe, with a 'track' column containing a Music
+    movie_album_and_revenue: The movie_album_and_revenue dataframe
+
+    Returns
+    -------
+    The popularity dataframe with the columns "album_id, popularity", and the movies merged with their popularity
+    """
+    movie_album_and_revenue = movie_album_and_revenue.dropna(subset='album_id').drop_duplicates(subset=['movie_name'])
+
+    musics = album_id_and_musics.dropna(subset='track').reset_index()
+    musics['popularity'] = musics['track'].apply(lambda x: x.popularity)
+
+    # Get the mean popularity for each album
+    pop_df = musics[['album_id', 'popularity']].groupby('album_id').mean().dropna(subset='popularity').reset_index()
+
+    merged_df = pd.merge(left=movie_album_and_revenue, right=pop_df, on='album_id', how='inner')
+
+    return pop_df, merged_df
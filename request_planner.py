@@ -0,0 +1,408 @@
+"""
+Dry-run planner of the requests of the enrichment. Without sending anything, it walks the same inputs as the
+enrichment functions (append_movie_revenue, append_movie_composers, the Spotify composers lookup,
+get_album_ids_into_df, get_track_ids_into_df, get_music_from_track_ids and get_audio_features_of_tracks) and counts the
+requests each stage would send per endpoint, once the near-duplicate titles are clustered, the identical requests
+coalesced, the rows already in the checkpoint logs, the composer mapping or the audio features table skipped, and the
+Spotify ids batched. The wall time of each stage is then estimated from the rate limits of the APIs.
+
+The inputs of a stage are the datasets of the previous run. When a dataset does not exist yet, its stage is planned
+from the counts of the previous stage, as an upper bound, or reported as unknown. As in enrich_with_spotify_data, a
+Spotify stage whose dataset exists sends nothing, unless the run is incremental, it then only sends the rows added or
+changed since its dataset.
+
+    python request_planner.py [--incremental] [--fallback-threshold SCORE] [--tmdb-rps N] [--spotify-rps N]
+"""
+import argparse
+import math
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from checkpoint_store import CheckpointStore
+from composer_matching import load_mapping
+from enrich_movie_data import CONTENT_COLUMNS, ENRICHED_MOVIES_PATH, IDENTITY_COLUMNS, PROCESSED_HASHES_PATH
+from enrich_music_data import get_composers
+from enrich_with_spotify_data import (ALBUM_IDENTITY_COLUMNS, AUDIO_FEATURES_PATH, BATCH_SIZE,
+                                      create_db_to_link_composers_to_movies, explode_album_tracks, movies_to_search)
+from helpers import clean_movies, load_movies
+from incremental import compute_row_hashes, hashes_from_snapshot, load_processed_hashes, select_delta
+from network.priority import priority_order
+from network.resilience import endpoint_of
+from pipeline import CMU_MOVIES_PATH
+from spotify.SpotifyDataLoader import SPOTIFY_BASE_URL, SpotifyDataLoader
+from tmdb.title_clustering import cluster_titles
+from tmdb.tmdbDataLoader import FALLBACK_BUDGET, TMDB_BASE_URL
+
+SPOTIFY_COMPOSERS_PATH = 'dataset/spotify_composers_dataset.pickle'
+ALBUMS_PATH = 'dataset/movie_album_and_revenue.pickle'
+TRACKS_PATH = 'dataset/movie_album_and_revenue_with_track_ids.pickle'
+MUSICS_PATH = 'dataset/album_id_and_musics.pickle'
+
+# Checkpoint logs of the Spotify stages, see checkpoint_store
+ALBUMS_CHECKPOINT_PATH = 'dataset/checkpoints/movie_album_ids.log'
+TRACKS_CHECKPOINT_PATH = 'dataset/checkpoints/album_track_ids.log'
+MUSICS_CHECKPOINT_PATH = 'dataset/checkpoints/track_musics.log'
+
+# Number of rows of tracks requested together by get_music_from_track_ids
+MUSICS_BATCH_SIZE = 250
+
+
+@dataclass
+class RateLimit:
+    """
+    Data class that describes how fast the requests to an API can be sent
+    """
+    # Requests per second allowed by the API
+    requests_per_second: float
+    # Requests in flight at the same time
+    max_concurrency: int
+    # Typical response time, in seconds
+    latency: float
+    # Wait of the loader after each request, in seconds
+    pause: float = 0
+
+    @property
+    def throughput(self) -> float:
+        """The number of requests per second, the lowest of the API limit and of the loader concurrency"""
+        return min(self.requests_per_second, self.max_concurrency / (self.latency + self.pause))
+
+
+# TMDB allows about 40 requests per second, the loader keeps 45 requests in flight (see network.resilience). Spotify
+# does not publish its limit, the loader gathers batches of 100 requests and waits 2s after each one
+RATE_LIMITS = {
+    'api.themoviedb.org': RateLimit(requests_per_second=40, max_concurrency=45, latency=0.3),
+    'api.spotify.com': RateLimit(requests_per_second=25, max_concurrency=100, latency=0.3, pause=2),
+}
+
+
+@dataclass
+class PlannedRequests:
+    """
+    Data class that represents the requests a stage would send to an endpoint
+    """
+    stage: str
+    endpoint: str
+    # None if the input of the stage does not exist yet
+    nb_requests: int = None
+    # Whether nb_requests is an upper bound, e.g. one request per movie found, planned as if all the movies were found
+    upper_bound: bool = False
+    note: str = ''
+
+
+def plan_revenue(movies: pd.DataFrame, fallback_threshold: float = None) -> list[PlannedRequests]:
+    """Plan the requests of append_movie_revenue: one search per cluster of near-duplicate titles, the fallback
+    searches of the low confidence matches, then the details of each movie found
+
+    Parameters
+    ----------
+    movies: The cleaned movies to enrich, None if they are not available
+    fallback_threshold: The title similarity under which a movie is searched again with relaxed queries, no fallback
+    search if None
+    """
+    search = endpoint_of(f'{TMDB_BASE_URL}/search/movie')
+    details = endpoint_of(f'{TMDB_BASE_URL}/movie/0')
+    if movies is None:
+        return [PlannedRequests('revenue', search, note=f'{CMU_MOVIES_PATH} is missing')]
+
+    nb_searches = len(pd.unique(cluster_titles(movies['name'], movies['release_date'])))
+    plan = [PlannedRequests('revenue', search, nb_searches,
+                            note=f'{len(movies)} movies, {len(movies) - nb_searches} near-duplicate titles')]
+    if fallback_threshold is not None:
+        # The number of low confidence matches is unknown before the searches, but the fallbacks stop at the budget
+        plan.append(PlannedRequests('revenue', search, math.ceil(FALLBACK_BUDGET * nb_searches), upper_bound=True,
+                                    note=f'fallback searches of the matches below {fallback_threshold:g}, at most '
+                                         f'{FALLBACK_BUDGET:.0%} of the searches'))
+    plan.append(PlannedRequests('revenue', details, nb_searches, upper_bound=True, note='one per movie found'))
+    return plan
+
+
+def plan_composers(enriched_movies: pd.DataFrame, nb_revenue_movies: int) -> list[PlannedRequests]:
+    """Plan the requests of append_movie_composers: the credits of each distinct movie, then the details of each
+    distinct composer, as all the requests of a step are in flight together
+
+    Parameters
+    ----------
+    enriched_movies: The movies of the previous run with their tmdb_id and composers, None if there is none
+    nb_revenue_movies: The upper bound of the movies found by the revenue stage, used without previous run
+    """
+    credits = endpoint_of(f'{TMDB_BASE_URL}/movie/0/credits')
+    person = endpoint_of(f'{TMDB_BASE_URL}/person/0')
+    if enriched_movies is None:
+        return [PlannedRequests('composers', credits, nb_revenue_movies, upper_bound=True,
+                                note='one per movie with a revenue'),
+                PlannedRequests('composers', person, note='unknown until the credits are retrieved')]
+
+    tmdb_ids = enriched_movies.tmdb_id.dropna()
+    return [PlannedRequests('composers', credits, tmdb_ids[tmdb_ids != -1].nunique()),
+            PlannedRequests('composers', person, len(get_composers(enriched_movies)))]
+
+
+def plan_spotify_composers(enriched_movies: pd.DataFrame) -> list[PlannedRequests]:
+    """Plan the requests of the Spotify composers lookup: a search of the composers missing from the composer mapping,
+    then the matched artists by batches
+
+    Parameters
+    ----------
+    enriched_movies: The movies with their composers, None if they are not available
+    """
+    search = endpoint_of(f'{SPOTIFY_BASE_URL}search')
+    artists = endpoint_of(f'{SPOTIFY_BASE_URL}artists')
+    if enriched_movies is None:
+        return [PlannedRequests('spotify_composers', search, note=f'{ENRICHED_MOVIES_PATH} is missing'),
+                PlannedRequests('spotify_composers', artists, note=f'{ENRICHED_MOVIES_PATH} is missing')]
+
+    composers = get_composers(enriched_movies)
+    mapping = load_mapping()
+    nb_new = (~composers.tmdb_person_id.isin(mapping.tmdb_person_id)).sum()
+    nb_mapped = mapping[mapping.tmdb_person_id.isin(composers.tmdb_person_id)].spotify_artist_id.nunique()
+    return [PlannedRequests('spotify_composers', search, int(nb_new),
+                            note=f'{len(composers) - nb_new} composers already in the mapping'),
+            PlannedRequests('spotify_composers', artists,
+                            math.ceil((nb_mapped + nb_new) / SpotifyDataLoader._REQUESTS_LIMIT), upper_bound=True,
+                            note=f'batches of {SpotifyDataLoader._REQUESTS_LIMIT} artists')]
+
+
+def _to_send(df: pd.DataFrame, output_path: str, identity_columns: list[str], incremental: bool) \
+        -> tuple[pd.DataFrame, str]:
+    """Select the input rows a Spotify stage of enrich_with_spotify_data sends when its output exists: none, or with
+    incremental the rows added or changed since the output, as selected by _enrich_delta
+
+    Parameters
+    ----------
+    df: The input rows of the stage
+    output_path: The dataset written by the stage, it should exist
+    identity_columns: The input columns identifying a row, see _enrich_delta
+    incremental: Whether to plan an incremental run
+
+    Returns
+    -------
+    The rows to send, and a description of the skipped rows
+    """
+    if not incremental:
+        return df.iloc[:0], f'{output_path} exists, skipped without --incremental'
+
+    hashes = compute_row_hashes(df, identity_columns)
+    to_enrich = select_delta(hashes, compute_row_hashes(pd.read_pickle(output_path), identity_columns)).to_numpy()
+    return df[to_enrich], f'{len(df) - to_enrich.sum()} unchanged since {output_path}'
+
+
+def plan_albums(enriched_movies: pd.DataFrame, spotify_composers: pd.DataFrame = None, incremental: bool = False) \
+        -> tuple[list[PlannedRequests], int]:
+    """Plan the requests of get_album_ids_into_df: a search per (movie, composer) pair missing from the checkpoint
+    log, or from the albums dataset in incremental mode, the identical names of a batch sharing their request
+
+    Parameters
+    ----------
+    enriched_movies: The movies with their composers, None if they are not available
+    spotify_composers: The Spotify artists of the composers, only the pairs of these composers are searched. All the
+    pairs are planned, as an upper bound, if None
+    incremental: Whether to plan an incremental run
+
+    Returns
+    -------
+    The planned requests, and the number of pairs searched, the upper bound of the albums found
+    """
+    search = endpoint_of(f'{SPOTIFY_BASE_URL}search')
+    if enriched_movies is None:
+        return [PlannedRequests('albums', search, note=f'{ENRICHED_MOVIES_PATH} is missing')], 0
+
+    if spotify_composers is None:
+        pairs = create_db_to_link_composers_to_movies(enriched_movies)[ALBUM_IDENTITY_COLUMNS]
+    else:
+        pairs = movies_to_search(enriched_movies, spotify_composers)
+    pairs = pairs.reset_index(drop=True)
+
+    if os.path.isfile(ALBUMS_PATH):
+        searched, skipped = _to_send(pairs, ALBUMS_PATH, ALBUM_IDENTITY_COLUMNS, incremental)
+    else:
+        store = CheckpointStore(ALBUMS_CHECKPOINT_PATH, read_only=True)
+        searched = pairs[[key not in store for key in pairs.itertuples(index=False, name=None)]]
+        skipped = f'{len(pairs) - len(searched)} in the checkpoint log'
+
+    # The batches follow the order of the movie revenue, as the albums stage
+    names = searched.movie_name[priority_order(searched.movie_revenue)].to_numpy()
+    nb_requests = sum(len(set(names[i:i + BATCH_SIZE])) for i in range(0, len(names), BATCH_SIZE))
+    return [PlannedRequests('albums', search, nb_requests, upper_bound=spotify_composers is None,
+                            note=f'{len(pairs)} pairs, {skipped}')], len(searched)
+
+
+def plan_tracks(movie_albums: pd.DataFrame, nb_albums_searched: int, incremental: bool = False) \
+        -> list[PlannedRequests]:
+    """Plan the requests of get_track_ids_into_df: the first page of the tracks of each album missing from the
+    checkpoint log, or from the tracks dataset in incremental mode, the next pages depending on the number of tracks
+
+    Parameters
+    ----------
+    movie_albums: The albums found by the previous run, None if there is none
+    nb_albums_searched: The number of pairs searched by the albums stage, used without previous run
+    incremental: Whether to plan an incremental run
+    """
+    tracks = endpoint_of(f'{SPOTIFY_BASE_URL}albums/0/tracks')
+    note = f'and one per {SpotifyDataLoader._ALBUM_TRACKS_LIMIT} tracks more'
+    if movie_albums is None:
+        return [PlannedRequests('tracks', tracks, nb_albums_searched, upper_bound=True,
+                                note=f'one per album found, {note}')]
+
+    albums = movie_albums.dropna(subset=['album_id']).drop_duplicates(subset=['movie_name'])
+    if os.path.isfile(TRACKS_PATH):
+        albums_sent, skipped = _to_send(albums, TRACKS_PATH, ALBUM_IDENTITY_COLUMNS + ['album_id'], incremental)
+        album_ids = albums_sent.album_id
+    else:
+        store = CheckpointStore(TRACKS_CHECKPOINT_PATH, read_only=True)
+        album_ids = albums.album_id[~albums.album_id.isin(store.state.keys())]
+        skipped = f'{len(albums) - len(album_ids)} albums in the checkpoint log'
+    nb_requests = sum(album_ids[i:i + BATCH_SIZE].nunique() for i in range(0, len(album_ids), BATCH_SIZE))
+    return [PlannedRequests('tracks', tracks, nb_requests, note=f'{skipped}, {note}')]
+
+
+def plan_musics(movie_albums_with_tracks: pd.DataFrame, incremental: bool = False) -> list[PlannedRequests]:
+    """Plan the requests of get_music_from_track_ids and get_audio_features_of_tracks: the tracks missing from the
+    checkpoint log, or from the musics dataset in incremental mode, and from the audio features table, by batches
+
+    Parameters
+    ----------
+    movie_albums_with_tracks: The track ids of the albums of the previous run, None if there is none
+    incremental: Whether to plan an incremental run
+    """
+    tracks = endpoint_of(f'{SPOTIFY_BASE_URL}tracks')
+    audio_features = endpoint_of(f'{SPOTIFY_BASE_URL}audio-features')
+    if movie_albums_with_tracks is None:
+        return [PlannedRequests('musics', tracks, note='unknown until the track ids are retrieved'),
+                PlannedRequests('audio_features', audio_features, note='unknown until the track ids are retrieved')]
+
+    albums_with_tracks = explode_album_tracks(movie_albums_with_tracks)
+
+    if os.path.isfile(MUSICS_PATH):
+        missing, skipped = _to_send(albums_with_tracks, MUSICS_PATH, ['album_id', 'track_ids'], incremental)
+    else:
+        store = CheckpointStore(MUSICS_CHECKPOINT_PATH, read_only=True)
+        missing = albums_with_tracks[~albums_with_tracks.track_ids.isin(store.state.keys())]
+        skipped = f'{len(albums_with_tracks) - len(missing)} tracks in the checkpoint log'
+    # The batches group the rows by index label, as the tracks of an album share the label of its row
+    rows_per_label = missing.groupby(level=0, sort=False).size().to_numpy()
+    nb_musics_requests = sum(math.ceil(rows_per_label[i:i + MUSICS_BATCH_SIZE].sum() /
+                                       SpotifyDataLoader._REQUESTS_LIMIT)
+                             for i in range(0, len(rows_per_label), MUSICS_BATCH_SIZE))
+
+    track_ids = pd.Series(albums_with_tracks.track_ids.dropna().unique())
+    stored = pd.read_parquet(AUDIO_FEATURES_PATH, columns=['track_id']).track_id if os.path.isfile(
+        AUDIO_FEATURES_PATH) else pd.Series(dtype='string')
+    nb_features = (~track_ids.isin(stored)).sum()
+
+    return [PlannedRequests('musics', tracks, nb_musics_requests,
+                            note=f'{skipped}, batches of {SpotifyDataLoader._REQUESTS_LIMIT}'),
+            PlannedRequests('audio_features', audio_features,
+                            math.ceil(nb_features / SpotifyDataLoader._AUDIO_FEATURES_LIMIT),
+                            note=f'{len(track_ids) - nb_features} tracks already stored, batches of '
+                                 f'{SpotifyDataLoader._AUDIO_FEATURES_LIMIT}')]
+
+
+def _read_if_exists(path: str) -> pd.DataFrame:
+    """Read a dataset of the previous run, None if it does not exist"""
+    return pd.read_pickle(path) if os.path.isfile(path) else None
+
+
+def plan_requests(incremental: bool = False, fallback_threshold: float = None) -> list[PlannedRequests]:
+    """Plan the requests of all the stages of the enrichment
+
+    Parameters
+    ----------
+    incremental: Whether to plan an incremental run, the rows processed by the previous run are not searched again
+    fallback_threshold: The title similarity under which a movie is searched again by the revenue stage, see
+    plan_revenue
+
+    Returns
+    -------
+    The requests of each stage, per endpoint
+    """
+    movies = clean_movies(load_movies(CMU_MOVIES_PATH)) if os.path.isfile(CMU_MOVIES_PATH) else None
+    enriched_movies = _read_if_exists(ENRICHED_MOVIES_PATH)
+
+    # The movies are selected as by create_enhanced_movie_dataset
+    if movies is not None and incremental and enriched_movies is not None:
+        hashes = compute_row_hashes(movies, IDENTITY_COLUMNS, CONTENT_COLUMNS)
+        processed = load_processed_hashes(PROCESSED_HASHES_PATH) if os.path.isfile(PROCESSED_HASHES_PATH) \
+            else hashes_from_snapshot(enriched_movies, IDENTITY_COLUMNS)
+        movies = movies[select_delta(hashes, processed).to_numpy()]
+
+    plan = plan_revenue(movies, fallback_threshold)
+    # A new incremental run only requests the credits of the new movies
+    plan += plan_composers(None if incremental else enriched_movies, plan[0].nb_requests or 0)
+    plan += plan_spotify_composers(enriched_movies)
+    albums_plan, nb_albums_searched = plan_albums(enriched_movies, _read_if_exists(SPOTIFY_COMPOSERS_PATH),
+                                                  incremental)
+    plan += albums_plan
+    plan += plan_tracks(_read_if_exists(ALBUMS_PATH), nb_albums_searched, incremental)
+    plan += plan_musics(_read_if_exists(TRACKS_PATH), incremental)
+
+    return plan
+
+
+def estimate_time(planned: PlannedRequests, rate_limits: dict[str, RateLimit] = None) -> float:
+    """Estimate the wall time of the requests to an endpoint
+
+    Parameters
+    ----------
+    planned: The planned requests
+    rate_limits: The rate limit of each host, RATE_LIMITS if None
+
+    Returns
+    -------
+    The time in seconds, nan if the number of requests is unknown
+    """
+    rate_limits = rate_limits or RATE_LIMITS
+    if planned.nb_requests is None:
+        return np.nan
+
+    return planned.nb_requests / rate_limits[planned.endpoint.split('/')[0]].throughput
+
+
+def report(plan: list[PlannedRequests], rate_limits: dict[str, RateLimit] = None) -> str:
+    """Summary of the planned requests, with the estimated time of each stage and of the whole run
+
+    Parameters
+    ----------
+    plan: The planned requests, see plan_requests
+    rate_limits: The rate limit of each host, RATE_LIMITS if None
+
+    Returns
+    -------
+    The summary, to be printed
+    """
+    lines = []
+    total_requests, total_time = 0, 0
+    for planned in plan:
+        time_needed = estimate_time(planned, rate_limits)
+        if planned.nb_requests is None:
+            count = 'unknown'
+        else:
+            count = f'{"at most " if planned.upper_bound else ""}{planned.nb_requests} requests, ' \
+                    f'~{time_needed / 60:.1f}min'
+            total_requests += planned.nb_requests
+            total_time += time_needed
+        lines.append(f'{planned.stage:<18} {planned.endpoint:<45} {count}' + (f' ({planned.note})' if planned.note
+                                                                               else ''))
+
+    lines.append(f'Total: {total_requests} requests, ~{total_time / 3600:.1f}h, excluding the unknown counts')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan the requests of the enrichment without sending them')
+    parser.add_argument('--incremental', action='store_true',
+                        help='plan an incremental run, only the movies added or changed since the previous run')
+    parser.add_argument('--fallback-threshold', type=float,
+                        help='plan the fallback searches of the movies matched below this title similarity (0-100)')
+    parser.add_argument('--tmdb-rps', type=float, default=RATE_LIMITS['api.themoviedb.org'].requests_per_second,
+                        help='requests per second allowed by TMDB')
+    parser.add_argument('--spotify-rps', type=float, default=RATE_LIMITS['api.spotify.com'].requests_per_second,
+                        help='requests per second allowed by Spotify')
+    args = parser.parse_args()
+
+    RATE_LIMITS['api.themoviedb.org'].requests_per_second = args.tmdb_rps
+    RATE_LIMITS['api.spotify.com'].requests_per_second = args.spotify_rps
+
+    print(report(plan_requests(args.incremental, args.fallback_threshold)))
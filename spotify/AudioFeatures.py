@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class AudioFeatures:
+    """
+    Data class that represent the audio features of a music track from Spotify
+    """
+    track_id: str
+    danceability: float
+    energy: float
+    key: int
+    loudness: float
+    mode: int
+    speechiness: float
+    acousticness: float
+    instrumentalness: float
+    liveness: float
+    valence: float
+    tempo: float
+    duration_ms: int
+    time_signature: int
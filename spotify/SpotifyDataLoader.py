@@ -7,36 +7,66 @@ import pandas as pd
 from aiohttp import ClientResponseError
 
 from config import config, reload_env_config
+from network.resilience import ResilientRequester
+from network.single_flight import SingleFlight
+from spotify.AudioFeatures import AudioFeatures
 from spotify.Composer_Spotify import ComposerSpotify
 from spotify.Music import Music
 
+SPOTIFY_BASE_URL = 'https://api.spotify.com/v1/'
+
 
 class SpotifyDataLoader:
-    def __init__(self):
+    def __init__(self, session: aiohttp.ClientSession = None):
+        """
+        Parameters
+        ----------
+        session: A session shared with other loaders (see network.session_pool), left open when the block is exited.
+        A new session is created if None
+        """
         reload_env_config()
-        self._tcp_connector = aiohttp.TCPConnector(limit=50)
         self._header = {
             'Authorization': f'Bearer {config["SPOTIFY_ACCESS_TOKEN"]}',
             'Content-Type': 'application/json',
         }
-        timeout = aiohttp.ClientTimeout(total=None)
-        self._session = aiohttp.ClientSession(connector=self._tcp_connector, headers=self._header, timeout=timeout)
-        self._base_url = 'https://api.spotify.com/v1/'
+        self._shared_session = session
+        if session is None:
+            self._tcp_connector = aiohttp.TCPConnector(limit=50)
+            timeout = aiohttp.ClientTimeout(total=None)
+            session = aiohttp.ClientSession(connector=self._tcp_connector, headers=self._header, timeout=timeout)
+        self._session = session
+        self._base_url = SPOTIFY_BASE_URL
+        # Kept when the config is reloaded, so that the counters cover the whole block
+        if not hasattr(self, 'single_flight'):
+            # Concurrent requests of the same url (e.g. the same artist of several tracks) share one request
+            self.single_flight = SingleFlight()
+            # Latency-aware timeouts, hedging and circuit breakers per endpoint, so that a stuck request or a failing
+            # endpoint is retried alone instead of restarting the whole batch
+            self.resilience = ResilientRequester()
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._session.close()
+        if self._shared_session is None:
+            await self._session.close()
+        print(f'Spotify: {self.single_flight.report()}')
+        print(f'Spotify: {self.resilience.report()}')
 
     _REQUESTS_LIMIT = 49
 
+    # Maximum number of ids of an audio features request
+    _AUDIO_FEATURES_LIMIT = 100
+
+    # Maximum number of tracks of a page of an album
+    _ALBUM_TRACKS_LIMIT = 50
+
     def reload_config(self):
         """Reload the config file"""
-        self.__init__()
+        self.__init__(self._shared_session)
 
     async def _perform_async_request(self, url: str):
-        """Perform specific request asynchronously given a URL
+        """Perform specific request asynchronously given a URL, or wait for the identical request in flight
 
         Parameters
         ----------
@@ -44,31 +74,51 @@ class SpotifyDataLoader:
 
         Return
         ------
-        Result of the request
+        Result of the request, shared with the identical requests so it should not be modified
         """
+        return await self.single_flight.do(url, lambda: self._perform_paced_request(url))
 
-        try:
-            async with self._session.get(url) as response:
-                try:
-                    response.raise_for_status()
-                except ClientResponseError as e:
-                    print(f'Error while performing request: {e}')
-                    if response.headers.get("Retry-After"):
-                        print(f"Sleeping for {response.headers.get('Retry-After')} seconds")
-                        await asyncio.sleep(int(response.headers.get('Retry-After')))
-                        raise e
-                    else:
-                        raise e
+    async def _perform_paced_request(self, url: str):
+        """Perform a request through the resilience layer, and wait between the requests to respect the rate limit.
+        The waits are kept out of the request, so that they are not counted in its latency
 
-                await asyncio.sleep(2)
-                return await response.json()
+        Parameters
+        ----------
+        url: correct formatted endpoint/url
+
+        Return
+        ------
+        Result of the request
+        """
+        try:
+            response = await self.resilience.call(url, lambda: self._perform_request(url))
         except ClientResponseError as e:
+            print(f'Error while performing request: {e}')
             if e.status == 400:
-                print(f'Error while performing request: {e}')
                 return None
-            print(f'Error while performing request: {e}')
+            if e.headers and e.headers.get("Retry-After"):
+                print(f"Sleeping for {e.headers.get('Retry-After')} seconds")
+                await asyncio.sleep(int(e.headers.get('Retry-After')))
             raise e
 
+        await asyncio.sleep(2)
+        return response
+
+    async def _perform_request(self, url: str):
+        """Perform specific request asynchronously given a URL
+
+        Parameters
+        ----------
+        url: correct formatted endpoint/url
+
+        Return
+        ------
+        Result of the request
+        """
+        async with self._session.get(url, headers=self._header) as response:
+            response.raise_for_status()
+            return await response.json()
+
     async def _perform_async_batch_request(self, url: str, args: list, batch_size: int = 100, lists=False) -> list:
         """Perform specific request asynchronously given a URL
 
@@ -109,7 +159,9 @@ class SpotifyDataLoader:
 
     async def get_albums_tracks_async(self, albums_ids: list[str]) -> list:
         """
-        Get the tracks ids of all the albums
+        Get the tracks ids of all the albums. The first page of each album gives its total number of tracks, then all
+        the remaining pages of all the albums are requested at once by offset, so that an album costs two round trips
+        whatever its number of tracks
 
         Parameters
         ----------
@@ -118,13 +170,24 @@ class SpotifyDataLoader:
 
         Return
         ------
-        tracks_ids: list[str]
-            List of tracks ids
+        tracks_ids: list[list[str]]
+            List of tracks ids of each album, in the order of albums_ids, empty for an album without tracks
         """
-        tracks = await self._perform_async_batch_request(f'{self._base_url}albums/%s/tracks',
-                                                         [album_id for album_id in albums_ids])
-
-        tracks_items = [t['items'] for t in tracks if t['items']]
+        url = f'{self._base_url}albums/%s/tracks?limit={self._ALBUM_TRACKS_LIMIT}'
+        first_pages = await self._perform_async_batch_request(url, list(albums_ids))
+
+        remaining_pages = [(album_nb, offset) for album_nb, page in enumerate(first_pages) if page
+                           for offset in range(self._ALBUM_TRACKS_LIMIT, page['total'], self._ALBUM_TRACKS_LIMIT)]
+        next_pages = await self._perform_async_batch_request(url + '&offset=%d',
+                                                             [(albums_ids[album_nb], offset)
+                                                              for album_nb, offset in remaining_pages])
+
+        # The pages are gathered in order, so that the tracks of an album keep their order. The items are copied, as a
+        # response may be shared by identical requests
+        tracks_items = [list(page['items']) if page else [] for page in first_pages]
+        for (album_nb, _), page in zip(remaining_pages, next_pages):
+            if page:
+                tracks_items[album_nb] += page['items']
 
         tracks_ids = []
         ban_words = ["Remastered", "Remaster", "remaster", "live", "Live", "Bonus"]
@@ -172,6 +235,49 @@ class SpotifyDataLoader:
 
         return tracks, genres
 
+    async def get_audio_features(self, tracks_ids: list[str]) -> list[AudioFeatures]:
+        """
+        Get the audio features of tracks, with one request per 100 tracks
+
+        Parameters
+        ----------
+        tracks_ids: list[str]
+            List of tracks ids, without duplicates
+
+        Return
+        ------
+        audio_features: list[AudioFeatures]
+            List of the audio features found, the tracks without audio features are missing
+        """
+        batched_track_ids = [",".join(tracks_ids[i:i + self._AUDIO_FEATURES_LIMIT]) for i in
+                             range(0, len(tracks_ids), self._AUDIO_FEATURES_LIMIT)]
+
+        results = await self._perform_async_batch_request(f'{self._base_url}audio-features?ids=%s', batched_track_ids)
+
+        audio_features = []
+        for result in results:
+            if not result:
+                continue
+            for features in result['audio_features']:
+                if features:
+                    audio_features.append(AudioFeatures(
+                        track_id=features['id'],
+                        danceability=features['danceability'],
+                        energy=features['energy'],
+                        key=features['key'],
+                        loudness=features['loudness'],
+                        mode=features['mode'],
+                        speechiness=features['speechiness'],
+                        acousticness=features['acousticness'],
+                        instrumentalness=features['instrumentalness'],
+                        liveness=features['liveness'],
+                        valence=features['valence'],
+                        tempo=features['tempo'],
+                        duration_ms=features['duration_ms'],
+                        time_signature=features['time_signature'],
+                    ))
+        return audio_features
+
     def get_music_from_track(self, track: dict, genre: list[str]) -> Music:
         """Get the music Object from a track
 
@@ -220,25 +326,28 @@ class SpotifyDataLoader:
             albums.append([result1['albums']['items'] for result1 in result if result1['albums']['items']])
         return albums[0]
 
-    async def search_composers_by_name(self, names: list[str]) -> list[str]:
+    async def search_artist_candidates(self, names: list[str], limit: int = 5) -> list[list[ComposerSpotify]]:
         """
-        Search for the composer ids given a list of composer names
+        Search the artists matching each composer name, to be matched against the name (see composer_matching)
 
         Parameters
         ----------
         names: list[str]
             List of composer names
 
+        limit: int
+            Number of artists returned per name
+
         Return
         ------
-        composer_ids: list[str]
-            List of composer ids
+        candidates: list[list[ComposerSpotify]]
+            List of the artists found for each name, in the order of names, empty for a name without any artist
         """
-        results = await self._perform_async_batch_request(f'{self._base_url}search?q=%s&type=artist&limit=1',
+        results = await self._perform_async_batch_request(f'{self._base_url}search?q=%s&type=artist&limit={limit}',
                                                           [urllib.parse.quote(name) for name in names])
 
-        composer_ids = [result['artists']['items'][0]['id'] for result in results if result['artists']['items']]
-        return composer_ids
+        return [[self._parse_composer(item) for item in result['artists']['items'] if item] if result else []
+                for result in results]
 
     async def get_composers_by_id(self, composers_id: list[str]) -> list[ComposerSpotify]:
         """
@@ -254,35 +363,29 @@ class SpotifyDataLoader:
         composers_parsed = []
         for c in composers:
             try:
-                composers_parsed.append(ComposerSpotify(
-                    id=c['id'],
-                    name=c['name'],
-                    genres=c['genres'],
-                    followers=c['followers']['total'],
-                    popularity=c['popularity'],
-                ))
+                composers_parsed.append(self._parse_composer(c))
             except Exception as e:
                 print(e)
                 print(c)
         return composers_parsed
 
-    async def create_composers_table(self, composers_names: list[str]):
-        """Create the composers table
+    @staticmethod
+    def _parse_composer(artist: dict) -> ComposerSpotify:
+        """Get the composer Object from an artist
 
         Parameters
         ----------
-        composers_names: list[str]
-            List of composers names
+        artist: dict
+            dict of the artist
 
         Return
-        -----
-        composers: pd.DataFrame
-            Dataframe of the composers
+        ------
+        composer: ComposerSpotify
         """
-        composers_ids = await self.search_composers_by_name(composers_names)
-
-        print("Composers: ", len(composers_ids))
-
-        composers = await self.get_composers_by_id(composers_ids)
-
-        return pd.DataFrame(composers)
+        return ComposerSpotify(
+            id=artist['id'],
+            name=artist['name'],
+            genres=artist['genres'],
+            followers=artist['followers']['total'],
+            popularity=artist['popularity'],
+        )
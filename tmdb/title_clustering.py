@@ -0,0 +1,53 @@
+"""
+Clustering of the near-duplicate movie titles before they are searched on TMDB. The CMU dataset lists some movies
+several times under variants of their title (case, punctuation, accents, a leading or trailing "The"), which only
+differ by their search url, so each variant was searched, and _filter_dataset later dropped the duplicate ids.
+
+The titles are blocked on a normalized key within the same release year: the movies sharing a key form a cluster,
+whose first movie is searched and shares its result with the other members.
+"""
+import re
+
+import numpy as np
+import pandas
+
+from helpers import normalize_words
+
+# Article at the start of a title, or moved at its end as in "Matrix, The"
+_ARTICLES = re.compile(r'^(?:the|a|an) | (?:the|a|an)$')
+
+
+def normalize_title(title: str) -> str:
+    """Normalize a movie title: remove accents, case, punctuation and the leading or trailing article, e.g.
+    'The Matrix', 'Matrix, The' and 'THE MATRIX!' are all 'matrix'
+
+    Parameters
+    ----------
+    title: The title to normalize
+
+    Returns
+    -------
+    The normalized title, empty for a title without any word
+    """
+    return _ARTICLES.sub('', normalize_words(title)).strip()
+
+
+def cluster_titles(names: pandas.Series, years: pandas.Series) -> np.ndarray:
+    """Cluster the movies whose titles only differ by their normalization, within the same release year
+
+    Parameters
+    ----------
+    names: The title of each movie
+    years: The release year of each movie, aligned with names
+
+    Returns
+    -------
+    The position of the representative of each movie, i.e. the first movie of its cluster, aligned with names
+    """
+    keys = names.map(normalize_title)
+    # A title without any word is only clustered with its exact duplicates
+    keys = keys.where(keys != '', names)
+
+    positions = pandas.Series(np.arange(len(names)), index=names.index)
+    return positions.groupby([keys.to_numpy(), years.to_numpy()], sort=False, dropna=False).transform('first') \
+        .to_numpy()
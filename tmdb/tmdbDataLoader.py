@@ -1,6 +1,11 @@
 import asyncio
 import datetime
+import json
+import os
 import urllib.parse
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass
 from datetime import datetime
 
 import aiohttp
@@ -9,9 +14,34 @@ import pandas
 from requests.exceptions import HTTPError
 
 from config import config
+from network.priority import PriorityScheduler
+from network.resilience import ResilientRequester
+from network.single_flight import SingleFlight
 from tmdb.Composer import Composer
+from tmdb.title_clustering import cluster_titles
 from rapidfuzz import fuzz
 
+TMDB_BASE_URL = "https://api.themoviedb.org/3"
+
+# Default maximum number of fallback searches, as a share of the searches by name and year
+FALLBACK_BUDGET = 0.1
+
+
+@dataclass
+class FallbackStats:
+    """
+    Data class that gathers the counters of the fallback searches of a TMDBDataLoader
+    """
+    # Searches of the movies by name and year, the base of the fallback budget
+    nb_searches: int = 0
+    # Movies not found or matched below the threshold by their search
+    nb_low_confidence: int = 0
+    nb_fallback_requests: int = 0
+    # Movies matched above the threshold by a fallback search
+    nb_rescued: int = 0
+    # Movies whose fallback searches were stopped because the budget was spent
+    nb_budget_exhausted: int = 0
+
 
 class TMDBDataLoader:
     """
@@ -25,22 +55,56 @@ class TMDBDataLoader:
             ...
     """
 
-    def __init__(self, debug=True):
-        # Create special connector to limit number of connection per host
-        self._tcp_connector = aiohttp.TCPConnector(limit_per_host=50)
-        # Create header to use with the session
+    # Number of search responses matched together in the process pool
+    _MATCH_BATCH_SIZE = 500
+
+    # Number of movies in flight when they are fetched by priority
+    _PRIORITY_CONCURRENCY = 50
+
+    def __init__(self, debug=True, executor: Executor = None, session: aiohttp.ClientSession = None,
+                 fallback_threshold: float = None, fallback_budget: float = FALLBACK_BUDGET):
+        """
+        Parameters
+        ----------
+        debug: Whether to print the progress of the requests
+        executor: The executor running the CPU bound matching, a process pool is created on first use if None
+        session: A session shared with other loaders (see network.session_pool), left open when the block is exited.
+        A new session is created if None
+        fallback_threshold: If given, a movie not found or matched with a title similarity (0-100) below this threshold
+        is searched again with relaxed queries, see _search_movie_fallbacks
+        fallback_budget: The maximum number of fallback searches, as a share of the searches by name and year
+        """
+        # Create header to send with each request
         self._header = headers = {"accept": "application/json",
                                   "Authorization": f"Bearer {config['TMDB_BEARER_TOKEN']}"}
 
-        # create a timeout set to None, to bypass the timeout and prevent error after 5min, which is the default timeout
-        timeout = aiohttp.ClientTimeout(total=None)
-        # create the session
-        self._session = aiohttp.ClientSession(headers=headers, connector=self._tcp_connector, timeout=timeout)
+        self._own_session = session is None
+        if self._own_session:
+            # Create special connector to limit number of connection per host
+            self._tcp_connector = aiohttp.TCPConnector(limit_per_host=50)
+            # create a timeout set to None, to bypass the timeout and prevent error after 5min, which is the default
+            # timeout
+            timeout = aiohttp.ClientTimeout(total=None)
+            # create the session
+            session = aiohttp.ClientSession(headers=headers, connector=self._tcp_connector, timeout=timeout)
+        self._session = session
 
-        self._base_url = "https://api.themoviedb.org/3"
+        self._base_url = TMDB_BASE_URL
 
         self._debug = debug
 
+        self._executor = executor
+        self._own_executor = executor is None
+
+        # Concurrent requests of the same url (e.g. duplicate titles, composers of several movies) share one request
+        self.single_flight = SingleFlight()
+        # Latency-aware timeouts, hedging and circuit breakers per endpoint, as the session has no timeout
+        self.resilience = ResilientRequester()
+
+        self._fallback_threshold = fallback_threshold
+        self._fallback_budget = fallback_budget
+        self.fallback_stats = FallbackStats()
+
     async def __aenter__(self):
         """ Method called when entering the 'async with' block
 
@@ -52,11 +116,50 @@ class TMDBDataLoader:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """
-        Method called when exiting the 'async with' block, to close the session
+        Method called when exiting the 'async with' block, to close the session if it is not shared
         """
-        await self._session.close()
+        if self._own_session:
+            await self._session.close()
+        if self._own_executor and self._executor is not None:
+            # The shutdown waits for the worker processes, it runs in a thread so that it does not block the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        if self._debug:
+            print(f'TMDB: {self.single_flight.report()}')
+            print(f'TMDB: {self.resilience.report()}')
+            if self._fallback_threshold is not None:
+                print(f'TMDB: {self.fallback_report()}')
+
+    def fallback_report(self) -> str:
+        """Summary of the fallback searches
+
+        Returns
+        -------
+        The summary, to be printed
+        """
+        stats = self.fallback_stats
+        extra_cost = stats.nb_fallback_requests / stats.nb_searches if stats.nb_searches else 0
+        return (f'{stats.nb_searches} movie searches, {stats.nb_low_confidence} below the match threshold, '
+                f'{stats.nb_rescued} rescued by {stats.nb_fallback_requests} fallback searches ({extra_cost:.1%} extra '
+                f'requests), {stats.nb_budget_exhausted} stopped by the budget')
 
     async def _perform_async_request(self, url: str, request_nb: int, request_descr: str):
+        """Perform specific request asynchronously given a URL, or wait for the identical request in flight
+
+        Parameters
+        ----------
+        url: correct formatted endpoint/url
+        request_nb: The index of the request we are processing, to be able to print a debug status of the
+        execution status
+        request_descr: A quick description of the request, to have a context in the debug print
+
+        Return
+        ------
+        Result of the request, shared with the identical requests so it should not be modified
+        """
+        return await self.single_flight.do(url, lambda: self.resilience.call(
+            url, lambda: self._perform_request(url, request_nb, request_descr)))
+
+    async def _perform_request(self, url: str, request_nb: int, request_descr: str):
         """Perform specific request asynchronously given a URL
 
         Parameters
@@ -72,7 +175,7 @@ class TMDBDataLoader:
         """
 
         try:
-            async with self._session.get(url) as response:
+            async with self._session.get(url, headers=self._header) as response:
                 response.raise_for_status()
                 response = await response.json()
                 if self._debug and request_nb % 1000 == 0:
@@ -110,18 +213,52 @@ class TMDBDataLoader:
         The list of movie ids along with the title of the found movie, duplicate element
         """
 
-        ids_requests_name_year = [(self._perform_async_request(url, int(idx), 'request movie id'), name, year)
-                                  for idx, (url, name, year) in urls.items()]
+        searches = [asyncio.ensure_future(self._perform_async_request(url, int(idx), 'request movie id'))
+                    for idx, (url, _, _) in urls.items()]
+        self.fallback_stats.nb_searches += len(searches)
+        names = [name for _, name, _ in urls]
+        years = [year for _, _, year in urls]
+
+        # Match each batch of responses in the process pool as soon as it is complete, while the searches of the next
+        # batches are still in flight, so that the matching overlaps with the network
+        matches = []
+        try:
+            for start in range(0, len(searches), self._MATCH_BATCH_SIZE):
+                end = start + self._MATCH_BATCH_SIZE
+                ids_responses = await asyncio.gather(*searches[start:end])
+
+                results = [response['results'] for response in ids_responses]
+                matches.append(asyncio.ensure_future(self._run_cpu_bound(
+                    self._get_best_match_movie_id, list(zip(results, names[start:end], years[start:end])))))
+
+            matched = await asyncio.gather(*matches)
+        except Exception:
+            for task in searches + matches:
+                task.cancel()
+            raise
 
-        urls, names, years = zip(*ids_requests_name_year)
+        id_results = [movie_id for movie_ids, _ in matched for movie_id in movie_ids]
+        name_results = [movie_name for _, movie_names in matched for movie_name in movie_names]
 
-        ids_responses = await asyncio.gather(*urls)
+        return id_results, name_results
 
-        results = map(lambda response: response['results'], ids_responses)
+    async def _run_cpu_bound(self, function, *args):
+        """Run a CPU bound function (e.g. the matching of the movies) in the executor, so that the event loop keeps
+        handling the network responses meanwhile
 
-        results_name = zip(results, names, years)
+        Parameters
+        ----------
+        function: The function to run, it should be picklable when the executor is a process pool
+        args: The arguments of the function
+
+        Returns
+        -------
+        The result of the function
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor()
 
-        return self._get_best_match_movie_id(results_name)  # [res[0]['id'] if res else -1 for res in results]
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
 
     @staticmethod
     def _get_best_match_movie_id(results_with_expected_name: zip) -> tuple[list, list]:
@@ -149,8 +286,9 @@ class TMDBDataLoader:
                 movies_titles += [movie['original_title'] for movie in movies]  # append all original titles
                 comparison_ratio = [fuzz.ratio(t.lower(), title.lower()) for t in movies_titles]
 
-                # As we now concatenate title with original_title, we have to duplicate the movies list as well
-                movies += movies
+                # As we now concatenate title with original_title, we have to duplicate the movies list as well. A new
+                # list is created, as the response may be shared by several identical requests
+                movies = movies + movies
                 max_ratio = np.argmax(comparison_ratio)
                 max_ratio_occurrences = np.where(np.array(comparison_ratio) == comparison_ratio[max_ratio])[0]
                 if len(max_ratio_occurrences) > 1:
@@ -237,13 +375,25 @@ class TMDBDataLoader:
         request_person = [self._perform_async_request(url, idx, 'request person details') for url in person_urls]
         responses_person = await asyncio.gather(*request_person)
 
-        composers = map(
-            lambda r: Composer(r['id'], r['name'], r['birthday'], r['gender'], r['homepage'], r['place_of_birth'],
-                               self._find_oldest_date_credits(r['movie_credits'])),
-            responses_person)
+        composers = map(self._parse_composer, responses_person)
 
         return list(composers)
 
+    @classmethod
+    def _parse_composer(cls, person: dict) -> Composer:
+        """Create a Composer from the response of a person details request
+
+        Parameters
+        ----------
+        person: The person details, with the movie credits appended
+
+        Returns
+        -------
+        The composer
+        """
+        return Composer(person['id'], person['name'], person['birthday'], person['gender'], person['homepage'],
+                        person['place_of_birth'], cls._find_oldest_date_credits(person['movie_credits']))
+
     @staticmethod
     def _find_oldest_date_credits(credit) -> str:
         """Given all the credit in which a given composer appear, find the date of the first movie for which he has
@@ -308,6 +458,9 @@ class TMDBDataLoader:
         result.query('tmdb_id != -1', inplace=True)
 
         duplicated_tmdb_id = result[result.tmdb_id.duplicated(keep=False)][['tmdb_id', 'name', 'tmdb_title']]
+        if duplicated_tmdb_id.empty:
+            # Common once the near-duplicate titles are clustered, and the apply below needs at least one group
+            return result.drop(columns='tmdb_title')
 
         # Extract unique id for the name of the movie that has the highest similarity with the one found on tmdb
         best_unique_id = duplicated_tmdb_id.groupby('tmdb_id').apply(lambda grouped_df: grouped_df.apply(
@@ -342,6 +495,89 @@ class TMDBDataLoader:
             end += chunk_size
         yield start, end, df.iloc[start:len(df)]
 
+    def _search_movie_url(self, name: str, year: str = None, page: int = 1) -> str:
+        """Create the url searching a movie by its name and release year
+
+        Parameters
+        ----------
+        name: The name of the movie
+        year: The release year of the movie, the movies of any year are searched if None
+        page: The page of the results
+
+        Returns
+        -------
+        The url of the search request
+        """
+        return (f"{self._base_url}/search/movie?"
+                f"query={urllib.parse.quote(name)}&"
+                f"include_adult=true&"
+                f"language=en-US&"
+                f"page={page}" + (f"&year={year}" if year is not None else ""))
+
+    def _fallback_queries(self, name: str, year: str) -> list[tuple[str, str]]:
+        """The relaxed searches of a movie, from the most to the least likely to find it: without the year, with the
+        previous and next years (release dates differ between countries), then the second page of the results
+
+        Parameters
+        ----------
+        name: The name of the movie
+        year: The release year of the movie
+
+        Returns
+        -------
+        The url of each search, with the year expected by the matching
+        """
+        # The matching breaks the ties with the expected year, the queries relaxing the year accept any release date
+        queries = [(self._search_movie_url(name), '')]
+        if str(year).isdigit():
+            queries += [(self._search_movie_url(name, str(int(year) + shift)), '') for shift in (-1, 1)]
+        queries.append((self._search_movie_url(name, year, page=2), year))
+        return queries
+
+    @staticmethod
+    def _match_score(name: str, tmdb_id: int, tmdb_title: str) -> float:
+        """The similarity (0-100) between the name of a movie and the title of the tmdb movie matched, 0 if the movie
+        was not found"""
+        return 0 if tmdb_id == -1 else fuzz.ratio(name.lower(), tmdb_title.lower())
+
+    async def _search_movie_fallbacks(self, request_nb: int, name: str, year: str, tmdb_id: int, tmdb_title: str) \
+            -> tuple[int, str]:
+        """Search a movie again with relaxed queries if its search did not find it, or matched it below the
+        threshold. The queries are tried in order until one of them matches above the threshold, or the global budget
+        of fallback searches is spent
+
+        Parameters
+        ----------
+        request_nb: The position of the movie, for the debug print
+        name: The name of the movie
+        year: The release year of the movie
+        tmdb_id: The tmdb id matched by the search by name and year, -1 if the movie was not found
+        tmdb_title: The tmdb title matched by the search by name and year
+
+        Returns
+        -------
+        The tmdb id and title of the movie, the ones of the first search unless a fallback matched above the threshold
+        """
+        if self._match_score(name, tmdb_id, tmdb_title) >= self._fallback_threshold:
+            return tmdb_id, tmdb_title
+
+        self.fallback_stats.nb_low_confidence += 1
+        for url, expected_year in self._fallback_queries(name, year):
+            # Checked and counted before the request, so that the concurrent fallbacks do not exceed the budget
+            if self.fallback_stats.nb_fallback_requests >= self._fallback_budget * self.fallback_stats.nb_searches:
+                self.fallback_stats.nb_budget_exhausted += 1
+                break
+            self.fallback_stats.nb_fallback_requests += 1
+
+            response = await self._perform_async_request(url, request_nb, 'request movie id fallback')
+            movie_ids, movie_names = self._get_best_match_movie_id([(response['results'], name, expected_year)])
+            if self._match_score(name, movie_ids[0], movie_names[0]) >= self._fallback_threshold:
+                self.fallback_stats.nb_rescued += 1
+                return movie_ids[0], movie_names[0]
+
+        # A fallback match below the threshold is not more reliable than the first one
+        return tmdb_id, tmdb_title
+
     async def append_tmdb_movie_ids(self, df: pandas.DataFrame, filter_dataset: bool = True) -> pandas.DataFrame:
         """Retrieve list of ids for the received dataframe
 
@@ -355,26 +591,67 @@ class TMDBDataLoader:
         A copy of the received dataframe where the tmdb movie ids were append
         """
 
-        search_movies_urls_name_year = df.agg(lambda entry: (f"{self._base_url}/search/movie?"
-                                                             f"query={urllib.parse.quote(entry['name'])}&"
-                                                             f"include_adult=true&"
-                                                             f"language=en-US&"
-                                                             f"page=1&year={entry['release_date']}",
-                                                             entry['name'], entry['release_date']),
-                                              axis='columns')
+        # The near-duplicate titles of a year are searched once, by the first movie of their cluster
+        representatives = cluster_titles(df['name'], df['release_date'])
+        searched = pandas.unique(representatives)
+        if self._debug and len(searched) < len(df):
+            print(f'{len(df) - len(searched)} near-duplicate titles share the search of another movie')
+
+        search_movies_urls_name_year = df.iloc[searched].agg(
+            lambda entry: (self._search_movie_url(entry['name'], entry['release_date']), entry['name'],
+                           entry['release_date']), axis='columns')
 
         # perform the async request
         movie_ids, movie_names = await self._search_all_movie_ids(search_movies_urls_name_year)
 
+        if self._fallback_threshold is not None and movie_ids:
+            matches = await asyncio.gather(*[
+                self._search_movie_fallbacks(int(idx), name, year, movie_id, movie_name)
+                for (idx, (_, name, year)), movie_id, movie_name in zip(search_movies_urls_name_year.items(),
+                                                                          movie_ids, movie_names)])
+            movie_ids = [movie_id for movie_id, _ in matches]
+            movie_names = [movie_name for _, movie_name in matches]
+
         res_df = df.copy()
-        res_df['tmdb_id'] = movie_ids
-        res_df['tmdb_title'] = movie_names
+        # The members of a cluster share the result of its representative
+        res_df['tmdb_id'] = pandas.Series(movie_ids, index=searched).reindex(representatives).to_numpy()
+        res_df['tmdb_title'] = pandas.Series(movie_names, index=searched, dtype='object') \
+            .reindex(representatives).to_numpy()
 
         if filter_dataset:
-            res_df = self._filter_dataset(res_df)
+            res_df = await self._run_cpu_bound(self._filter_dataset,
+                                               self._keep_best_cluster_members(res_df, representatives))
 
         return res_df
 
+    @staticmethod
+    def _keep_best_cluster_members(df: pandas.DataFrame, clusters: np.ndarray) -> pandas.DataFrame:
+        """Keep the member of each cluster of near-duplicate titles whose name is the closest to the tmdb title. The
+        members share the same tmdb id, so _filter_dataset would only keep this one, but after comparing them all with
+        the other movies of the same id
+
+        Parameters
+        ----------
+        df: The movies with their 'tmdb_id' and 'tmdb_title'
+        clusters: The cluster of each movie, e.g. the position of its representative returned by cluster_titles
+
+        Returns
+        -------
+        The movies, without the other members of the clusters
+        """
+        in_cluster = (pandas.Series(clusters).groupby(clusters).transform('size') > 1).to_numpy()
+        if not in_cluster.any():
+            return df
+
+        members = df[in_cluster]
+        scores = pandas.Series([fuzz.ratio(name.lower(), title.lower())
+                                for name, title in zip(members['name'], members['tmdb_title'])])
+        best = scores.groupby(clusters[in_cluster]).idxmax().to_numpy()
+
+        keep = ~in_cluster
+        keep[np.flatnonzero(in_cluster)[best]] = True
+        return df[keep]
+
     async def append_movie_composers(self, df: pandas.DataFrame, filter_dataset: bool = True) -> pandas.DataFrame:
         """Retrieve the composer for the received dataframe
 
@@ -406,8 +683,8 @@ class TMDBDataLoader:
 
         return res_df
 
-    async def append_movie_revenue(self, df: pandas.DataFrame, chunk_size=15000, filter_dataset: bool = True) \
-            -> pandas.DataFrame:
+    async def append_movie_revenue(self, df: pandas.DataFrame, chunk_size=15000, filter_dataset: bool = True,
+                                   priority: pandas.Series = None, time_budget: float = None) -> pandas.DataFrame:
         """Retrieve the revenue for the received dataframe
 
         Parameters
@@ -416,10 +693,16 @@ class TMDBDataLoader:
         chunk_size: The size of the chunk
         filter_dataset: Whether to filter movies that were not found on tmdb and filter movies for which the same
         tmdb_id was returned.
+        priority: The priority of each movie, aligned with df (e.g. the known box office revenue). If given, or if a
+        time budget is given, the movies are fetched one by one by decreasing priority instead of by chunks, see
+        _append_movie_revenue_by_priority
+        time_budget: The number of seconds after which no new movie is fetched, no limit if None
         Return
         ------
         A copy of the received dataframe where the composers were append
         """
+        if priority is not None or time_budget is not None:
+            return await self._append_movie_revenue_by_priority(df, filter_dataset, priority, time_budget)
 
         res = df.copy()
         # prepared df with new column
@@ -455,6 +738,238 @@ class TMDBDataLoader:
                     print(f'Received error: {e}, retry for block {start} - {end}')
 
         if filter_dataset:
-            res = self._filter_dataset(res)
+            res = await self._run_cpu_bound(self._filter_dataset, res)
+
+        return res
+
+    async def _fetch_movie_revenue(self, request_nb: int, name: str, year: str) -> tuple[int, str, float]:
+        """Search a single movie and retrieve its revenue
+
+        Parameters
+        ----------
+        request_nb: The position of the movie, for the debug print
+        name: The name of the movie
+        year: The release year of the movie
+
+        Returns
+        -------
+        The tmdb id of the movie (-1 if it was not found), its tmdb title and its revenue
+        """
+        response = await self._perform_async_request(self._search_movie_url(name, year), request_nb,
+                                                     'request movie id')
+        self.fallback_stats.nb_searches += 1
+        # A single response is matched inline, sending it to the process pool would cost more than the matching
+        movie_ids, movie_names = self._get_best_match_movie_id([(response['results'], name, year)])
+        tmdb_id, tmdb_title = movie_ids[0], movie_names[0]
+        if self._fallback_threshold is not None:
+            tmdb_id, tmdb_title = await self._search_movie_fallbacks(request_nb, name, year, tmdb_id, tmdb_title)
+        if tmdb_id == -1:
+            return tmdb_id, tmdb_title, np.nan
+
+        movie = await self._perform_async_request(f'{self._base_url}/movie/{tmdb_id}?language=en-US', request_nb,
+                                                  'request movie revenue')
+        revenue = np.nan if movie['revenue'] is not None and movie['revenue'] == 0 else movie['revenue']
+        return tmdb_id, tmdb_title, revenue
+
+    async def _append_movie_revenue_by_priority(self, df: pandas.DataFrame, filter_dataset: bool,
+                                                priority: pandas.Series, time_budget: float) -> pandas.DataFrame:
+        """Retrieve the revenue of the movies by decreasing priority, keeping the window of movies in flight full, so
+        that a run cut short by its time budget covers the most valuable movies first
+
+        Parameters
+        ----------
+        df: The movies dataframe for which to append the revenue
+        filter_dataset: Whether to filter the movies found on tmdb, see _filter_dataset
+        priority: The priority of each movie, aligned with df, the movies keep their order if None
+        time_budget: The number of seconds after which no new movie is fetched, no limit if None
+
+        Return
+        ------
+        A copy of the received dataframe with the revenue. The movies not fetched (time budget spent or error) have a
+        nan tmdb_id, so that they can be fetched by a later run
+        """
+        priorities = pandas.Series(0.0, index=df.index) if priority is None \
+            else priority.reindex(df.index).astype('float64')
+        names, years = df['name'].tolist(), df['release_date'].tolist()
+
+        # The near-duplicate titles of a year are fetched once, with the highest priority of their cluster
+        representatives = cluster_titles(df['name'], df['release_date'])
+        cluster_priorities = pandas.Series(priorities.to_numpy()).groupby(representatives).max()
+
+        scheduler = PriorityScheduler(max_concurrency=self._PRIORITY_CONCURRENCY, time_budget=time_budget)
+        results = await scheduler.run(cluster_priorities.index.tolist(), cluster_priorities.tolist(),
+                                      lambda i: self._fetch_movie_revenue(i, names[i], years[i]))
+        print(f'TMDB revenue: {scheduler.report()}')
+
+        # The members of a cluster share the result of its representative
+        fetched = [position for position, representative in enumerate(representatives) if representative in results]
+        values = [results[representatives[position]] for position in fetched]
+
+        res = df.copy()
+        fetched = df.index[fetched]
+        res['tmdb_id'] = pandas.Series([tmdb_id for tmdb_id, _, _ in values], index=fetched)
+        res['tmdb_title'] = pandas.Series([tmdb_title for _, tmdb_title, _ in values], index=fetched, dtype='object')
+        res['tmdb_revenue'] = pandas.Series([revenue for _, _, revenue in values], index=fetched, dtype='float')
+
+        if filter_dataset:
+            # The movies not fetched are kept aside, as the filter drops the missing ids
+            not_fetched = res.tmdb_id.isna()
+            filtered = await self._run_cpu_bound(self._filter_dataset, self._keep_best_cluster_members(
+                res[~not_fetched], representatives[~not_fetched.to_numpy()]))
+            res = pandas.concat([filtered, res[not_fetched].drop(columns='tmdb_title')])
+            res = res.reindex(df.index[df.index.isin(res.index)])
 
         return res
+
+    async def _perform_budgeted_request(self, url: str, request_nb: int, request_descr: str,
+                                        budget: asyncio.Semaphore):
+        """Perform a request once a slot of the concurrency budget is available
+
+        Parameters
+        ----------
+        url: correct formatted endpoint/url
+        request_nb: The index of the request we are processing, for the debug print
+        request_descr: A quick description of the request, to have a context in the debug print
+        budget: The semaphore shared by all the requests of the stream
+
+        Return
+        ------
+        Result of the request
+        """
+        async with budget:
+            return await self._perform_async_request(url, request_nb, request_descr)
+
+    @staticmethod
+    def _stream_key(name: str, year: str, tmdb_id) -> str:
+        """Key identifying a movie in the output of a stream, so that a stream can be resumed on another dataframe
+
+        Parameters
+        ----------
+        name: The name of the movie
+        year: The release year of the movie
+        tmdb_id: The tmdb id of the movie, None if it is searched
+
+        Returns
+        -------
+        The key of the movie
+        """
+        return json.dumps([name, str(year), None if pandas.isna(tmdb_id) else int(tmdb_id)])
+
+    async def _stream_movie(self, key: str, request_nb: int, name: str, year: str, tmdb_id,
+                            budget: asyncio.Semaphore) -> dict:
+        """Bring a single movie through the search, match, credits and person steps
+
+        Parameters
+        ----------
+        key: The key of the movie in the stream, see _stream_key
+        request_nb: The position of the movie in the stream, for the debug print
+        name: The name of the movie
+        year: The release year of the movie
+        tmdb_id: The tmdb id of the movie, None if it should be searched, nan or -1 if it was not found
+        budget: The semaphore shared by all the requests of the stream
+
+        Returns
+        -------
+        A record with the 'key', 'tmdb_id', 'tmdb_title' and 'composers' of the movie
+        """
+        tmdb_title = None
+        if tmdb_id is None:
+            response = await self._perform_budgeted_request(self._search_movie_url(name, year), request_nb,
+                                                            'stream movie id', budget)
+            movie_ids, movie_names = self._get_best_match_movie_id([(response['results'], name, year)])
+            tmdb_id, tmdb_title = movie_ids[0], movie_names[0]
+
+        composers = []
+        # A movie without tmdb id in the dataframe (nan) was not found, as a movie searched without match (-1)
+        if pandas.notna(tmdb_id) and tmdb_id != -1:
+            credits = await self._perform_budgeted_request(
+                f'{self._base_url}/movie/{int(tmdb_id)}/credits?language=en-US', request_nb, 'stream movie composer',
+                budget)
+
+            person_ids = [person['id'] for person in credits['crew']
+                          if person and 'composer' in person['job'].lower()]
+            persons = await asyncio.gather(*[self._perform_budgeted_request(
+                f'{self._base_url}/person/{person_id}?append_to_response=movie_credits&language=en-US', request_nb,
+                'stream person details', budget) for person_id in person_ids])
+
+            composers = [self._parse_composer(person) for person in persons]
+
+        return {'key': key, 'tmdb_id': int(tmdb_id) if pandas.notna(tmdb_id) else None, 'tmdb_title': tmdb_title,
+                'composers': composers}
+
+    async def stream_movie_composers(self, df: pandas.DataFrame, output_path: str = None, max_concurrency: int = 50,
+                                     filter_dataset: bool = True) -> pandas.DataFrame:
+        """Streaming alternative of append_movie_composers: each movie goes through search -> match -> credits ->
+        person as soon as its previous step completes, instead of waiting for every movie to finish each step. The
+        number of requests in flight is bounded by a global budget, and the record of each movie is appended to
+        output_path as soon as it is complete, so that an interrupted stream can be resumed
+
+        Parameters
+        ----------
+        df: The movies dataframe for which to append the composers, the tmdb ids are searched if the dataframe has no
+        tmdb_id column
+        output_path: The JSON lines file where to write the record of each movie, the movies already present in the
+        file are not requested again. Nothing is written if None
+        max_concurrency: The maximum number of requests in flight
+        filter_dataset: Whether to filter movies that were not found on tmdb and filter movies for which the same
+        tmdb_id was returned, only used when the tmdb ids are searched
+
+        Return
+        ------
+        A copy of the received dataframe where the composers were append
+        """
+        records = {}
+        if output_path and os.path.isfile(output_path):
+            with open(output_path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    record['composers'] = [Composer(**composer) for composer in record['composers']]
+                    records[record['key']] = record
+
+        search_ids = 'tmdb_id' not in df.columns
+        tmdb_ids = [None] * len(df) if search_ids else df.tmdb_id.tolist()
+        budget = asyncio.Semaphore(max_concurrency)
+
+        keys = [self._stream_key(name, year, tmdb_id)
+                for name, year, tmdb_id in zip(df['name'], df['release_date'], tmdb_ids)]
+        streams = [asyncio.create_task(self._stream_movie(key, request_nb, name, year, tmdb_id, budget))
+                   for request_nb, (key, name, year, tmdb_id) in
+                   enumerate(zip(keys, df['name'], df['release_date'], tmdb_ids))
+                   if key not in records]
+        if self._debug:
+            print(f'Streaming {len(streams)} movies, {len(records)} already done')
+
+        nb_errors = 0
+        with open(output_path, 'a') if output_path else nullcontext() as output:
+            for stream in asyncio.as_completed(streams):
+                try:
+                    record = await stream
+                except Exception as e:
+                    # The movie is not written, so it will be requested again by the next stream
+                    print(f'Error while streaming a movie: {e}')
+                    nb_errors += 1
+                    continue
+
+                records[record['key']] = record
+                if output:
+                    output.write(json.dumps({**record, 'composers': [asdict(c) for c in record['composers']]}) + '\n')
+                    output.flush()
+
+        if nb_errors:
+            print(f'{nb_errors} movies failed, run the stream again to retry them')
+
+        # Movies that failed are considered as not found
+        not_found = {'tmdb_id': -1, 'tmdb_title': 'NOT_FOUND', 'composers': []}
+        results = [records.get(key, not_found) for key in keys]
+
+        res_df = df.copy()
+        if search_ids:
+            res_df['tmdb_id'] = [record['tmdb_id'] for record in results]
+            res_df['tmdb_title'] = [record['tmdb_title'] for record in results]
+        # map empty list to nan values, as append_movie_composers
+        res_df['composers'] = [record['composers'] if record['composers'] else np.nan for record in results]
+
+        if search_ids and filter_dataset:
+            res_df = await self._run_cpu_bound(self._filter_dataset, res_df)
+
+        return res_df